@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FreedomPay ASGI Server
+Асинхронный режим тестового сервера FreedomPay
+
+Платежные и статусные маршруты (/pay, /check, /result, /check_payment_status,
+/wait_payment_status, /payment_status_stream, /diagnose) обрабатываются корутинами:
+long-poll и SSE ждут на asyncio future, а не на потоке, исходящий POST шлюза идет
+через httpx.AsyncClient. Остальные страницы отдает тот же Flask-приложение
+в ограниченном пуле потоков.
+
+Зависимости режима (необязательные для основного сервера, см. requirements.txt):
+    pip install -r requirements.txt
+
+Запуск:
+    python freedom_pay_asgi.py --port 5000
+    uvicorn freedom_pay_asgi:app --port 5000
+"""
+
+import argparse
+import asyncio
+import contextvars
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qsl, urlsplit
+
+try:
+    import httpx
+except ImportError:  # без httpx исходящие запросы идут через GatewaySession в пуле потоков
+    httpx = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+import freedom_pay_final_attempt as server
+
+ASGI_WSGI_THREADS = 16          # потоков для маршрутов, которые остаются на Flask
+ASGI_MAX_BODY = 1024 * 1024     # байт, больше в форме callback'а не бывает
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-wsgi")
+
+class AsyncGatewayClient:
+    """Исходящие запросы к шлюзу: пул keep-alive соединений и таймауты как у GatewaySession"""
+
+    def __init__(self):
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(server.HTTP_READ_TIMEOUT, connect=server.HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_keepalive_connections=server.HTTP_POOL_MAXSIZE),
+                headers={"User-Agent": server.PROBE_USER_AGENT})
+        return self._client
+
+    async def post(self, url, data):
+        """POST формы; возвращает (код, тело ответа)"""
+        if httpx is None:
+            response = await asyncio.to_thread(server.gateway_session.post, url, data=data)
+            return response.status_code, response.text
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        try:
+            response = await self._get_client().post(url, data=data)
+        except httpx.HTTPError:
+            server.GATEWAY_ERRORS.inc(host, "async")
+            raise
+        finally:
+            server.GATEWAY_LATENCY.observe(time.perf_counter() - started, host, "async")
+        return response.status_code, response.text
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+gateway_client = AsyncGatewayClient()
+
+def _resolve(future, status):
+    if not future.done():
+        future.set_result(status)
+
+async def wait_for_change(order_id, known_status, timeout):
+    """
+    Асинхронный аналог StatusWaiters.wait_for_change: подписка в том же реестре,
+    callback из потока очереди будит future через call_soon_threadsafe.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def on_change(status):
+        loop.call_soon_threadsafe(_resolve, future, status)
+
+    server.status_waiters.subscribe(order_id, on_change)
+    try:
+        # Подписываемся до чтения, чтобы не пропустить изменение между ними
+        status = server.payment_statuses.get(order_id, "pending")
+        if status != known_status:
+            return status
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return status
+    finally:
+        server.status_waiters.unsubscribe(order_id, on_change)
+
+class Request:
+    """Минимальный разбор ASGI-запроса: путь, query, заголовки, форма"""
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.body = body
+        # keep_blank_values: пустые поля (pg_card_pan=) входят в подпись FreedomPay, как и во Flask
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope.get("headers", [])}
+
+    @property
+    def form(self):
+        # FreedomPay и форма /pay шлют application/x-www-form-urlencoded; битый UTF-8 заменяется, как в werkzeug,
+        # иначе такой запрос давал бы 500 вместо 400 от проверки подписи
+        return dict(parse_qsl(self.body.decode("utf-8", "replace"), keep_blank_values=True))
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def send_response(send, status, body, content_type="text/html; charset=utf-8", headers=None):
+    if isinstance(body, (dict, list)):
+        body = server.json.dumps(body, ensure_ascii=False)
+        content_type = "application/json"
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    raw_headers = [(b"content-type", content_type.encode("latin-1")),
+                   (b"content-length", str(len(body)).encode("latin-1"))]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode("latin-1"), str(value).encode("latin-1")))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+async def pay(request, send):
+    if not server.validate_credentials():
+        return await send_response(send, 200, "<h2>❌ Ошибка конфигурации</h2>")
+    if not server.validate_ngrok_url():
+        return await send_response(send, 200, "<h2>❌ Ошибка конфигурации NGROK URL</h2>")
+    amount = request.form.get("amount")
+    if amount is None:
+        return await send_response(send, 400, "<h2>Bad Request</h2>")
+    redirect_url = server.build_payment_redirect(amount, route=request.path)
+    await send_response(send, 302, "", headers={"Location": redirect_url})
+
+async def callback(request, send):
+    # Запись в журнал (fsync) — в потоке, чтобы медленный диск не останавливал event loop;
+    # места в очереди не ждем: переполнение сразу отвечает 503
+    response = await asyncio.to_thread(server.process_callback, request.path.lstrip("/"), request.form,
+                                       enqueue_timeout=0, route=request.path)
+    body, status = response[0], response[1]
+    headers = response[2] if len(response) > 2 else None
+    await send_response(send, status, body, "text/html; charset=utf-8", headers)
+
+async def check_payment_status(request, send):
+    order_id = request.args.get("order_id")
+    if not order_id:
+        return await send_response(send, 400, {"status": "error", "message": "order_id не указан"})
+    record = server.payment_statuses.get_record(order_id)
+    status = record["status"] if record else "pending"
+    if server.needs_gateway_lookup(record):
+        # Общий с другими запросами вызов шлюза; shield — таймаут клиента не отменяет его для остальных
+        future = asyncio.wrap_future(server.status_lookup.lookup_async(record))
+        try:
+            outcome = await asyncio.wait_for(asyncio.shield(future), server.STATUS_LOOKUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            outcome = None
+        # Запись финального статуса (хранилище и outbox webhook'ов) — не на event loop
+        status = await asyncio.to_thread(server.apply_gateway_outcome, record, outcome)
+    server.log_message("🔍 Unity запрашивает статус", route=request.path, order_id=order_id, status=status)
+    await send_response(send, 200, {"order_id": order_id, "status": status,
+                                    "timestamp": datetime.now().isoformat()})
+
+async def wait_payment_status(request, send):
+    order_id = request.args.get("order_id")
+    if not order_id:
+        return await send_response(send, 400, {"status": "error", "message": "order_id не указан"})
+    known_status = request.args.get("known", "pending")
+    try:
+        timeout = min(float(request.args.get("timeout", server.LONG_POLL_MAX_TIMEOUT)), server.LONG_POLL_MAX_TIMEOUT)
+    except ValueError:
+        return await send_response(send, 400, {"status": "error", "message": "timeout должен быть числом"})
+    status = await wait_for_change(order_id, known_status, max(timeout, 0))
+    await send_response(send, 200, {"order_id": order_id, "status": status, "changed": status != known_status,
+                                    "timestamp": datetime.now().isoformat()})
+
+async def payment_status_stream(request, send):
+    order_id = request.args.get("order_id")
+    if not order_id:
+        return await send_response(send, 400, {"status": "error", "message": "order_id не указан"})
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                            (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+
+    deadline = time.monotonic() + server.SSE_MAX_DURATION
+    status = server.payment_statuses.get(order_id, "pending")
+    await emit("retry: 3000\n")
+    await emit(server.format_sse_event("status", {"order_id": order_id, "status": status}))
+    while status not in server.FINAL_STATUSES and time.monotonic() < deadline:
+        new_status = await wait_for_change(order_id, status, server.SSE_HEARTBEAT_INTERVAL)
+        if new_status == status:
+            await emit(": keep-alive\n\n")
+            continue
+        status = new_status
+        await emit(server.format_sse_event("status", {"order_id": order_id, "status": status}))
+    await send({"type": "http.response.body", "body": b""})
+
+async def diagnose(request, send):
+    server.log_message("🩺 Начинаем диагностику ошибки 10000...", route=request.path)
+    test_params, signature, _ = server.diagnose_test_request()
+    try:
+        post_outcome = await gateway_client.post(server.GATEWAY_URLS[0], dict(test_params, pg_sig=signature))
+    except Exception as e:
+        post_outcome = e
+    # Проверка шлюзов может уйти в сеть, рендер шаблона — CPU: обе вне event loop
+    results = await asyncio.to_thread(server.diagnose_results, post_outcome, bool(request.args.get("refresh")))
+
+    def render():
+        with server.app.app_context():
+            return server.render_page("diagnose", results='\\n'.join(results))
+
+    await send_response(send, 200, await asyncio.to_thread(render))
+
+ROUTES = {
+    ("POST", "/pay"): pay,
+    ("POST", "/check"): callback,
+    ("POST", "/result"): callback,
+    ("GET", "/check_payment_status"): check_payment_status,
+    ("GET", "/wait_payment_status"): wait_payment_status,
+    ("GET", "/payment_status_stream"): payment_status_stream,
+    ("GET", "/diagnose"): diagnose,
+}
+
+def build_environ(scope, body):
+    """WSGI environ из ASGI scope для маршрутов, которые обслуживает Flask"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def start_wsgi(environ):
+    """
+    Запуск Flask-приложения в потоке пула: (код, заголовки, первые куски тела, итератор, ответ WSGI).
+    По WSGI start_response можно вызвать и при первой итерации, поэтому первый кусок берем сразу.
+    """
+    response = {"chunks": []}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+        return response["chunks"].append
+
+    result = server.app(environ, start_response)
+    iterator = iter(result)
+    try:
+        for chunk in iterator:
+            if chunk:
+                response["chunks"].append(chunk)
+                break
+    except BaseException:
+        if hasattr(result, "close"):
+            result.close()
+        raise
+    return response["status"], response["headers"], response["chunks"], iterator, result
+
+def next_chunk(iterator):
+    """Следующий непустой кусок тела WSGI-ответа или None в конце"""
+    for chunk in iterator:
+        if chunk:
+            return chunk
+    return None
+
+async def call_wsgi(scope, body, send):
+    """
+    Маршрут Flask в пуле потоков с потоковой отдачей тела: каждый кусок (страницы
+    /all_payment_statuses, строки NDJSON) уходит клиенту сразу, поток пула занят только
+    на время его получения. Все шаги идут в одном contextvars.Context запроса:
+    генераторы stream_with_context держат в нем контекст Flask между потоками пула.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.Context()
+    status, headers, chunks, iterator, result = await loop.run_in_executor(
+        wsgi_executor, context.run, start_wsgi, build_environ(scope, body))
+    try:
+        # Content-Length Flask оставляем, chunked-кодирование делает сам ASGI-сервер
+        raw_headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+                       if name.lower() != "transfer-encoding"]
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        while True:
+            chunk = await loop.run_in_executor(wsgi_executor, context.run, next_chunk, iterator)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(wsgi_executor, context.run, result.close)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            server.start_background_services()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await gateway_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    """ASGI-приложение: платежные маршруты — корутины, остальное — Flask в пуле потоков"""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return await send_response(send, 413, "<h2>Request Entity Too Large</h2>")
+
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        return await call_wsgi(scope, body, send)
+
+    started = time.perf_counter()
+    status = {}
+
+    async def tracked_send(message):
+        if message["type"] == "http.response.start":
+            status["code"] = message["status"]
+        await send(message)
+
+    request = Request(scope, body)
+    limited = None
+    if request.path in server.rate_limiter.limits:
+        limited = server.rate_limit_response(request.path, (scope.get("client") or ("", 0))[0],
+                                             request.headers.get("x-forwarded-for"), request.args.get("order_id"))
+    if limited is not None:
+        payload, status_code, headers = limited
+        await send_response(tracked_send, status_code, payload, headers=headers)
+    else:
+        await handler(request, tracked_send)
+    if scope["path"] in server.METRICS_ROUTES:
+        server.REQUEST_LATENCY.observe(time.perf_counter() - started, scope["path"])
+        server.REQUESTS_TOTAL.inc(scope["path"], status.get("code", 500))
+
+def main():
+    """Главная функция"""
+    parser = argparse.ArgumentParser(description="Тестовый сервер FreedomPay в режиме ASGI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    if uvicorn is None:
+        sys.exit("❌ Для ASGI режима нужен uvicorn: pip install -r requirements.txt")
+    if httpx is None:
+        server.log_message("⚠️ httpx не установлен, исходящие запросы пойдут через пул потоков", level="WARNING")
+
+    server.log_message("🚀 Запуск FreedomPay тестового сервера (ASGI)...")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", lifespan="on")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1530 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FreedomPay Server Benchmarks
+Бенчмарки производительности тестового сервера FreedomPay
+
+Запуск:
+    python freedom_pay_benchmark.py store --orders 1000000
+    python freedom_pay_benchmark.py longpoll --clients 200
+    python freedom_pay_benchmark.py signer --count 100000
+    python freedom_pay_benchmark.py logging --requests 20000
+    python freedom_pay_benchmark.py templates --orders 10000
+    python freedom_pay_benchmark.py probe --deadline 2
+    python freedom_pay_benchmark.py session --requests 2000
+    python freedom_pay_benchmark.py selector
+    python freedom_pay_benchmark.py soak --orders 10000000
+    python freedom_pay_benchmark.py metrics --threads 8
+    python freedom_pay_benchmark.py profiler
+    python freedom_pay_benchmark.py e2e --concurrency 1,4,16,64 --output e2e_results.json
+    python freedom_pay_benchmark.py asgi --waiters 2000
+    python freedom_pay_benchmark.py parity
+    python freedom_pay_benchmark.py scaling --workers 1,2,4
+    python freedom_pay_benchmark.py reconcile --orders 2000 --rate 20 --budget 5
+    python freedom_pay_benchmark.py lookup --clients 32 --orders 20
+    python freedom_pay_benchmark.py journal --callbacks 10000000
+    python freedom_pay_benchmark.py webhooks --orders 20000 --delay 200 --failure-rate 0.1
+    python freedom_pay_benchmark.py ratelimit --abusers 8 --clients 16 --duration 10
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import freedom_pay_final_attempt as server
+
+def percentile(values, p):
+    """Перцентиль p (0..100) по отсортированному списку"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def format_latency(seconds):
+    """Форматирование задержки в микросекундах"""
+    return f"{seconds * 1e6:.1f} µs"
+
+def format_optional(value, spec):
+    """Число по формату spec или "—", если замер его не дал (ни одного запроса)"""
+    return "—" if value is None else format(value, spec)
+
+def relative_change(value, previous):
+    """Изменение относительно previous в процентах или "—", если сравнивать не с чем"""
+    return f"{(value / previous - 1) * 100:+.0f}%" if previous else "—"
+
+def bench_store(args):
+    """Устойчивая скорость записи и p99 чтения хранилища статусов"""
+    workdir = tempfile.mkdtemp(prefix="fp_store_bench_")
+    try:
+        store = server.create_status_store(args.backend, os.path.join(workdir, "bench.db"))
+        orders = args.orders
+        statuses = ("pending", "success", "failed")
+
+        print("=" * 60)
+        print(f"📦 ХРАНИЛИЩЕ СТАТУСОВ: {args.backend}, заказов: {orders}")
+        print("=" * 60)
+
+        # Запись: как в /check + /result — отдельный set() на каждый callback
+        started = time.perf_counter()
+        for i in range(orders):
+            store.set(f"order_{i}", statuses[i % 3], payment_id=f"pay_{i}")
+        store.flush()
+        elapsed = time.perf_counter() - started
+        print(f"✍️  Записи: {orders / elapsed:,.0f} в сек ({elapsed:.2f} с всего)")
+
+        # Чтение по order_id (как /check_payment_status и /payment_status/<order_id>)
+        rng = random.Random(42)
+        latencies = []
+        for _ in range(args.reads):
+            order_id = f"order_{rng.randrange(orders)}"
+            t0 = time.perf_counter()
+            store.get(order_id)
+            latencies.append(time.perf_counter() - t0)
+        print(f"🔍 get(order_id):   p50 {format_latency(percentile(latencies, 50))}, "
+              f"p99 {format_latency(percentile(latencies, 99))}")
+
+        # Чтение по pg_payment_id (как повторный /result)
+        latencies = []
+        for _ in range(args.reads):
+            payment_id = f"pay_{rng.randrange(orders)}"
+            t0 = time.perf_counter()
+            store.find_by_payment_id(payment_id)
+            latencies.append(time.perf_counter() - t0)
+        print(f"🔍 find_by_payment_id: p50 {format_latency(percentile(latencies, 50))}, "
+              f"p99 {format_latency(percentile(latencies, 99))}")
+
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def rss_mb():
+    """Текущий RSS процесса в МБ"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+def bench_soak(args):
+    """RSS на длинном потоке заказов: /check → pending, /result → success/failed, часть зависает и истекает"""
+    workdir = tempfile.mkdtemp(prefix="fp_soak_bench_")
+    try:
+        store = server.create_status_store(args.backend, os.path.join(workdir, "soak.db"))
+        if args.backend == "bounded":
+            store.capacity = args.capacity
+            store.pending_ttl = args.pending_ttl
+        rng = random.Random(7)
+        expiry = server.OrderExpiry(store)
+
+        print("=" * 60)
+        print(f"🧪 SOAK: {args.backend}, заказов: {args.orders:,}, "
+              f"кеш: {args.capacity:,}, pending TTL: {args.pending_ttl} с")
+        print("=" * 60)
+
+        batch = 10_000
+        report_every = max(batch, args.orders // 10)
+        started = time.perf_counter()
+        baseline = rss_mb()
+        expired = 0
+        print(f"   {0:>12,} заказов  RSS {baseline:7.1f} МБ")
+        for start in range(0, args.orders, batch):
+            order_ids = [f"soak_{i}" for i in range(start, min(start + batch, args.orders))]
+            for order_id in order_ids:
+                store.insert_if_absent(order_id, "pending")
+            # 95% заказов получают /result, остальные так и остаются pending
+            updates = [(order_id, "success" if rng.random() < 0.9 else "failed", f"pay_{order_id}")
+                       for order_id in order_ids if rng.random() < 0.95]
+            store.set_many(updates)
+            for _ in range(batch // 10):
+                store.get(rng.choice(order_ids))
+            expired += len(expiry.run_once(sweep=start % (batch * 50) == 0))
+            done = start + len(order_ids)
+            if done % report_every == 0 or done == args.orders:
+                print(f"   {done:>12,} заказов  RSS {rss_mb():7.1f} МБ  "
+                      f"({done / (time.perf_counter() - started):,.0f} заказов/с, просрочено {expired:,})")
+        store.flush()
+        print(f"Прирост RSS: {rss_mb() - baseline:+.1f} МБ")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def free_port():
+    """Свободный локальный TCP порт"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def children_cpu_seconds():
+    """Суммарное CPU-время завершенных дочерних процессов"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class ServerProcess:
+    """Тестовый сервер в отдельном процессе, чтобы мерить его CPU отдельно от клиентов"""
+
+    def __init__(self, workdir, extra_args=(), env=None):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.workdir = workdir
+        self.extra_args = list(extra_args)
+        # Клиенты бенчмарков идут с одного адреса, поэтому лимиты частоты выключены, если их не задали явно
+        self.env = dict(os.environ, FREEDOMPAY_STATUS_DB=os.path.join(workdir, "server.db"),
+                        FREEDOMPAY_RATE_LIMITS=json.dumps({route: None for route in server.RATE_LIMITS}))
+        self.env.update(env or {})
+        self.process = None
+        self.cpu_seconds = None
+
+    def __enter__(self):
+        self._cpu_before = children_cpu_seconds()
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "serve", "--port", str(self.port)] + self.extra_args,
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            try:
+                requests.get(f"{self.base_url}/check_payment_status", timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.05)
+        self.process.kill()
+        raise RuntimeError("Сервер не запустился")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
+        self.cpu_seconds = children_cpu_seconds() - self._cpu_before
+
+def serve(args):
+    """Запуск сервера без reloader/debug для бенчмарков"""
+    if args.workers:
+        import freedom_pay_prefork
+        freedom_pay_prefork.PreforkServer("127.0.0.1", args.port, args.workers).run()
+        return
+    if args.asgi:
+        import uvicorn
+        import freedom_pay_asgi
+        uvicorn.run(freedom_pay_asgi.app, host="127.0.0.1", port=args.port, log_level="warning")
+        return
+    from werkzeug.serving import make_server
+    make_server("127.0.0.1", args.port, server.app, threaded=True).serve_forever()
+
+def run_status_clients(base_url, mode, clients, delay, poll_interval):
+    """
+    Клиенты ждут финальный статус своего заказа в режиме mode ("poll" или "longpoll"),
+    а отдельный поток присылает /result для каждого заказа через ~delay секунд.
+    Возвращает число запросов клиентов к серверу.
+    """
+    run_id = f"{mode}_{time.time_ns()}"
+    order_ids = [f"{run_id}_{i}" for i in range(clients)]
+    request_counts = [0] * clients
+    ready = threading.Barrier(clients + 1)
+
+    def client(index):
+        session = requests.Session()
+        order_id = order_ids[index]
+        ready.wait()
+        while True:
+            if mode == "poll":
+                response = session.get(f"{base_url}/check_payment_status", params={"order_id": order_id})
+            else:
+                response = session.get(f"{base_url}/wait_payment_status", params={"order_id": order_id})
+            request_counts[index] += 1
+            if response.json()["status"] in server.FINAL_STATUSES:
+                return
+            if mode == "poll":
+                time.sleep(poll_interval)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+
+    session = requests.Session()
+    rng = random.Random(7)
+    schedule = sorted((rng.uniform(delay / 2, delay * 1.5), order_id) for order_id in order_ids)
+    started = time.monotonic()
+    for at, order_id in schedule:
+        time.sleep(max(0, started + at - time.monotonic()))
+        session.post(f"{base_url}/result", data={"pg_order_id": order_id, "pg_result": "1",
+                                                 "pg_payment_id": f"pay_{order_id}"})
+    for thread in threads:
+        thread.join()
+    return sum(request_counts)
+
+def bench_longpoll(args):
+    """Сравнение опроса /check_payment_status с long-poll /wait_payment_status"""
+    print("=" * 60)
+    print(f"⏳ ОПРОС vs LONG-POLL: клиентов {args.clients}, оплата через ~{args.delay} с")
+    print("=" * 60)
+    results = {}
+    for mode in ("poll", "longpoll"):
+        workdir = tempfile.mkdtemp(prefix="fp_longpoll_bench_")
+        try:
+            with ServerProcess(workdir) as srv:
+                started = time.perf_counter()
+                total_requests = run_status_clients(srv.base_url, mode, args.clients, args.delay, args.poll_interval)
+                elapsed = time.perf_counter() - started
+            results[mode] = (total_requests, srv.cpu_seconds)
+            print(f"{mode:>9}: запросов {total_requests:>7}, CPU сервера {srv.cpu_seconds:6.2f} с, "
+                  f"время {elapsed:5.1f} с")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    poll_requests, poll_cpu = results["poll"]
+    long_requests, long_cpu = results["longpoll"]
+    print(f"📉 Запросов меньше в {poll_requests / max(long_requests, 1):.1f} раз, "
+          f"CPU меньше в {poll_cpu / max(long_cpu, 1e-6):.1f} раз")
+
+def legacy_generate_signature(params_dict, script_name, secret_key):
+    """Прежняя реализация generate_correct_signature — база для сравнения"""
+    sorted_keys = sorted(params_dict.keys())
+    values = [str(params_dict[key]) for key in sorted_keys]
+    values.insert(0, script_name)
+    values.append(secret_key)
+    sign_string = ';'.join(values)
+    signature = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+    return signature, sign_string
+
+def sample_callback_params(index):
+    """Типичный набор полей callback'а /result"""
+    return {
+        "pg_order_id": f"order_{index}",
+        "pg_payment_id": str(100000000 + index),
+        "pg_amount": "1000",
+        "pg_currency": "UZS",
+        "pg_net_amount": "970",
+        "pg_ps_amount": "1000",
+        "pg_ps_full_amount": "1000",
+        "pg_ps_currency": "UZS",
+        "pg_description": "Test Payment",
+        "pg_result": "1",
+        "pg_payment_date": "2025-01-01 12:00:00",
+        "pg_can_reject": "1",
+        "pg_user_phone": "998901234567",
+        "pg_salt": f"salt{index:012d}",
+    }
+
+def bench_signer(args):
+    """Signer против прежней generate_correct_signature"""
+    signer = server.get_signer("result.php", server.SECRET_KEY)
+    params_list = [sample_callback_params(i) for i in range(args.count)]
+    signed_list = [dict(params, pg_sig=signer.sign(params)) for params in params_list]
+    count = args.count
+
+    def timed(label, func):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<38} {elapsed / count * 1e6:7.2f} µs/подпись  ({count / elapsed:,.0f} в сек)")
+
+    print("=" * 60)
+    print(f"🔐 ПОДПИСЬ: {count} словарей по {len(params_list[0])} полей")
+    print("=" * 60)
+    timed("legacy generate_correct_signature", lambda: [
+        legacy_generate_signature(params, "result.php", server.SECRET_KEY) for params in params_list])
+    timed("legacy проверка (копия + сравнение)", lambda: [
+        legacy_generate_signature({k: v for k, v in params.items() if k != 'pg_sig'},
+                                  "result.php", server.SECRET_KEY)[0] == params['pg_sig']
+        for params in signed_list])
+    timed("Signer.sign", lambda: [signer.sign(params) for params in params_list])
+    timed("Signer.sign_many", lambda: signer.sign_many(params_list))
+    timed("Signer.verify_many", lambda: signer.verify_many(signed_list))
+
+def legacy_log_message(msg):
+    """Прежний log_message: strftime + синхронный print на каждую строку"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {msg}")
+
+def legacy_route_logging(route, form, signature, sign_string):
+    """Строки, которые прежние обработчики писали на один запрос маршрута"""
+    log = legacy_log_message
+    if route == "/pay":
+        log(f"💰 Amount: {form['pg_amount']} UZS")
+        log(f"🧂 Salt: {form['pg_salt']}")
+        log(f"✅ ПРАВИЛЬНАЯ подпись: {signature}")
+        log(f"📝 Sign String: {sign_string}")
+        log(f"🔗 Итоговая ссылка: https://api.freedompay.uz/payment.php?{sign_string}")
+        log("🚀 Перенаправляем...")
+    elif route == "/result":
+        log("▶ RESULT запрос получен")
+        log(f"📨 Данные: {dict(form)}")
+        log("🔍 Проверка подписи:")
+        log(f"   Получена: {signature}")
+        log(f"   Ожидаем: {signature}")
+        log(f"   Строка: {sign_string}")
+        log("✅ Подпись RESULT корректна")
+        log(f"🆔 Order ID: {form['pg_order_id']}")
+        log(f"💳 Payment ID: {form['pg_payment_id']}")
+        log(f"💰 Amount: {form['pg_amount']} UZS")
+        log(f"✅ Платеж успешен! Payment ID: {form['pg_payment_id']}")
+    else:
+        log(f"🔍 Unity запрашивает статус для Order ID: {form['pg_order_id']}")
+        log("📊 Статус: pending")
+
+def structured_route_logging(route, form, signature, sign_string):
+    """Те же события через текущий log_message"""
+    log = server.log_message
+    if route == "/pay":
+        log("💰 Новый платеж", amount=form['pg_amount'], salt=form['pg_salt'], signature=signature)
+        log("📝 Sign String", level="DEBUG", sign_string=sign_string)
+        log("🚀 Перенаправляем", level="DEBUG", redirect_url=sign_string)
+    elif route == "/result":
+        log("▶ RESULT", level="DEBUG", form=form)
+        log("✅ Платеж успешен", order_id=form['pg_order_id'], payment_id=form['pg_payment_id'])
+    else:
+        log("🔍 Unity запрашивает статус", order_id=form['pg_order_id'], status="pending")
+
+def bench_logging(args):
+    """Накладные расходы логирования на один запрос: прежний print против очереди"""
+    signer = server.get_signer("result.php", server.SECRET_KEY)
+    forms = [sample_callback_params(i) for i in range(args.requests)]
+    signatures = [(signer.sign(form), signer.sign_string(form)) for form in forms]
+    sink = tempfile.TemporaryFile("w+") if args.sink == "file" else open(os.devnull, "w")
+    server.logger.stream = sink
+    modes = {"print (прежний)": legacy_route_logging, "очередь + JSON": structured_route_logging}
+
+    print("=" * 60)
+    print(f"📝 ЛОГИРОВАНИЕ: {args.requests} запросов на маршрут, вывод в {args.sink}")
+    print("=" * 60)
+    try:
+        for route in ("/pay", "/result", "/check_payment_status"):
+            timings = {}
+            # Режимы чередуются по раундам, берется лучший раунд — так меньше влияет шум машины
+            for _ in range(args.rounds):
+                for mode, route_logging in modes.items():
+                    with server.app.test_request_context(route), contextlib.redirect_stdout(sink):
+                        started = time.perf_counter()
+                        for form, (signature, sign_string) in zip(forms, signatures):
+                            route_logging(route, form, signature, sign_string)
+                        handler_time = time.perf_counter() - started
+                        # Время фонового потока тоже считаем: он делит GIL с обработчиками
+                        server.logger.flush()
+                        total_time = time.perf_counter() - started
+                    best = timings.get(mode, (handler_time, total_time))
+                    timings[mode] = (min(handler_time, best[0]), min(total_time, best[1]))
+            print(f"{route}:")
+            for mode, (handler_time, total_time) in timings.items():
+                print(f"   {mode:<16} в обработчике {format_latency(handler_time / args.requests):>10}/запрос, "
+                      f"всего {format_latency(total_time / args.requests):>10}/запрос")
+    finally:
+        server.logger.stream = None
+
+def bench_templates(args):
+    """Запросы в секунду для /all_payment_statuses: render_template_string, реестр, кеш, страница по курсору"""
+    from flask import render_template_string
+
+    store = server.create_status_store("memory")
+    store.set_many([(f"order_{i}", ("pending", "success", "failed")[i % 3], None) for i in range(args.orders)])
+    server.payment_statuses = store
+    source = server.TEMPLATE_SOURCES["all_payment_statuses"]
+    app = server.app
+    context = {"status_filter": None, "next_cursor": None, "limit": args.orders}
+
+    def legacy():
+        with app.test_request_context("/all_payment_statuses"):
+            return render_template_string(source, records=store.iter_records(), **context)
+
+    def compiled():
+        with app.test_request_context("/all_payment_statuses"):
+            return server.render_page("all_payment_statuses", records=store.iter_records(), **context)
+
+    def cached():
+        with app.test_request_context("/all_payment_statuses"):
+            return server.render_cached_page("all_payment_statuses", (store.version, "bench"),
+                                             records=store.iter_records(), **context)
+
+    client = app.test_client()
+    cases = {
+        "render_template_string (прежний)": legacy,
+        "скомпилированный шаблон": compiled,
+        "шаблон + кеш страницы": cached,
+        "GET страница по курсору": lambda: client.get("/all_payment_statuses").data,
+    }
+
+    print("=" * 60)
+    print(f"🖼  /all_payment_statuses: {args.orders} заказов")
+    print("=" * 60)
+    for label, render in cases.items():
+        render()  # прогрев, для кеша — первое заполнение
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            render()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<34} {args.requests / elapsed:10,.1f} запросов/с")
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Локальная замена шлюза: /slow отвечает с задержкой, /nohead не принимает HEAD"""
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят отдельными write: без TCP_NODELAY keep-alive упирается в delayed ACK
+    disable_nagle_algorithm = True
+    slow_delay = 3.0
+
+    def _respond(self, status, body=b"OK"):
+        if self.path.startswith("/slow"):
+            time.sleep(self.slow_delay)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._respond(405 if self.path.startswith("/nohead") else 200)
+
+    def do_GET(self):
+        self._respond(200)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond(200)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in_server(handler=StandInHandler):
+    """HTTP-сервер-заглушка в фоновом потоке; возвращает (server, base_url)"""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+def bench_probe(args):
+    """Последовательная проверка (как раньше) против параллельной с дедлайном на заглушках"""
+    _, fast_url = start_stand_in_server()
+    # Слушающий сокет без accept: соединение устанавливается, ответа нет никогда
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(16)
+    blackhole_url = f"http://127.0.0.1:{blackhole.getsockname()[1]}"
+    dead_url = f"http://127.0.0.1:{free_port()}"
+
+    urls = [f"{fast_url}/payment.php", f"{fast_url}/init_payment.php", f"{fast_url}/nohead/payment.php",
+            f"{fast_url}/slow/payment.php", f"{blackhole_url}/payment.php", f"{dead_url}/payment.php"]
+
+    print("=" * 60)
+    print(f"🌐 ПРОВЕРКА ШЛЮЗОВ: {len(urls)} URL, таймаут {args.timeout} с, дедлайн {args.deadline} с")
+    print("=" * 60)
+
+    started = time.perf_counter()
+    for url in urls:
+        try:
+            requests.head(url, timeout=args.timeout)
+        except requests.RequestException:
+            pass
+    print(f"Последовательно (requests.head): {time.perf_counter() - started:.2f} с")
+
+    started = time.perf_counter()
+    probes = server.probe_endpoints(urls, method="HEAD", get_on_405=True,
+                                    deadline=args.deadline, timeout=args.timeout)
+    print(f"Параллельно (probe_endpoints):    {time.perf_counter() - started:.2f} с")
+    for probe in probes:
+        outcome = f"код {probe['status']}" if probe["ok"] else f"ошибка: {probe['error'][:40]}"
+        if probe["get_status"] is not None:
+            outcome += f" | GET {probe['get_status']}"
+        print(f"   {probe['url']:<45} {outcome}{server.format_probe_timings(probe)}")
+
+    # Фоновый монитор: страницы читают таблицу, недоступные хосты отключаются автоматом
+    monitor = server.GatewayHealthMonitor(urls, deadline=args.deadline, timeout=args.timeout)
+    rounds = []
+    for _ in range(server.BREAKER_FAILURE_THRESHOLD + 1):
+        started = time.perf_counter()
+        monitor.refresh()
+        rounds.append(time.perf_counter() - started)
+    print(f"Проверки монитора по кругам: {', '.join(f'{value:.2f} с' for value in rounds)}")
+    print(f"Автоматы: {monitor.stats()['breakers']}")
+
+    reads = 10_000
+    started = time.perf_counter()
+    for _ in range(reads):
+        monitor.snapshot()
+    print(f"Чтение таблицы здоровья: {format_latency((time.perf_counter() - started) / reads)}")
+    blackhole.close()
+
+def bench_session(args):
+    """Отдельные requests.post (новое соединение на запрос) против общей сессии с пулом"""
+    httpd, base_url = start_stand_in_server()
+    url = f"{base_url}/payment.php"
+    payloads = [dict(sample_callback_params(i), pg_sig="0" * 32) for i in range(args.requests)]
+
+    def run(post):
+        latencies = []
+        def worker(chunk):
+            for data in chunk:
+                started = time.perf_counter()
+                post(url, data=data).close()
+                latencies.append(time.perf_counter() - started)
+        chunks = [payloads[i::args.threads] for i in range(args.threads)]
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started, sorted(latencies)
+
+    print("=" * 60)
+    print(f"🔌 ИСХОДЯЩИЕ ЗАПРОСЫ: {args.requests} POST, {args.threads} потоков")
+    print("=" * 60)
+
+    elapsed, latencies = run(lambda target, **kwargs: requests.post(target, timeout=10, **kwargs))
+    print(f"requests.post:   {elapsed:.2f} с, p50 {format_latency(percentile(latencies, 50))}, "
+          f"p99 {format_latency(percentile(latencies, 99))}, соединений: {args.requests}")
+
+    host = base_url.split("//", 1)[1]
+    session = server.GatewaySession({host: args.threads})
+    elapsed, latencies = run(session.post)
+    pools = session.stats()["pools"]
+    print(f"GatewaySession:  {elapsed:.2f} с, p50 {format_latency(percentile(latencies, 50))}, "
+          f"p99 {format_latency(percentile(latencies, 99))}, "
+          f"соединений: {sum(pool['connections'] for pool in pools.values())}, "
+          f"переиспользовано: {sum(pool['reused'] for pool in pools.values())}")
+    session.close()
+    httpd.shutdown()
+
+def bench_selector(args):
+    """Стоимость выбора шлюза в /pay и переключение при деградации основного"""
+    urls = list(server.GATEWAY_URLS)
+    monitor = server.GatewayHealthMonitor(urls)
+    selector = server.GatewaySelector(urls, monitor)
+    rng = random.Random(1)
+
+    def probe_round(primary_latency, primary_error_rate):
+        results = []
+        for index, url in enumerate(urls):
+            latency = primary_latency if index == 0 else 0.040 + 0.010 * index
+            failed = index == 0 and rng.random() < primary_error_rate
+            results.append({"url": url, "ok": not failed, "status": None if failed else 200,
+                            "error": "timeout" if failed else None,
+                            "timings": {} if failed else {"connect": latency / 3, "tls": latency / 3,
+                                                          "first_byte": latency / 3}})
+        selector.observe(results)
+        return selector.pick()
+
+    print("=" * 60)
+    print(f"🔀 ВЫБОР ШЛЮЗА: {len(urls)} URL, {args.picks} вызовов pick()")
+    print("=" * 60)
+
+    phases = [("норма", 0.030, 0.0), ("основной медленный", 0.300, 0.0), ("восстановление", 0.030, 0.0),
+              ("основной с ошибками", 0.030, 0.8), ("восстановление", 0.030, 0.0)]
+    for name, latency, error_rate in phases:
+        before = selector.pick()
+        picks = [probe_round(latency, error_rate) for _ in range(10)]
+        changed = next((i + 1 for i, pick in enumerate(picks) if pick != before), None)
+        host = picks[-1].split("//")[1].split("/")[0]
+        print(f"   {name:<22} выбор: {host:<26} "
+              f"{'без смены' if changed is None else f'смена после {changed} проверок'}")
+    print(f"Переключений: {selector.switches}")
+
+    started = time.perf_counter()
+    for _ in range(args.picks):
+        selector.pick()
+    print(f"pick(): {format_latency((time.perf_counter() - started) / args.picks)}")
+    started = time.perf_counter()
+    for _ in range(args.picks // 100):
+        selector.observe([])
+    print(f"Пересчет выбора: {format_latency((time.perf_counter() - started) / (args.picks // 100))}")
+
+def bench_metrics(args):
+    """Стоимость observe()/inc() на маршрут и влияние шардирования при нескольких потоках"""
+    print("=" * 60)
+    print(f"📈 МЕТРИКИ: {args.threads} потоков × {args.observations:,} наблюдений")
+    print("=" * 60)
+
+    def run(shards):
+        server.METRICS_SHARDS = shards
+        histogram = server.Histogram("bench_latency_seconds", "bench", ("route",))
+        counter = server.Counter("bench_requests_total", "bench", ("route", "code"))
+        server.METRICS.remove(histogram)
+        server.METRICS.remove(counter)
+
+        def worker():
+            for i in range(args.observations):
+                histogram.observe(0.0001 * (i % 100), "/check_payment_status")
+                counter.inc("/check_payment_status", 200)
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        total = args.threads * args.observations
+        assert counter.values()[("/check_payment_status", 200)] == total
+        return elapsed / total
+
+    shards = server.METRICS_SHARDS
+    try:
+        print(f"Одна блокировка:   {format_latency(run(1))} на observe + inc")
+        print(f"{shards} шардов:        {format_latency(run(shards))} на observe + inc")
+    finally:
+        server.METRICS_SHARDS = shards
+
+    started = time.perf_counter()
+    body = server.render_metrics()
+    print(f"Сбор /metrics: {format_latency(time.perf_counter() - started)}, {len(body.splitlines())} строк")
+
+def bench_profiler(args):
+    """Накладные расходы сэмплирующего профайлера и cProfile на /check_payment_status"""
+    client = server.app.test_client()
+    server.payment_statuses.set("bench_order", "pending")
+    url = "/check_payment_status?order_id=bench_order"
+    # Тысячи запросов к одному заказу: с лимитами почти все ответы были бы дешевыми 429
+    server.rate_limiter.limits = {}
+    # Профиль запроса снимается только с токеном администратора
+    server.ADMIN_TOKEN = server.ADMIN_TOKEN or "bench"
+    headers = {"X-Admin-Token": server.ADMIN_TOKEN}
+
+    def run(suffix=""):
+        best = float("inf")
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                client.get(url + suffix, headers=headers)
+            best = min(best, (time.perf_counter() - started) / args.requests)
+        return best
+
+    print("=" * 60)
+    print(f"🔬 ПРОФИЛИРОВАНИЕ: {args.requests} запросов × {args.rounds} кругов")
+    print("=" * 60)
+    baseline = run()
+    print(f"Без профилирования:            {format_latency(baseline)} на запрос")
+    server.sampling_profiler.start(interval=args.interval, duration=3600)
+    sampled = run()
+    server.sampling_profiler.stop()
+    print(f"Сэмплирование раз в {args.interval * 1000:.0f} мс:     {format_latency(sampled)} на запрос "
+          f"({(sampled / baseline - 1) * 100:+.1f}%, снимков: {server.sampling_profiler.samples})")
+    server.PROFILE_REQUESTS = True
+    profiled = run("&_profile=1")
+    server.PROFILE_REQUESTS = False
+    print(f"cProfile каждого запроса:      {format_latency(profiled)} на запрос "
+          f"({(profiled / baseline - 1) * 100:+.1f}%)")
+
+def process_cpu_seconds(pid):
+    """CPU-время (user + system) работающего процесса и его дочерних процессов (воркеров pre-fork)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    total = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except OSError:
+        return total
+    for child in children:
+        with contextlib.suppress(OSError):
+            total += process_cpu_seconds(int(child))
+    return total
+
+def e2e_request_factory(route, run_id):
+    """Функция (номер запроса) -> (метод, путь, форма) для маршрута платежного потока"""
+    check_signer = server.get_signer("check.php", server.SECRET_KEY)
+    result_signer = server.get_signer("result.php", server.SECRET_KEY)
+
+    def pay(index):
+        return "POST", "/pay", {"amount": "1000"}
+
+    def check(index):
+        params = {"pg_order_id": f"{run_id}_{index}", "pg_payment_id": str(500000000 + index),
+                  "pg_amount": "1000", "pg_currency": "UZS", "pg_salt": f"salt{index:012d}"}
+        params["pg_sig"] = check_signer.sign(params)
+        return "POST", "/check", params
+
+    def result(index):
+        params = dict(sample_callback_params(index), pg_order_id=f"{run_id}_{index}",
+                      pg_payment_id=str(500000000 + index))
+        params["pg_sig"] = result_signer.sign(params)
+        return "POST", "/result", params
+
+    def status(index):
+        return "GET", f"/check_payment_status?order_id={run_id}_{index % 1000}", None
+
+    return {"/pay": pay, "/check": check, "/result": result, "/check_payment_status": status}[route]
+
+def run_e2e_level(base_url, pid, route, concurrency, duration, run_id):
+    """concurrency клиентов с keep-alive шлют запросы route в течение duration секунд"""
+    make_request = e2e_request_factory(route, run_id)
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        local = []
+        local_errors = 0
+        while time.monotonic() < deadline:
+            with counter_lock:
+                index = next(counter)
+            method, path, form = make_request(index)
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, data=form, allow_redirects=False, timeout=30)
+                if response.status_code >= 400:
+                    local_errors += 1
+            except requests.RequestException:
+                local_errors += 1
+            local.append(time.perf_counter() - started)
+        latencies.extend(local)
+        errors.append(local_errors)
+        session.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    cpu_before = process_cpu_seconds(pid)
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cpu = process_cpu_seconds(pid) - cpu_before
+    latencies.sort()
+    count = len(latencies)
+    return {"route": route, "concurrency": concurrency, "requests": count, "errors": sum(errors),
+            "rps": round(count / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "cpu_ms_per_request": round(cpu / count * 1000, 3) if count else None}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def bench_e2e(args):
+    """/pay, /check, /result, /check_payment_status под растущей конкурентностью; результат в JSON"""
+    levels = [int(level) for level in args.concurrency.split(",")]
+    routes = ["/pay", "/check", "/result", "/check_payment_status"]
+    run_id = f"e2e_{time.time_ns()}"
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {(row["route"], row["concurrency"]): row for row in json.load(f)["results"]}
+
+    print("=" * 60)
+    print(f"🏁 E2E: {', '.join(routes)}; конкурентность {levels}, {args.duration} с на замер, "
+          f"хранилище {args.backend}")
+    print("=" * 60)
+    print(f"   {'маршрут':<22}{'конк.':>6}{'rps':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'CPU мс/з':>10}{'ошибки':>8}")
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="fp_e2e_bench_")
+    try:
+        env = {"FREEDOMPAY_STATUS_STORE": args.backend, "FREEDOMPAY_LOG_FILE": os.path.join(workdir, "server.log")}
+        with ServerProcess(workdir, env=env) as proc:
+            for route in routes:
+                for concurrency in levels:
+                    row = run_e2e_level(proc.base_url, proc.process.pid, route, concurrency, args.duration, run_id)
+                    results.append(row)
+                    line = (f"   {route:<22}{concurrency:>6}{row['rps']:>9,.0f}{row['p50_ms']:>9.2f}"
+                            f"{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                            f"{format_optional(row['cpu_ms_per_request'], '.3f'):>10}"
+                            f"{row['errors']:>8}")
+                    previous = baseline.get((route, concurrency))
+                    if previous:
+                        line += (f"   Δrps {relative_change(row['rps'], previous['rps'])}"
+                                 f", Δp99 {relative_change(row['p99_ms'], previous['p99_ms'])}")
+                    print(line)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"benchmark": "e2e", "timestamp": datetime.now().isoformat(timespec="seconds"),
+              "revision": git_revision(), "python": sys.version.split()[0], "cpu_count": os.cpu_count(),
+              "backend": args.backend, "duration": args.duration, "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты: {args.output}")
+
+def process_status(pid):
+    """Threads и VmRSS (МБ) процесса по /proc/<pid>/status"""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            fields[name] = value.split()
+    return int(fields["Threads"][0]), int(fields["VmRSS"][0]) / 1024
+
+async def open_waiters(base_url, order_ids, timeout):
+    """Long-poll клиенты на голом asyncio: по соединению на заказ, без потока на клиента"""
+    host, port = base_url.rsplit("/", 1)[1].split(":")
+    received = {}
+
+    async def waiter(order_id, connected):
+        reader, writer = await asyncio.open_connection(host, int(port))
+        writer.write((f"GET /wait_payment_status?order_id={order_id}&timeout={timeout} HTTP/1.1\r\n"
+                      f"Host: {host}\r\nConnection: close\r\n\r\n").encode())
+        await writer.drain()
+        connected.release()
+        body = await reader.read()
+        received[order_id] = (time.perf_counter(), body)
+        writer.close()
+
+    connected = asyncio.Semaphore(0)
+    tasks = [asyncio.create_task(waiter(order_id, connected)) for order_id in order_ids]
+    for _ in order_ids:
+        await connected.acquire()
+    return tasks, received
+
+async def measure_waiters(proc, waiters, run_id):
+    """Открывает waiters long-poll клиентов, мерит потоки/RSS сервера и задержку пробуждения по /result"""
+    order_ids = [f"{run_id}_{i}" for i in range(waiters)]
+    idle_threads, idle_rss = process_status(proc.process.pid)
+    tasks, received = await open_waiters(proc.base_url, order_ids, server.LONG_POLL_MAX_TIMEOUT)
+    await asyncio.sleep(1.0)  # сервер должен принять все соединения и дойти до ожидания
+    threads, rss = process_status(proc.process.pid)
+
+    sent_at = {}
+    make_result = e2e_request_factory("/result", run_id)
+
+    def post_results():
+        session = requests.Session()
+        for index, order_id in enumerate(order_ids):
+            _, path, form = make_result(index)
+            sent_at[order_id] = time.perf_counter()
+            session.post(proc.base_url + path, data=form, timeout=30)
+        session.close()
+
+    await asyncio.to_thread(post_results)
+    await asyncio.gather(*tasks)
+    wake = sorted(received[order_id][0] - sent_at[order_id] for order_id in order_ids
+                  if b'"success"' in received[order_id][1])
+    return {"waiters": waiters, "threads_idle": idle_threads, "threads": threads,
+            "rss_idle_mb": round(idle_rss, 1), "rss_mb": round(rss, 1), "woken": len(wake),
+            "wake_p50_ms": round(percentile(wake, 50) * 1000, 2) if wake else None,
+            "wake_p99_ms": round(percentile(wake, 99) * 1000, 2) if wake else None}
+
+def bench_asgi(args):
+    """Потоковый (werkzeug) и ASGI (uvicorn) режимы: тысячи long-poll клиентов и пропускная способность"""
+    modes = ["threaded"]
+    if importlib.util.find_spec("uvicorn") is None:
+        print("⚠️ uvicorn не установлен: ASGI режим пропущен (pip install -r requirements.txt)")
+    else:
+        modes.append("asgi")
+
+    print("=" * 60)
+    print(f"🔀 THREADED vs ASGI: long-poll клиентов {args.waiters}, "
+          f"/check_payment_status при конкурентности {args.concurrency}")
+    print("=" * 60)
+    for mode in modes:
+        workdir = tempfile.mkdtemp(prefix="fp_asgi_bench_")
+        try:
+            env = {"FREEDOMPAY_STATUS_STORE": "bounded", "FREEDOMPAY_LOG_FILE": os.path.join(workdir, "server.log")}
+            extra_args = ["--asgi"] if mode == "asgi" else []
+            with ServerProcess(workdir, extra_args, env=env) as proc:
+                run_id = f"asgi_{mode}_{time.time_ns()}"
+                waiting = asyncio.run(measure_waiters(proc, args.waiters, run_id))
+                status = run_e2e_level(proc.base_url, proc.process.pid, "/check_payment_status",
+                                       args.concurrency, args.duration, run_id)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"{mode:>9}: потоков {waiting['threads_idle']} -> {waiting['threads']}, "
+              f"RSS {waiting['rss_idle_mb']:.0f} -> {waiting['rss_mb']:.0f} МБ, "
+              f"разбужено {waiting['woken']}/{waiting['waiters']}, "
+              f"пробуждение p50 {waiting['wake_p50_ms']} мс / p99 {waiting['wake_p99_ms']} мс")
+        print(f"{'':>9}  статус: {status['rps']:,.0f} rps, p99 {status['p99_ms']:.2f} мс, "
+              f"CPU {format_optional(status['cpu_ms_per_request'], '.3f')} мс/запрос, ошибок {status['errors']}")
+
+async def call_asgi(method, path, query="", form=None):
+    """Запрос к freedom_pay_asgi.app без сервера: (код, тело, число кусков тела); form — dict или готовое тело"""
+    import freedom_pay_asgi
+    from urllib.parse import urlencode
+    body = form if isinstance(form, bytes) else urlencode(form).encode() if form is not None else b""
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(),
+             "headers": [(b"content-type", b"application/x-www-form-urlencoded")], "client": ("127.0.0.1", 0),
+             "server": ("127.0.0.1", 5000), "scheme": "http", "http_version": "1.1", "root_path": ""}
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await freedom_pay_asgi.app(scope, receive, send)
+    chunks = [message["body"] for message in messages if message["type"] == "http.response.body" and message["body"]]
+    return messages[0]["status"], b"".join(chunks), len(chunks)
+
+def bench_parity(args):
+    """Flask и ASGI отвечают одинаково: callback'и с пустыми полями, статус, потоковые страницы"""
+    run_id = time.time_ns()
+    client = server.app.test_client()
+    failures = 0
+
+    def signed(script, form):
+        return dict(form, pg_sig=server.get_signer(script, server.SECRET_KEY).sign(form))
+
+    def compare(label, flask_response, asgi_response, same_body=True):
+        nonlocal failures
+        flask_status, flask_body = flask_response.status_code, flask_response.get_data()
+        asgi_status, asgi_body, asgi_chunks = asgi_response
+        try:
+            # JSON сериализуется по-разному (ключи, ensure_ascii) - сравнивается содержимое
+            flask_body, asgi_body = json.loads(flask_body), json.loads(asgi_body)
+        except ValueError:
+            pass
+        ok = flask_status == asgi_status and (not same_body or flask_body == asgi_body)
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {label:<46} Flask {flask_status} / ASGI {asgi_status}, "
+              f"кусков тела ASGI: {asgi_chunks}")
+        return ok
+
+    print("=" * 60)
+    print("⚖️  ПАРИТЕТ Flask / ASGI")
+    print("=" * 60)
+    for index, blank in enumerate(("pg_card_pan", "pg_description", "pg_user_phone")):
+        forms = {}
+        for mode in ("flask", "asgi"):
+            order_id = f"parity_{run_id}_{index}_{mode}"
+            forms[mode] = (signed("check.php", {"pg_order_id": order_id, "pg_amount": "1000", "pg_salt": "salt",
+                                                blank: ""}),
+                           signed("result.php", {"pg_order_id": order_id, "pg_payment_id": f"{run_id}{index}{mode}",
+                                                 "pg_result": "1", "pg_amount": "1000", "pg_salt": "salt",
+                                                 blank: ""}))
+        for position, route in enumerate(("/check", "/result")):
+            compare(f"{route} с пустым {blank}", client.post(route, data=forms["flask"][position]),
+                    asyncio.run(call_asgi("POST", route, form=forms["asgi"][position])))
+        server.callback_queue.join()
+        statuses = [server.payment_statuses.get(forms[mode][1]["pg_order_id"]) for mode in ("flask", "asgi")]
+        ok = statuses == ["success", "success"]
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {'статус после /result':<46} Flask {statuses[0]} / ASGI {statuses[1]}")
+    bad = signed("result.php", {"pg_order_id": f"parity_{run_id}_bad", "pg_payment_id": "1", "pg_result": "1"})
+    bad["pg_amount"] = ""
+    compare("/result с подменой пустого поля", client.post("/result", data=bad),
+            asyncio.run(call_asgi("POST", "/result", form=bad)))
+    # Не UTF-8 в теле: werkzeug 3 отбрасывает всю форму, ASGI заменяет байты и отвергает подпись.
+    # Коды могут различаться, но ни один режим не должен отвечать 500
+    broken = f"pg_order_id=parity_{run_id}_broken&pg_result=1&pg_description=\xff\xfe&pg_sig=0".encode("latin-1")
+    flask_status = client.post("/result", data=broken, content_type="application/x-www-form-urlencoded").status_code
+    asgi_status = asyncio.run(call_asgi("POST", "/result", form=broken))[0]
+    ok = flask_status < 500 and asgi_status < 500
+    failures += not ok
+    print(f"{'✅' if ok else '❌'} {'/result с битым UTF-8 (без 500)':<46} Flask {flask_status} / ASGI {asgi_status}")
+    compare("/check_payment_status без order_id", client.get("/check_payment_status?order_id="),
+            asyncio.run(call_asgi("GET", "/check_payment_status", "order_id=")))
+    compare("/all_payment_statuses.ndjson (через Flask)", client.get("/all_payment_statuses.ndjson"),
+            asyncio.run(call_asgi("GET", "/all_payment_statuses.ndjson")))
+    compare("/all_payment_statuses (через Flask)", client.get("/all_payment_statuses"),
+            asyncio.run(call_asgi("GET", "/all_payment_statuses")), same_body=False)
+    print("✅ паритет" if not failures else f"❌ расхождений: {failures}")
+    if failures:
+        sys.exit(1)
+
+def check_shared_visibility(base_url, checks, run_id):
+    """/result и сразу /check_payment_status на новом соединении (может попасть в другой воркер)"""
+    make_result = e2e_request_factory("/result", run_id)
+    stale = 0
+    for index in range(checks):
+        method, path, form = make_result(index)
+        requests.post(base_url + path, data=form, timeout=10)
+        order_id = form["pg_order_id"]
+        deadline = time.monotonic() + 1.0
+        while True:
+            status = requests.get(f"{base_url}/check_payment_status", params={"order_id": order_id},
+                                  timeout=10).json()["status"]
+            if status == "success" or time.monotonic() > deadline:
+                break
+            stale += 1
+            time.sleep(0.005)
+    return stale
+
+def bench_scaling(args):
+    """Пропускная способность /check_payment_status и /result при 1..N воркерах pre-fork"""
+    levels = [int(level) for level in args.workers.split(",")]
+    routes = ["/check_payment_status", "/result"]
+    print("=" * 60)
+    print(f"📈 PRE-FORK: воркеров {levels}, конкурентность {args.concurrency}, {args.duration} с на замер, "
+          f"CPU {os.cpu_count()}")
+    print("=" * 60)
+    print(f"   {'маршрут':<22}{'воркеры':>8}{'rps':>9}{'p50 мс':>9}{'p99 мс':>9}{'CPU мс/з':>10}{'ошибки':>8}")
+    baseline = {}
+    for workers in levels:
+        workdir = tempfile.mkdtemp(prefix="fp_scaling_bench_")
+        try:
+            env = {"FREEDOMPAY_STATUS_STORE": "shared", "FREEDOMPAY_LOG_FILE": os.path.join(workdir, "server.log")}
+            with ServerProcess(workdir, ["--workers", str(workers)], env=env) as proc:
+                run_id = f"scaling_{workers}_{time.time_ns()}"
+                for route in routes:
+                    row = run_e2e_level(proc.base_url, proc.process.pid, route, args.concurrency,
+                                        args.duration, run_id)
+                    baseline.setdefault(route, row["rps"])
+                    print(f"   {route:<22}{workers:>8}{row['rps']:>9,.0f}{row['p50_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                          f"{format_optional(row['cpu_ms_per_request'], '.3f'):>10}{row['errors']:>8}"
+                          f"   x{row['rps'] / baseline[route]:.2f}")
+                stale = check_shared_visibility(proc.base_url, args.checks, f"{run_id}_visibility")
+                print(f"   {'видимость /result':<22}{workers:>8}   устаревших ответов {stale} на {args.checks} заказов")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def start_simulator(argv):
+    """Симулятор шлюза в потоке этого процесса; возвращает (симулятор, базовый URL, сервер)"""
+    from werkzeug.serving import make_server
+    import freedom_pay_gateway_simulator as gateway_simulator
+
+    simulator = gateway_simulator.GatewaySimulator(gateway_simulator.parse_args(argv))
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # без строки на каждый запрос сверки
+    port = free_port()
+    httpd = make_server("127.0.0.1", port, gateway_simulator.create_app(simulator), threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return simulator, f"http://127.0.0.1:{port}", httpd
+
+def bench_reconcile(args):
+    """Сверка зависших заказов через get_status2.php симулятора: конкурентность, лимит частоты, бюджет"""
+    simulator, base_url, httpd = start_simulator(["--status-latency", str(args.latency), "--error-rate",
+                                                  str(args.error_rate), "--seed", "7"])
+    rng = random.Random(7)
+    outcomes = (("paid", "success"), ("declined", "failed"), ("aborted", "failed"), ("created", "pending"),
+                (None, "pending"))
+    weights = (60, 15, 5, 10, 10)
+
+    print("=" * 60)
+    print(f"🔄 СВЕРКА: заказов {args.orders}, ответ шлюза {args.latency:g} мс, ошибок {args.error_rate:.0%}")
+    print("=" * 60)
+
+    def scenario(label, concurrency, rate, budget):
+        workdir = tempfile.mkdtemp(prefix="fp_reconcile_bench_")
+        try:
+            store = server.SQLiteStatusStore(os.path.join(workdir, "statuses.db"))
+            expected = {}
+            run_id = time.time_ns()
+            updates = []
+            for i in range(args.orders):
+                order_id = f"rec_{run_id}_{i}"
+                gateway_status, expected[order_id] = rng.choices(outcomes, weights)[0]
+                payment_id = simulator.register_payment(order_id, gateway_status) if gateway_status else None
+                updates.append((order_id, "pending", payment_id))
+            store.set_many(updates)
+            store.flush()
+            reconciler = server.Reconciler(store, url=f"{base_url}/get_status2.php", batch=args.orders,
+                                           concurrency=concurrency, rate=rate, budget=budget)
+            run = reconciler.run_once(now=time.time() + reconciler.after + 1)
+            # Неверная запись — финальный статус, не совпадающий со шлюзом (ошибки запроса оставляют "pending")
+            mismatched = sum(1 for order_id, status in expected.items()
+                             if store.get(order_id) not in ("pending", status))
+            rps = run["checked"] / run["duration"] if run["duration"] else 0
+            print(f"{label:<26} проверено {run['checked']:>5} за {run['duration']:6.2f} с ({rps:6.0f}/с), "
+                  f"обновлено {run['updated']:>5}, не найдено {run['not_found']:>4}, ошибок {run['errors']:>3}, "
+                  f"вне бюджета {run['over_budget']:>5}, неверных {mismatched}")
+            store.close()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for concurrency in (1, args.concurrency):
+        scenario(f"конкурентность {concurrency}", concurrency, 0, 600)
+    scenario(f"лимит {args.rate:g}/с, бюджет {args.budget:g} с", args.concurrency, args.rate, args.budget)
+    print(f"📊 Шлюз: {simulator.snapshot()['status_requests']} запросов get_status2.php, "
+          f"пул: {server.gateway_session.pool_stats()}")
+    httpd.shutdown()
+    simulator.dispatcher.close()
+
+def bench_lookup(args):
+    """Запросы статуса к шлюзу: каждый клиент сам vs single-flight кеш GatewayStatusLookup"""
+    simulator, base_url, httpd = start_simulator(["--status-latency", str(args.latency), "--seed", "7"])
+    run_id = time.time_ns()
+    records = []
+    for i in range(args.orders):
+        order_id = f"lookup_{run_id}_{i}"
+        payment_id = simulator.register_payment(order_id, "paid" if i % 2 else "created")
+        records.append({"order_id": order_id, "payment_id": payment_id, "status": "pending"})
+    reconciler = server.Reconciler(server.MemoryStatusStore(), url=f"{base_url}/get_status2.php")
+
+    print("=" * 60)
+    print(f"🔁 SINGLE-FLIGHT: клиентов {args.clients} x {args.requests} запросов по {args.orders} заказам, "
+          f"ответ шлюза {args.latency:g} мс")
+    print("=" * 60)
+
+    def run(label, lookup):
+        ready = threading.Barrier(args.clients + 1)
+        latencies = []
+
+        def client(index):
+            rng = random.Random(index)
+            local = []
+            ready.wait()
+            for _ in range(args.requests):
+                record = rng.choice(records)
+                started = time.perf_counter()
+                lookup(record)
+                local.append(time.perf_counter() - started)
+            latencies.extend(local)
+
+        calls_before = simulator.snapshot()["status_requests"]
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        calls = simulator.snapshot()["status_requests"] - calls_before
+        latencies.sort()
+        print(f"{label:<14} запросов в шлюз {calls:>6} на {len(latencies)} обращений, время {elapsed:6.2f} с, "
+              f"p50 {percentile(latencies, 50) * 1000:.2f} мс, p99 {percentile(latencies, 99) * 1000:.2f} мс")
+
+    run("напрямую", reconciler.query)
+    lookup = server.GatewayStatusLookup(reconciler.query)
+    run("single-flight", lookup.lookup)
+    print(f"📊 {lookup.stats()}")
+    httpd.shutdown()
+    simulator.dispatcher.close()
+
+def bench_journal(args):
+    """Журнал callback'ов: скорость записи и время восстановления (весь журнал vs снимок + хвост)"""
+    workdir = tempfile.mkdtemp(prefix="fp_journal_bench_")
+    orders = args.callbacks // 2
+    tail_from = int(orders * (1 - args.tail))
+
+    print("=" * 60)
+    print(f"📼 ЖУРНАЛ: {args.callbacks:,} callback'ов ({orders:,} заказов: check + result), "
+          f"хвост после снимка {args.tail:.0%}, fsync {'да' if args.fsync else 'нет'}")
+    print("=" * 60)
+    try:
+        journal = server.CallbackJournal(workdir, fsync=args.fsync)
+        journal.recover(server.MemoryStatusStore())
+        signer = server.get_signer("result.php", server.SECRET_KEY)
+        forms = [dict(sample_callback_params(i), pg_result="0" if i % 10 == 0 else "1") for i in range(1000)]
+        for form in forms:
+            form["pg_sig"] = signer.sign(form)
+
+        def append_orders(start, stop):
+            for i in range(start, stop):
+                form = forms[i % 1000]
+                journal.append("check", {"pg_order_id": f"order_{i}", "pg_payment_id": form["pg_payment_id"],
+                                         "pg_amount": form["pg_amount"], "pg_salt": form["pg_salt"],
+                                         "pg_sig": form["pg_sig"]})
+                journal.append("result", dict(form, pg_order_id=f"order_{i}"))
+
+        started = time.perf_counter()
+        append_orders(0, tail_from)
+        append_seconds = time.perf_counter() - started
+        journal.close()
+        size = sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir))
+        print(f"✍️  запись: {tail_from * 2 / append_seconds:,.0f} callback'ов/с "
+              f"({append_seconds / max(tail_from * 2, 1) * 1e6:.2f} µs), журнал {size / 2**20:,.0f} МБ")
+
+        store = server.MemoryStatusStore()
+        stats = journal.recover(store)
+        print(f"🔁 весь журнал:   {stats['seconds']:7.2f} с, {stats['callbacks'] / stats['seconds']:,.0f} callback'ов/с, "
+              f"заказов {len(store):,}, RSS {rss_mb():,.0f} МБ")
+
+        checkpoint = journal.checkpoint(store, None)
+        snapshot_size = os.path.getsize(journal._path("snapshot", checkpoint["segment"], "snap"))
+        print(f"📸 снимок:        {checkpoint['seconds']:7.2f} с, {checkpoint['orders']:,} заказов, "
+              f"{snapshot_size / 2**20:,.0f} МБ")
+        del store
+        append_orders(tail_from, orders)
+        journal.close()
+
+        store = server.MemoryStatusStore()
+        stats = journal.recover(store)
+        print(f"⚡ снимок + хвост: {stats['seconds']:7.2f} с ({stats['snapshot_orders']:,} заказов из снимка, "
+              f"{stats['callbacks']:,} callback'ов хвоста), заказов {len(store):,}")
+        counts = store.count_by_status()
+        print(f"✅ статусы: {counts}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+class SubscriberHandler(BaseHTTPRequestHandler):
+    """Подписчик webhook'ов: отвечает с задержкой delay и долей ошибок 503 failure_rate"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    delay = 0.0
+    failure_rate = 0.0
+    lock = threading.Lock()
+    posts = 0
+    lags = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.delay)
+        cls = type(self)
+        failed = random.random() < self.failure_rate
+        if not failed:
+            now = time.time()
+            with cls.lock:
+                cls.posts += 1
+                cls.lags.extend(now - event["created_at"] for event in json.loads(body)["events"])
+        self.send_response(503 if failed else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def bench_webhooks(args):
+    """Применение /result без подписчиков vs с outbox и медленным подписчиком; доставка пачками"""
+    SubscriberHandler.delay = args.delay / 1000
+    SubscriberHandler.failure_rate = args.failure_rate
+    httpd, base_url = start_stand_in_server(SubscriberHandler)
+    workdir = tempfile.mkdtemp(prefix="fp_webhook_bench_")
+    run_id = time.time_ns()
+    print("=" * 60)
+    print(f"📣 WEBHOOK'И: {args.orders:,} /result, подписчик отвечает за {args.delay:g} мс, "
+          f"ошибок {args.failure_rate:.0%}, пачка callback'ов {args.batch}")
+    print("=" * 60)
+
+    def apply(label):
+        batches = [[("result", {"pg_order_id": f"webhook_{run_id}_{label}_{i}", "pg_payment_id": str(i),
+                                "pg_result": "1" if i % 10 else "0"})
+                    for i in range(start, min(start + args.batch, args.orders))]
+                   for start in range(0, args.orders, args.batch)]
+        started = time.perf_counter()
+        for batch in batches:
+            server.apply_callbacks(batch)
+        elapsed = time.perf_counter() - started
+        print(f"{label:<14} применение {elapsed:6.2f} с, {elapsed / args.orders * 1e6:7.1f} µs на callback")
+        return time.perf_counter()
+
+    try:
+        apply("без outbox")
+        outbox = server.WebhookOutbox(os.path.join(workdir, "outbox.db"), [f"{base_url}/hook"],
+                                      retry_base=0.2, retry_max=2)
+        server.webhook_outbox = outbox
+        outbox.start()
+        finished = apply("с outbox")
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and outbox.backlog().get(f"{base_url}/hook", {}).get("pending"):
+            time.sleep(0.05)
+        drained = time.perf_counter() - finished
+        stats = outbox.stats()["subscribers"][f"{base_url}/hook"]
+        lags = sorted(SubscriberHandler.lags)
+        print(f"📬 доставлено {stats['delivered']:,} событий за {stats['posts']:,} POST "
+              f"(в среднем {stats['delivered'] / max(stats['posts'], 1):.0f} в пачке), повторов {stats['retries']:,}, "
+              f"осталось {stats['pending']:,}")
+        print(f"⏱  outbox опустел через {drained:.2f} с после последнего /result, задержка события "
+              f"p50 {percentile(lags, 50) * 1000:.0f} мс, p99 {percentile(lags, 99) * 1000:.0f} мс")
+        outbox.close()
+    finally:
+        server.webhook_outbox = None
+        httpd.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def bench_ratelimit(args):
+    """Обычные клиенты опрашивают статус рядом с клиентом-циклом: без лимитов vs token bucket"""
+    run_id = time.time_ns()
+
+    def scenario(label, env):
+        workdir = tempfile.mkdtemp(prefix="fp_ratelimit_bench_")
+        stop = threading.Event()
+        latencies = []
+        abuser_codes = {}
+        lock = threading.Lock()
+
+        def abuser(index):
+            session = requests.Session()
+            session.headers["X-Forwarded-For"] = "10.66.0.1"
+            codes = {}
+            while not stop.is_set():
+                response = session.get(f"{base_url}/check_payment_status",
+                                       params={"order_id": f"abuse_{run_id}_{index % 2}"})
+                codes[response.status_code] = codes.get(response.status_code, 0) + 1
+            with lock:
+                for code, count in codes.items():
+                    abuser_codes[code] = abuser_codes.get(code, 0) + count
+
+        def client(index):
+            session = requests.Session()
+            session.headers["X-Forwarded-For"] = f"10.1.{index // 250}.{index % 250}"
+            local = []
+            while not stop.is_set():
+                started = time.perf_counter()
+                response = session.get(f"{base_url}/check_payment_status",
+                                       params={"order_id": f"client_{run_id}_{index}"})
+                local.append((time.perf_counter() - started, response.status_code))
+                stop.wait(1 / args.client_rate)
+            with lock:
+                latencies.extend(local)
+
+        try:
+            with ServerProcess(workdir, env=env) as process:
+                base_url = process.base_url
+                threads = ([threading.Thread(target=abuser, args=(i,)) for i in range(args.abusers)] +
+                           [threading.Thread(target=client, args=(i,)) for i in range(args.clients)])
+                for thread in threads:
+                    thread.start()
+                time.sleep(args.duration)
+                stop.set()
+                for thread in threads:
+                    thread.join()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        ok = sorted(latency for latency, code in latencies if code == 200)
+        limited = sum(code == 429 for _, code in latencies)
+        total = sum(abuser_codes.values())
+        print(f"{label:<12} клиенты: {len(ok):>5} ответов 200 из {len(latencies)} (429 — {limited}), "
+              f"p50 {percentile(ok, 50) * 1000:6.1f} мс, p99 {percentile(ok, 99) * 1000:6.1f} мс | "
+              f"цикл: {total / args.duration:7.0f} запросов/с, 429 — {abuser_codes.get(429, 0) / max(total, 1):.0%}, "
+              f"CPU сервера {process.cpu_seconds:.1f} с")
+
+    print("=" * 60)
+    print(f"🚦 ЛИМИТЫ: {args.abusers} потоков клиента-цикла + {args.clients} клиентов по {args.client_rate:g} "
+          f"запроса/с, {args.duration:g} с")
+    print("=" * 60)
+    scenario("без лимитов", None)
+    # Как за ngrok: все соединения с 127.0.0.1, клиенты различаются по X-Forwarded-For
+    scenario("token bucket", {"FREEDOMPAY_RATE_LIMITS": "{}", "FREEDOMPAY_TRUSTED_PROXIES": "127.0.0.1"})
+    # Без доверенных прокси все клиенты — один адрес 127.0.0.1 и одна корзина на всех
+    scenario("без прокси", {"FREEDOMPAY_RATE_LIMITS": "{}", "FREEDOMPAY_TRUSTED_PROXIES": ""})
+
+def main():
+    """Главная функция"""
+    parser = argparse.ArgumentParser(description="Бенчмарки тестового сервера FreedomPay")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    store_parser = subparsers.add_parser("store", help="хранилище статусов платежей")
+    store_parser.add_argument("--backend", default="sqlite", choices=["sqlite", "memory", "bounded"])
+    store_parser.add_argument("--orders", type=int, default=1_000_000)
+    store_parser.add_argument("--reads", type=int, default=100_000)
+    store_parser.set_defaults(func=bench_store)
+
+    longpoll_parser = subparsers.add_parser("longpoll", help="опрос статуса vs long-poll")
+    longpoll_parser.add_argument("--clients", type=int, default=200)
+    longpoll_parser.add_argument("--delay", type=float, default=10.0, help="секунд до прихода /result")
+    longpoll_parser.add_argument("--poll-interval", type=float, default=0.05)
+    longpoll_parser.set_defaults(func=bench_longpoll)
+
+    signer_parser = subparsers.add_parser("signer", help="подпись и проверка pg_sig")
+    signer_parser.add_argument("--count", type=int, default=100_000)
+    signer_parser.set_defaults(func=bench_signer)
+
+    logging_parser = subparsers.add_parser("logging", help="накладные расходы логирования")
+    logging_parser.add_argument("--requests", type=int, default=20_000)
+    logging_parser.add_argument("--rounds", type=int, default=3)
+    logging_parser.add_argument("--sink", default="file", choices=["file", "devnull"])
+    logging_parser.set_defaults(func=bench_logging)
+
+    templates_parser = subparsers.add_parser("templates", help="рендер /all_payment_statuses")
+    templates_parser.add_argument("--orders", type=int, default=10_000)
+    templates_parser.add_argument("--requests", type=int, default=50)
+    templates_parser.set_defaults(func=bench_templates)
+
+    probe_parser = subparsers.add_parser("probe", help="проверка доступности шлюзов на заглушках")
+    probe_parser.add_argument("--timeout", type=float, default=5.0)
+    probe_parser.add_argument("--deadline", type=float, default=2.0)
+    probe_parser.set_defaults(func=bench_probe)
+
+    session_parser = subparsers.add_parser("session", help="исходящие запросы: пул соединений")
+    session_parser.add_argument("--requests", type=int, default=2000)
+    session_parser.add_argument("--threads", type=int, default=4)
+    session_parser.set_defaults(func=bench_session)
+
+    selector_parser = subparsers.add_parser("selector", help="выбор шлюза для /pay по EWMA")
+    selector_parser.add_argument("--picks", type=int, default=1_000_000)
+    selector_parser.set_defaults(func=bench_selector)
+
+    soak_parser = subparsers.add_parser("soak", help="RSS на длинном потоке заказов")
+    soak_parser.add_argument("--backend", default="bounded", choices=["sqlite", "memory", "bounded"])
+    soak_parser.add_argument("--orders", type=int, default=10_000_000)
+    soak_parser.add_argument("--capacity", type=int, default=server.ORDER_CACHE_CAPACITY)
+    soak_parser.add_argument("--pending-ttl", type=float, default=1.0)
+    soak_parser.set_defaults(func=bench_soak)
+
+    metrics_parser = subparsers.add_parser("metrics", help="накладные расходы метрик")
+    metrics_parser.add_argument("--threads", type=int, default=8)
+    metrics_parser.add_argument("--observations", type=int, default=200_000)
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    profiler_parser = subparsers.add_parser("profiler", help="накладные расходы профилирования")
+    profiler_parser.add_argument("--requests", type=int, default=2000)
+    profiler_parser.add_argument("--rounds", type=int, default=3)
+    profiler_parser.add_argument("--interval", type=float, default=server.SAMPLER_INTERVAL)
+    profiler_parser.set_defaults(func=bench_profiler)
+
+    e2e_parser = subparsers.add_parser("e2e", help="платежный поток под нагрузкой, результат в JSON")
+    e2e_parser.add_argument("--concurrency", default="1,4,16,64", help="уровни конкурентности через запятую")
+    e2e_parser.add_argument("--duration", type=float, default=3.0, help="секунд на маршрут и уровень")
+    e2e_parser.add_argument("--backend", default="bounded", choices=["sqlite", "memory", "bounded"])
+    e2e_parser.add_argument("--output", default="e2e_results.json")
+    e2e_parser.add_argument("--baseline", help="прошлый JSON для сравнения")
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    asgi_parser = subparsers.add_parser("asgi", help="потоковый режим vs ASGI под long-poll")
+    asgi_parser.add_argument("--waiters", type=int, default=2000)
+    asgi_parser.add_argument("--concurrency", type=int, default=16)
+    asgi_parser.add_argument("--duration", type=float, default=3.0)
+    asgi_parser.set_defaults(func=bench_asgi)
+
+    parity_parser = subparsers.add_parser("parity", help="одинаковые ответы Flask и ASGI режимов")
+    parity_parser.set_defaults(func=bench_parity)
+
+    scaling_parser = subparsers.add_parser("scaling", help="масштабирование pre-fork по числу воркеров")
+    scaling_parser.add_argument("--workers", default=f"1,{max(2, os.cpu_count() or 1)}",
+                                help="числа воркеров через запятую")
+    scaling_parser.add_argument("--concurrency", type=int, default=32)
+    scaling_parser.add_argument("--duration", type=float, default=3.0)
+    scaling_parser.add_argument("--checks", type=int, default=200, help="заказов для проверки видимости")
+    scaling_parser.set_defaults(func=bench_scaling)
+
+    reconcile_parser = subparsers.add_parser("reconcile", help="сверка зависших заказов с симулятором шлюза")
+    reconcile_parser.add_argument("--orders", type=int, default=2000)
+    reconcile_parser.add_argument("--concurrency", type=int, default=server.RECONCILE_CONCURRENCY)
+    reconcile_parser.add_argument("--rate", type=float, default=server.RECONCILE_RATE)
+    reconcile_parser.add_argument("--budget", type=float, default=5.0)
+    reconcile_parser.add_argument("--latency", type=float, default=20, help="мс на ответ get_status2.php")
+    reconcile_parser.add_argument("--error-rate", type=float, default=0.0)
+    reconcile_parser.set_defaults(func=bench_reconcile)
+
+    lookup_parser = subparsers.add_parser("lookup", help="single-flight кеш запросов статуса к шлюзу")
+    lookup_parser.add_argument("--clients", type=int, default=32)
+    lookup_parser.add_argument("--requests", type=int, default=50, help="запросов на клиента")
+    lookup_parser.add_argument("--orders", type=int, default=20)
+    lookup_parser.add_argument("--latency", type=float, default=50, help="мс на ответ get_status2.php")
+    lookup_parser.set_defaults(func=bench_lookup)
+
+    journal_parser = subparsers.add_parser("journal", help="журнал callback'ов: запись и восстановление")
+    journal_parser.add_argument("--callbacks", type=int, default=10_000_000)
+    journal_parser.add_argument("--tail", type=float, default=0.1, help="доля callback'ов после последнего снимка")
+    journal_parser.add_argument("--fsync", action="store_true", help="fsync каждой записи")
+    journal_parser.set_defaults(func=bench_journal)
+
+    webhooks_parser = subparsers.add_parser("webhooks", help="рассылка статусов подписчикам через outbox")
+    webhooks_parser.add_argument("--orders", type=int, default=20000)
+    webhooks_parser.add_argument("--batch", type=int, default=100, help="callback'ов в пачке применения")
+    webhooks_parser.add_argument("--delay", type=float, default=200, help="мс ответа подписчика")
+    webhooks_parser.add_argument("--failure-rate", type=float, default=0.1)
+    webhooks_parser.add_argument("--timeout", type=float, default=120, help="секунд ждем доставки")
+    webhooks_parser.set_defaults(func=bench_webhooks)
+
+    ratelimit_parser = subparsers.add_parser("ratelimit", help="лимиты частоты опроса статуса под клиентом-циклом")
+    ratelimit_parser.add_argument("--abusers", type=int, default=8, help="потоков клиента, опрашивающего в цикле")
+    ratelimit_parser.add_argument("--clients", type=int, default=16, help="клиентов с разными адресами")
+    ratelimit_parser.add_argument("--client-rate", type=float, default=2, help="запросов в секунду от клиента")
+    ratelimit_parser.add_argument("--duration", type=float, default=10)
+    ratelimit_parser.set_defaults(func=bench_ratelimit)
+
+    serve_parser = subparsers.add_parser("serve", help="запуск сервера для бенчмарков")
+    serve_parser.add_argument("--port", type=int, default=5000)
+    serve_parser.add_argument("--asgi", action="store_true", help="uvicorn + freedom_pay_asgi вместо werkzeug")
+    serve_parser.add_argument("--workers", type=int, help="pre-fork с этим числом воркеров (FREEDOMPAY_STATUS_STORE=shared)")
+    serve_parser.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
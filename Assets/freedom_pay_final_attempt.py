@@ -1,9 +1,38 @@
-from flask import Flask, request, redirect, render_template_string
+from flask import Flask, Response, request, redirect, render_template, stream_template, stream_with_context, has_request_context
 import uuid
 import hashlib
+import hmac
 import requests
 import json
+import os
+import time
+import atexit
+import contextlib
+import sqlite3
+import threading
+import queue
+import heapq
+import bisect
+import itertools
+import random
+import socket
+import ssl
+import sys
+import zlib
+import http.client
+import io
+import mmap
+import struct
+import cProfile
+import pstats
+import tracemalloc
+import gc
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as wait_futures
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime
+from urllib.parse import urlsplit, urljoin
+import xml.etree.ElementTree as ElementTree
 
 app = Flask(__name__)
 
@@ -20,13 +49,1263 @@ GATEWAY_URLS = [
 
 NGROK_URL = "https://2f91d0d162d4.ngrok-free.app"  # Убираем все лишние пробелы
 
-# Хранилище статусов платежей (в реальном проекте используйте базу данных)
-payment_statuses = {}
+# Хранилище статусов платежей: "bounded" (по умолчанию: кеш в памяти поверх SQLite), "sqlite", "memory"
+# или "shared" (SQLite без буфера и кеша с событиями изменений — для нескольких процессов-воркеров)
+STATUS_STORE_BACKEND = os.environ.get("FREEDOMPAY_STATUS_STORE", "bounded")
+STATUS_DB_PATH = os.environ.get("FREEDOMPAY_STATUS_DB", "payment_statuses.db")
+STATUS_FLUSH_INTERVAL = 0.05  # секунд между пакетными записями в SQLite
+STATUS_FLUSH_BATCH = 1000     # записей, после которых пакет сбрасывается сразу
+ORDER_CACHE_CAPACITY = 100_000  # заказов в памяти для бэкенда "bounded"
+PENDING_ORDER_TTL = 86400       # секунд в "pending", после которых заказ становится "expired"
+ORDER_EXPIRY_INTERVAL = 1.0     # секунд между проверками сроков
+ORDER_SWEEP_EVERY = 60          # каждая N-я проверка ищет просроченные заказы и в SQLite
+STATUS_EVENT_POLL_INTERVAL = 0.05  # секунд между проверками изменений из других процессов ("shared")
+STATUS_EVENT_RETENTION = 300       # секунд хранятся строки status_events
+STATUS_EVENT_PRUNE_EVERY = 200     # каждая N-я проверка удаляет старые события
 
-def log_message(msg):
-    """Логирование с временными метками"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {msg}")
+class StatusStore:
+    """Базовый интерфейс хранилища статусов (ведет себя как словарь order_id -> статус)"""
+
+    persistent = True  # статусы переживают перезапуск процесса
+
+    def get(self, order_id, default=None):
+        record = self.get_record(order_id)
+        return record["status"] if record else default
+
+    def __getitem__(self, order_id):
+        record = self.get_record(order_id)
+        if record is None:
+            raise KeyError(order_id)
+        return record["status"]
+
+    def __setitem__(self, order_id, status):
+        self.set(order_id, status)
+
+    def __contains__(self, order_id):
+        return self.get_record(order_id) is not None
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def iter_records(self, status=None, after=0, batch_size=500):
+        """Обход всех записей страницами по курсору — память не растет с числом заказов"""
+        while True:
+            records = self.page(after=after, limit=batch_size, status=status)
+            yield from records
+            if len(records) < batch_size:
+                return
+            after = records[-1]["cursor"]
+
+    def count_by_status(self):
+        """Число заказов по статусам: {статус: количество}"""
+        counts = {}
+        for _, status in self.items():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def pending_older_than(self, before, limit):
+        """До limit заказов в "pending", не менявшихся с before, начиная с самых старых"""
+        records = [record for record in self.iter_records(status="pending") if record["updated_at"] < before]
+        records.sort(key=lambda record: record["updated_at"])
+        return records[:limit]
+
+    def expire_stale(self, now=None, sweep=True):
+        """Переводит в "expired" заказы, ожидающие дольше PENDING_ORDER_TTL; возвращает их order_id"""
+        if not sweep:
+            return []
+        return self.expire_pending((now or time.time()) - PENDING_ORDER_TTL)
+
+    def flush(self):
+        pass
+
+    def after_fork(self):
+        """Вызывается в дочернем процессе после fork() (режим pre-fork)"""
+        pass
+
+    def close(self):
+        self.flush()
+
+def _make_record(order_id, status, payment_id=None, now=None):
+    now = now or time.time()
+    return {
+        "order_id": order_id,
+        "status": status,
+        "payment_id": payment_id,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+class MemoryStatusStore(StatusStore):
+    """Хранилище статусов в памяти процесса (для отладки и бенчмарков)"""
+
+    persistent = False
+
+    def __init__(self):
+        self._records = {}
+        self._by_payment_id = {}
+        self._lock = threading.Lock()
+        self._last_cursor = 0
+        # Индекс для page(): курсоры по возрастанию и order_id с тем же номером (только дописываются)
+        self._cursors = []
+        self._cursor_orders = []
+        self.version = 0  # растет при каждом изменении, ключ для кеша страниц
+
+    def _next_cursor(self, order_id):
+        """Под self._lock: новый курсор записи order_id"""
+        self._last_cursor += 1
+        self._cursors.append(self._last_cursor)
+        self._cursor_orders.append(order_id)
+        return self._last_cursor
+
+    def _new_record(self, order_id, status, payment_id=None, now=None):
+        record = _make_record(order_id, status, payment_id, now)
+        record["cursor"] = self._next_cursor(order_id)
+        return record
+
+    def get_record(self, order_id):
+        return self._records.get(order_id)
+
+    def find_by_payment_id(self, payment_id):
+        order_id = self._by_payment_id.get(payment_id)
+        return self._records.get(order_id) if order_id is not None else None
+
+    def set(self, order_id, status, payment_id=None):
+        self.set_many([(order_id, status, payment_id)])
+
+    def set_many(self, updates):
+        now = time.time()
+        with self._lock:
+            for order_id, status, payment_id in updates:
+                record = self._records.get(order_id)
+                if record is None:
+                    record = self._new_record(order_id, status, payment_id, now)
+                else:
+                    record = dict(record, status=status, updated_at=now)
+                    if payment_id:
+                        record["payment_id"] = payment_id
+                self._records[order_id] = record
+                if record["payment_id"]:
+                    self._by_payment_id[record["payment_id"]] = order_id
+            self.version += 1
+
+    def insert_if_absent(self, order_id, status):
+        with self._lock:
+            if order_id in self._records:
+                return False
+            self._records[order_id] = self._new_record(order_id, status)
+            self.version += 1
+            return True
+
+    def dump_records(self):
+        """Все записи разом (для снимка журнала callback'ов)"""
+        with self._lock:
+            return list(self._records.values())
+
+    def load_records(self, rows):
+        """Загрузка снимка: строки [order_id, status, payment_id, created_at, updated_at]"""
+        with self._lock:
+            for order_id, status, payment_id, created_at, updated_at in rows:
+                self._records[order_id] = {"order_id": order_id, "status": status, "payment_id": payment_id,
+                                           "created_at": created_at, "updated_at": updated_at,
+                                           "cursor": self._next_cursor(order_id)}
+                if payment_id:
+                    self._by_payment_id[payment_id] = order_id
+            self.version += 1
+
+    def expire_pending(self, before):
+        """Все "pending", не менявшиеся с before, становятся "expired" (полный проход — только для отладки)"""
+        now = time.time()
+        expired = []
+        with self._lock:
+            for order_id, record in self._records.items():
+                if record["status"] == "pending" and record["updated_at"] < before:
+                    self._records[order_id] = dict(record, status="expired", updated_at=now)
+                    expired.append(order_id)
+            if expired:
+                self.version += 1
+        return expired
+
+    def page(self, after=0, limit=100, status=None):
+        """До limit записей с курсором больше after (в порядке создания)"""
+        records = []
+        with self._lock:
+            # Поиск позиции — O(log N), дальше читается только сама страница
+            for index in range(bisect.bisect_right(self._cursors, after), len(self._cursors)):
+                record = self._records[self._cursor_orders[index]]
+                if record["cursor"] != self._cursors[index]:
+                    continue  # запись получила новый курсор (повторная загрузка снимка)
+                if status is None or record["status"] == status:
+                    records.append(record)
+                    if len(records) >= limit:
+                        break
+        return records
+
+    def items(self):
+        for order_id, record in list(self._records.items()):
+            yield order_id, record["status"]
+
+    def __len__(self):
+        return len(self._records)
+
+class SQLiteStatusStore(StatusStore):
+    """
+    Хранилище статусов в SQLite (WAL).
+    Записи копятся в буфере и сбрасываются фоновым потоком одной транзакцией,
+    чтения сначала смотрят в буфер, затем в индекс по order_id / pg_payment_id.
+    """
+
+    def __init__(self, path, flush_interval=STATUS_FLUSH_INTERVAL, flush_batch=STATUS_FLUSH_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}    # еще не записанные изменения
+        self._flushing = {}   # изменения, которые записываются прямо сейчас
+        self._writer = None
+        self._closed = False
+        self._schema_ready = False
+        self.version = 0  # растет при каждом изменении в этом процессе
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS payments (
+                        order_id TEXT PRIMARY KEY,
+                        status TEXT NOT NULL,
+                        pg_payment_id TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS payments_pg_payment_id ON payments(pg_payment_id);
+                    CREATE INDEX IF NOT EXISTS payments_status ON payments(status);
+                """)
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _ensure_writer(self):
+        if self._writer is None or not self._writer.is_alive():
+            with self._lock:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(target=self._writer_loop, name="status-store-writer", daemon=True)
+                    self._writer.start()
+
+    def _writer_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log_message(f"❌ Ошибка записи статусов в SQLite: {e}", level="ERROR")
+
+    @staticmethod
+    def _row_to_record(order_id, row):
+        if row is None:
+            return None
+        return {
+            "order_id": order_id,
+            "status": row[0],
+            "payment_id": row[1],
+            "created_at": row[2],
+            "updated_at": row[3],
+        }
+
+    def get_record(self, order_id):
+        record = self._pending.get(order_id) or self._flushing.get(order_id)
+        if record is not None:
+            return record
+        row = self._connection().execute(
+            "SELECT status, pg_payment_id, created_at, updated_at FROM payments WHERE order_id = ?",
+            (order_id,)).fetchone()
+        return self._row_to_record(order_id, row)
+
+    def find_by_payment_id(self, payment_id):
+        for buffer in (self._pending, self._flushing):
+            for record in list(buffer.values()):
+                if record["payment_id"] == payment_id:
+                    return record
+        row = self._connection().execute(
+            "SELECT order_id, status, pg_payment_id, created_at, updated_at FROM payments WHERE pg_payment_id = ? LIMIT 1",
+            (payment_id,)).fetchone()
+        return self._row_to_record(row[0], row[1:]) if row else None
+
+    def set(self, order_id, status, payment_id=None):
+        self.set_many([(order_id, status, payment_id)])
+
+    def set_many(self, updates):
+        now = time.time()
+        with self._lock:
+            for order_id, status, payment_id in updates:
+                record = self._pending.get(order_id)
+                if record is None:
+                    record = _make_record(order_id, status, payment_id, now)
+                else:
+                    record = dict(record, status=status, updated_at=now, if_absent=False)
+                    if payment_id:
+                        record["payment_id"] = payment_id
+                self._pending[order_id] = record
+            self.version += 1
+            size = len(self._pending)
+        self._ensure_writer()
+        if size >= self.flush_batch:
+            self._wakeup.set()
+
+    def insert_if_absent(self, order_id, status):
+        if self.get_record(order_id) is not None:
+            return False
+        with self._lock:
+            if order_id in self._pending:
+                return False
+            record = _make_record(order_id, status)
+            record["if_absent"] = True
+            self._pending[order_id] = record
+            self.version += 1
+        self._ensure_writer()
+        return True
+
+    def flush(self):
+        """Записывает накопленный буфер одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+            batch = self._flushing
+            upserts = []
+            inserts = []
+            for record in batch.values():
+                row = (record["order_id"], record["status"], record["payment_id"],
+                       record["created_at"], record["updated_at"])
+                (inserts if record.get("if_absent") else upserts).append(row)
+            conn = self._connection()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                if upserts:
+                    conn.executemany("""
+                        INSERT INTO payments (order_id, status, pg_payment_id, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(order_id) DO UPDATE SET
+                            status = excluded.status,
+                            pg_payment_id = COALESCE(excluded.pg_payment_id, payments.pg_payment_id),
+                            updated_at = excluded.updated_at
+                    """, upserts)
+                if inserts:
+                    conn.executemany("""
+                        INSERT INTO payments (order_id, status, pg_payment_id, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(order_id) DO NOTHING
+                    """, inserts)
+                self._log_changes(conn, [(row[0], row[1]) for row in upserts])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                # Возвращаем записи в буфер, не затирая более свежие изменения
+                with self._lock:
+                    for order_id, record in batch.items():
+                        self._pending.setdefault(order_id, record)
+                raise
+            finally:
+                self._flushing = {}
+            return len(batch)
+
+    def expire_pending(self, before):
+        """Все "pending", не менявшиеся с before, становятся "expired" одним UPDATE по индексу payments_status"""
+        # Сначала сбрасываем буфер, чтобы не просрочить заказ, уже оплаченный в памяти
+        self.flush()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "UPDATE payments SET status = 'expired', updated_at = ? "
+                "WHERE status = 'pending' AND updated_at < ? RETURNING order_id",
+                (time.time(), before)).fetchall()
+            self._log_changes(conn, [(row[0], "expired") for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if rows:
+            with self._lock:
+                self.version += 1
+        return [row[0] for row in rows]
+
+    def page(self, after=0, limit=100, status=None):
+        """До limit записей с rowid больше after; фильтр по статусу идет по индексу payments_status"""
+        self.flush()
+        query = "SELECT rowid, order_id, status, pg_payment_id, created_at, updated_at FROM payments WHERE rowid > ?"
+        params = [after]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY rowid LIMIT ?"
+        params.append(limit)
+        records = []
+        for row in self._connection().execute(query, params):
+            record = self._row_to_record(row[1], row[2:])
+            record["cursor"] = row[0]
+            records.append(record)
+        return records
+
+    def pending_older_than(self, before, limit):
+        self.flush()
+        rows = self._connection().execute(
+            "SELECT order_id, status, pg_payment_id, created_at, updated_at FROM payments "
+            "WHERE status = 'pending' AND updated_at < ? ORDER BY updated_at LIMIT ?", (before, limit))
+        return [self._row_to_record(row[0], row[1:]) for row in rows]
+
+    def items(self):
+        self.flush()
+        cursor = self._connection().execute("SELECT order_id, status FROM payments ORDER BY rowid")
+        for order_id, status in cursor:
+            yield order_id, status
+
+    def __len__(self):
+        self.flush()
+        return self._connection().execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+
+    def count_by_status(self):
+        """Подсчет по индексу payments_status без чтения самих строк"""
+        self.flush()
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM payments GROUP BY status"))
+
+    def _log_changes(self, conn, changes):
+        """Вызывается внутри транзакции записи со списком (order_id, status)"""
+        pass
+
+    def after_fork(self):
+        # Соединения SQLite и поток записи родителя в дочернем процессе использовать нельзя
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        self._flushing = {}
+        self._writer = None
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+class SharedStatusStore(SQLiteStatusStore):
+    """
+    SQLite-хранилище для нескольких процессов-воркеров на одном хосте.
+    Изменения пишутся сразу, без буфера: /check_payment_status в соседнем воркере должен
+    видеть только что принятый /result. Каждое изменение той же транзакцией попадает
+    в status_events, по которой StatusEventPoller будит клиентов в остальных процессах.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._events_ready = False
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = super()._connection()
+            if not self._events_ready:
+                # AUTOINCREMENT: id не переиспользуются после удаления старых событий
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS status_events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        order_id TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        created_at REAL NOT NULL
+                    )
+                """)
+                self._events_ready = True
+        return conn
+
+    def _ensure_writer(self):
+        # Записи синхронные, фоновый поток записи не нужен
+        pass
+
+    def set_many(self, updates):
+        super().set_many(updates)
+        self.flush()
+
+    def insert_if_absent(self, order_id, status):
+        inserted = super().insert_if_absent(order_id, status)
+        if inserted:
+            self.flush()
+        return inserted
+
+    def _log_changes(self, conn, changes):
+        if changes:
+            now = time.time()
+            conn.executemany("INSERT INTO status_events (order_id, status, created_at) VALUES (?, ?, ?)",
+                             [(order_id, status, now) for order_id, status in changes])
+
+    def last_event_id(self):
+        return self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM status_events").fetchone()[0]
+
+    def events_after(self, after, limit=1000):
+        """До limit событий (id, order_id, status) с id больше after"""
+        return self._connection().execute(
+            "SELECT id, order_id, status FROM status_events WHERE id > ? ORDER BY id LIMIT ?",
+            (after, limit)).fetchall()
+
+    def prune_events(self, before):
+        """Удаляет события старше before; возвращает их число"""
+        return self._connection().execute("DELETE FROM status_events WHERE created_at < ?", (before,)).rowcount
+
+    def touch(self):
+        """Отмечает изменение из другого процесса (version — ключ кеша страниц)"""
+        with self._lock:
+            self.version += 1
+
+class BoundedStatusStore(StatusStore):
+    """
+    Ограниченный по памяти кеш заказов поверх долговременного хранилища (SQLite).
+    Все изменения пишутся в durable, в памяти держатся только последние capacity
+    заказов (LRU). Зависшие в "pending" заказы переводятся в "expired" по куче сроков,
+    вытесненные из кеша — периодическим запросом к durable.
+    """
+
+    def __init__(self, durable, capacity=ORDER_CACHE_CAPACITY, pending_ttl=PENDING_ORDER_TTL):
+        self.durable = durable
+        self.capacity = capacity
+        self.pending_ttl = pending_ttl
+        self._hot = OrderedDict()  # order_id -> запись, от давно использованных к недавним
+        self._deadlines = []       # куча (срок, order_id) для pending-заказов из кеша
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    @property
+    def version(self):
+        return self.durable.version
+
+    def _remember(self, record):
+        """Кладет запись в кеш (под self._lock) и вытесняет самые старые сверх capacity"""
+        order_id = record["order_id"]
+        self._hot[order_id] = record
+        self._hot.move_to_end(order_id)
+        if record["status"] == "pending":
+            heapq.heappush(self._deadlines, (record["updated_at"] + self.pending_ttl, order_id))
+        while len(self._hot) > self.capacity:
+            self._hot.popitem(last=False)
+            self.evicted += 1
+        # Записи кучи для вытесненных и уже оплаченных заказов не нужны — сжимаем кучу
+        if len(self._deadlines) > 2 * self.capacity:
+            self._deadlines = [(record["updated_at"] + self.pending_ttl, order_id)
+                               for order_id, record in self._hot.items() if record["status"] == "pending"]
+            heapq.heapify(self._deadlines)
+
+    def get_record(self, order_id):
+        with self._lock:
+            record = self._hot.get(order_id)
+            if record is not None:
+                self._hot.move_to_end(order_id)
+                self.hits += 1
+                return record
+            self.misses += 1
+        version = self.durable.version
+        record = self.durable.get_record(order_id)
+        if record is not None:
+            with self._lock:
+                # Пока читали durable, заказ мог измениться — устаревшую запись в кеш не кладем
+                if self.durable.version == version and order_id not in self._hot:
+                    self._remember(record)
+        return record
+
+    def find_by_payment_id(self, payment_id):
+        return self.durable.find_by_payment_id(payment_id)
+
+    def set(self, order_id, status, payment_id=None):
+        self.set_many([(order_id, status, payment_id)])
+
+    def set_many(self, updates):
+        now = time.time()
+        with self._lock:
+            self.durable.set_many(updates)
+            for order_id, status, payment_id in updates:
+                record = self._hot.get(order_id)
+                if record is None:
+                    # Заказа нет в кеше: время создания знает только durable, читать его ради этого не стоит
+                    continue
+                record = dict(record, status=status, updated_at=now)
+                if payment_id:
+                    record["payment_id"] = payment_id
+                self._remember(record)
+
+    def insert_if_absent(self, order_id, status):
+        with self._lock:
+            if order_id in self._hot:
+                return False
+        if not self.durable.insert_if_absent(order_id, status):
+            return False
+        with self._lock:
+            self._remember(_make_record(order_id, status))
+        return True
+
+    def expire_stale(self, now=None, sweep=True):
+        """
+        Переводит в "expired" заказы, ожидающие дольше pending_ttl.
+        Кеш проверяется по куче сроков; sweep=True дополнительно ищет вытесненные заказы в durable.
+        Возвращает список order_id, ставших "expired".
+        """
+        now = now or time.time()
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, order_id = heapq.heappop(self._deadlines)
+                record = self._hot.get(order_id)
+                # Запись могла смениться или попасть в кучу дважды — проверяем по кешу
+                if (record is not None and record["status"] == "pending"
+                        and record["updated_at"] + self.pending_ttl <= now):
+                    self._hot[order_id] = dict(record, status="expired", updated_at=now)
+                    expired.append(order_id)
+            if expired:
+                self.durable.set_many([(order_id, "expired", None) for order_id in expired])
+        if sweep:
+            swept = self.durable.expire_pending(now - self.pending_ttl)
+            with self._lock:
+                for order_id in swept:
+                    record = self._hot.get(order_id)
+                    if record is not None and record["status"] == "pending":
+                        self._hot[order_id] = dict(record, status="expired", updated_at=now)
+            expired.extend(swept)
+        self.expired += len(expired)
+        return expired
+
+    def page(self, after=0, limit=100, status=None):
+        return self.durable.page(after=after, limit=limit, status=status)
+
+    def items(self):
+        return self.durable.items()
+
+    def count_by_status(self):
+        return self.durable.count_by_status()
+
+    def __len__(self):
+        return len(self.durable)
+
+    def pending_older_than(self, before, limit):
+        # Статусы пишутся в durable сразу, кеш для этого запроса не нужен
+        return self.durable.pending_older_than(before, limit)
+
+    def flush(self):
+        return self.durable.flush()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self.durable.after_fork()
+
+    def close(self):
+        self.durable.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"cached": len(self._hot), "capacity": self.capacity, "deadlines": len(self._deadlines),
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "evicted": self.evicted, "expired": self.expired}
+
+def create_status_store(backend=STATUS_STORE_BACKEND, path=STATUS_DB_PATH):
+    """Создает хранилище статусов по имени бэкенда"""
+    if backend == "memory":
+        return MemoryStatusStore()
+    if backend == "sqlite":
+        return SQLiteStatusStore(path)
+    if backend == "bounded":
+        return BoundedStatusStore(SQLiteStatusStore(path))
+    if backend == "shared":
+        return SharedStatusStore(path)
+    raise ValueError(f"Неизвестный бэкенд хранилища статусов: {backend}")
+
+payment_statuses = create_status_store()
+atexit.register(payment_statuses.close)
+
+# Финальные статусы: после них ожидающим клиентам больше нечего ждать
+FINAL_STATUSES = ("success", "failed", "expired")
+LONG_POLL_MAX_TIMEOUT = 30   # секунд, дольше держать запрос не даем (прокси рвут соединение)
+SSE_HEARTBEAT_INTERVAL = 15  # секунд между keep-alive комментариями в SSE
+SSE_MAX_DURATION = 300       # секунд, после которых SSE-поток закрывается и клиент переподключается
+
+class StatusWaiters:
+    """Реестр клиентов, ожидающих изменения статуса конкретного заказа"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}  # order_id -> set(callback)
+
+    def subscribe(self, order_id, callback):
+        with self._lock:
+            self._waiters.setdefault(order_id, set()).add(callback)
+
+    def unsubscribe(self, order_id, callback):
+        with self._lock:
+            callbacks = self._waiters.get(order_id)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._waiters[order_id]
+
+    def notify(self, order_id, status):
+        """Будит всех, кто ждет order_id"""
+        with self._lock:
+            callbacks = self._waiters.pop(order_id, None)
+        for callback in callbacks or ():
+            callback(status)
+
+    def wait_for_change(self, order_id, known_status, timeout):
+        """Блокируется, пока статус заказа отличается от known_status, или до таймаута"""
+        changed = threading.Event()
+        result = {}
+
+        def on_change(status):
+            result["status"] = status
+            changed.set()
+
+        self.subscribe(order_id, on_change)
+        try:
+            # Подписываемся до чтения, чтобы не пропустить изменение между ними
+            status = payment_statuses.get(order_id, "pending")
+            if status != known_status:
+                return status
+            changed.wait(timeout)
+            return result.get("status", status)
+        finally:
+            self.unsubscribe(order_id, on_change)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._waiters.values())
+
+status_waiters = StatusWaiters()
+
+def set_payment_status(order_id, status, payment_id=None):
+    """Единая точка изменения статуса: запись в хранилище и пробуждение ожидающих клиентов"""
+    set_payment_statuses([(order_id, status, payment_id)])
+
+def set_payment_statuses(updates):
+    """Пакетная версия set_payment_status: список (order_id, status, payment_id)"""
+    write_statuses(payment_statuses, updates)
+
+def write_statuses(store, updates):
+    """
+    Запись статусов в store с публикацией переходов. События outbox пишутся до статусов:
+    при сбое outbox исключение прерывает запись, и повтор пачки снова увидит переход
+    (доставка и так at-least-once, дубль события допустим). Клиенты будятся после записи.
+    """
+    if not updates:
+        return
+    changed = status_transitions(store, updates)
+    if webhook_outbox is not None:
+        webhook_outbox.publish(changed)
+    store.set_many(updates)
+    for order_id, status, _ in changed:
+        status_waiters.notify(order_id, status)
+
+def status_transitions(store, updates):
+    """Обновления из updates, которые меняют статус (с учетом более ранних обновлений той же пачки)"""
+    previous = {}
+    changed = []
+    for update in updates:
+        order_id, status = update[0], update[1]
+        before = previous[order_id] if order_id in previous else store.get(order_id)
+        if before != status:
+            changed.append(update)
+        previous[order_id] = status
+    return changed
+
+# Счетчики компонентов сервера для /stats: имя -> функция, возвращающая dict
+STATS_PROVIDERS = {}
+
+def register_stats(name, provider):
+    """Регистрирует источник статистики для /stats"""
+    STATS_PROVIDERS[name] = provider
+
+register_stats("status_waiters", lambda: {"waiting_clients": len(status_waiters)})
+if hasattr(payment_statuses, "stats"):
+    register_stats("order_cache", payment_statuses.stats)
+
+class OrderExpiry:
+    """Фоновый перевод зависших "pending" заказов в "expired" с пробуждением ожидающих клиентов"""
+
+    def __init__(self, store, interval=ORDER_EXPIRY_INTERVAL, sweep_every=ORDER_SWEEP_EVERY):
+        self.store = store
+        self.interval = interval
+        self.sweep_every = sweep_every
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.expired = 0
+
+    def run_once(self, now=None, sweep=True):
+        expired = self.store.expire_stale(now, sweep=sweep)
+        for order_id in expired:
+            status_waiters.notify(order_id, "expired")
+        if expired:
+            log_message("⌛ Заказы просрочены", count=len(expired))
+        self.runs += 1
+        self.expired += len(expired)
+        return expired
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="order-expiry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once(sweep=self.runs % self.sweep_every == 0)
+            except Exception as e:
+                log_message("⚠️ Ошибка просрочки заказов", level="WARNING", error=str(e))
+
+    def after_fork(self):
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stats(self):
+        return {"runs": self.runs, "expired": self.expired, "running": self._thread is not None}
+
+order_expiry = OrderExpiry(payment_statuses)
+register_stats("order_expiry", order_expiry.stats)
+atexit.register(order_expiry.stop)
+
+class StatusEventPoller:
+    """
+    Пробуждение клиентов по изменениям из других процессов (бэкенд "shared"):
+    раз в interval читает новые строки status_events и будит ожидающих в этом процессе.
+    Пока здесь никто не ждет, запоминается только последний id.
+    """
+
+    def __init__(self, store, interval=STATUS_EVENT_POLL_INTERVAL, retention=STATUS_EVENT_RETENTION,
+                 prune_every=STATUS_EVENT_PRUNE_EVERY):
+        self.store = store
+        self.interval = interval
+        self.retention = retention
+        self.prune_every = prune_every
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_id = None
+        self.runs = 0
+        self.events = 0
+        self.pruned = 0
+
+    def run_once(self):
+        """Одна проверка; возвращает число прочитанных событий"""
+        self.runs += 1
+        if self.runs % self.prune_every == 0:
+            self.pruned += self.store.prune_events(time.time() - self.retention)
+        if self.last_id is None or not len(status_waiters):
+            last_id = self.store.last_event_id()
+            if self.last_id is not None and last_id != self.last_id:
+                self.store.touch()
+            self.last_id = last_id
+            return 0
+        count = 0
+        while True:
+            events = self.store.events_after(self.last_id)
+            for _, order_id, status in events:
+                status_waiters.notify(order_id, status)
+            count += len(events)
+            if events:
+                self.last_id = events[-1][0]
+            if len(events) < 1000:
+                break
+        if count:
+            self.store.touch()
+            self.events += count
+        return count
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            # id последнего события берем сразу: все, что было до запуска, уже лежит в хранилище
+            self.last_id = self.store.last_event_id()
+            self._thread = threading.Thread(target=self._run, name="status-events", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                log_message("⚠️ Ошибка чтения событий статусов", level="WARNING", error=str(e))
+
+    def after_fork(self):
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stats(self):
+        return {"runs": self.runs, "events": self.events, "pruned": self.pruned, "last_id": self.last_id,
+                "running": self._thread is not None}
+
+status_event_poller = None
+if hasattr(payment_statuses, "events_after"):
+    status_event_poller = StatusEventPoller(payment_statuses)
+    register_stats("status_events", status_event_poller.stats)
+    atexit.register(status_event_poller.stop)
+
+# Метрики для /metrics в текстовом формате Prometheus.
+# Значения разложены по шардам со своими блокировками: поток пишет в свой шард,
+# поэтому под нагрузкой потоки почти не ждут друг друга; /metrics суммирует шарды.
+METRICS_SHARDS = 16
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+_metrics_local = threading.local()
+_metrics_shard_counter = itertools.count()
+
+def _metrics_shard():
+    """Номер шарда текущего потока (назначается по кругу при первом обращении)"""
+    try:
+        return _metrics_local.shard
+    except AttributeError:
+        _metrics_local.shard = next(_metrics_shard_counter) % METRICS_SHARDS
+        return _metrics_local.shard
+
+def _format_labels(names, values, extra=""):
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """Монотонный счетчик с метками"""
+    
+    kind = "counter"
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._shards = [({}, threading.Lock()) for _ in range(METRICS_SHARDS)]
+        METRICS.append(self)
+    
+    def inc(self, *labels, amount=1):
+        values, lock = self._shards[_metrics_shard()]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+    
+    def values(self):
+        totals = {}
+        for values, lock in self._shards:
+            with lock:
+                for labels, value in values.items():
+                    totals[labels] = totals.get(labels, 0) + value
+        return totals
+    
+    def collect(self):
+        for labels, value in sorted(self.values().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (секунды) и метками"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._shards = [({}, threading.Lock()) for _ in range(METRICS_SHARDS)]
+        METRICS.append(self)
+    
+    def observe(self, value, *labels):
+        # Строка: счетчики корзин (последняя — +Inf), сумма, количество
+        index = bisect.bisect_left(self.buckets, value)
+        rows, lock = self._shards[_metrics_shard()]
+        with lock:
+            row = rows.get(labels)
+            if row is None:
+                row = rows[labels] = [0] * (len(self.buckets) + 3)
+            row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+    
+    def collect(self):
+        totals = {}
+        for rows, lock in self._shards:
+            with lock:
+                for labels, row in rows.items():
+                    total = totals.setdefault(labels, [0] * len(row))
+                    for i, value in enumerate(row):
+                        total[i] += value
+        for labels, row in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {row[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {row[-1]}"
+
+class GaugeFunc:
+    """Значения считаются при сборе: функция возвращает {кортеж меток: значение}"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name, help_text, labelnames, func):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        METRICS.append(self)
+    
+    def collect(self):
+        for labels, value in sorted(self.func().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+REQUEST_LATENCY = Histogram("freedompay_http_request_duration_seconds",
+                            "Время обработки запроса по маршрутам", ("route",))
+REQUESTS_TOTAL = Counter("freedompay_http_requests_total", "Запросы по маршрутам и кодам ответа",
+                         ("route", "code"))
+SIGNATURE_CHECKS = Counter("freedompay_signature_checks_total",
+                           "Проверки pg_sig в callback'ах: pass, fail, missing", ("callback", "result"))
+GATEWAY_LATENCY = Histogram("freedompay_gateway_request_duration_seconds",
+                            "Исходящие запросы к шлюзу (сессия и проверки доступности)", ("host", "kind"))
+GATEWAY_ERRORS = Counter("freedompay_gateway_errors_total", "Ошибки исходящих запросов к шлюзу",
+                         ("host", "kind"))
+RATE_LIMITED = Counter("freedompay_rate_limited_total", "Ответы 429 по маршрутам и виду ключа: client, order",
+                       ("route", "key"))
+WEBHOOK_DELIVERIES = Counter("freedompay_webhook_events_total",
+                             "События подписчикам: delivered, retry, dead", ("subscriber", "result"))
+WEBHOOK_LATENCY = Histogram("freedompay_webhook_request_duration_seconds",
+                            "POST пачки событий подписчику", ("subscriber",))
+
+# Логирование: JSON-строки пишет фоновый поток, обработчик запроса только кладет запись в очередь
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_LEVEL = os.environ.get("FREEDOMPAY_LOG_LEVEL", "INFO")
+LOG_FILE = os.environ.get("FREEDOMPAY_LOG_FILE")  # по умолчанию stdout
+LOG_QUEUE_SIZE = 10000
+LOG_FLUSH_INTERVAL = 0.05  # секунд копим строки перед записью, чтобы реже будить поток записи
+# Уровни и доля записываемых сообщений для частых маршрутов (WARNING и выше пишутся всегда)
+ROUTE_LOG_LEVELS = {
+    "/check_payment_status": "INFO",
+    "/wait_payment_status": "INFO",
+    "/payment_status_stream": "INFO",
+}
+ROUTE_LOG_SAMPLING = {
+    "/check_payment_status": 0.01,
+}
+
+class StructuredLogger:
+    """Неблокирующий логгер: очередь + фоновый поток, пишущий JSON lines"""
+
+    def __init__(self, stream=None, level=LOG_LEVEL, route_levels=None, route_sampling=None,
+                 maxsize=LOG_QUEUE_SIZE):
+        self.stream = stream
+        self.level = LOG_LEVELS[level]
+        self.route_levels = {route: LOG_LEVELS[name] for route, name in (route_levels or {}).items()}
+        self.route_sampling = dict(route_sampling or {})
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.filtered = 0
+        self.dropped = 0
+
+    def log(self, level, msg, route=None, fields=None):
+        levelno = LOG_LEVELS[level]
+        if levelno < self.route_levels.get(route, self.level):
+            self.filtered += 1
+            return
+        if levelno < LOG_LEVELS["WARNING"]:
+            rate = self.route_sampling.get(route)
+            if rate is not None and random.random() >= rate:
+                self.filtered += 1
+                return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), level, msg, route, fields))
+        except queue.Full:
+            # Лучше потерять строку лога, чем задержать ответ FreedomPay
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _format(self, timestamp, level, msg, route, fields):
+        entry = {
+            "ts": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds"),
+            "level": level,
+            "msg": msg,
+        }
+        if route:
+            entry["route"] = route
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _writer(self):
+        while True:
+            lines = [self._format(*self._queue.get())]
+            time.sleep(LOG_FLUSH_INTERVAL)
+            while True:
+                try:
+                    lines.append(self._format(*self._queue.get_nowait()))
+                except queue.Empty:
+                    break
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+            self.written += len(lines)
+            for _ in lines:
+                self._queue.task_done()
+
+    def flush(self):
+        """Ждет, пока фоновый поток запишет все принятые строки"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def after_fork(self):
+        # Поток записи остался в родителе; строки, не записанные им, дочернему процессу не нужны
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "filtered": self.filtered,
+            "dropped": self.dropped,
+        }
+
+logger = StructuredLogger(
+    stream=open(LOG_FILE, "a", encoding="utf-8") if LOG_FILE else None,
+    route_levels=ROUTE_LOG_LEVELS,
+    route_sampling=ROUTE_LOG_SAMPLING,
+)
+atexit.register(logger.flush)
+register_stats("logger", logger.stats)
+
+def log_message(msg, level="INFO", route=None, **fields):
+    """Логирование: уровень, маршрут (по умолчанию текущий запрос) и дополнительные поля"""
+    if route is None and has_request_context():
+        route = request.path
+    logger.log(level, msg, route, fields)
+
+class TTLCache:
+    """Ограниченный кеш: записи живут ttl секунд, при переполнении вытесняются самые старые"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value), в порядке добавления
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (now + self.ttl, value)
+            # TTL одинаковый для всех, поэтому просроченные записи всегда в начале
+            while self._data:
+                oldest_key, (expires_at, _) = next(iter(self._data.items()))
+                if expires_at > now and len(self._data) <= self.maxsize:
+                    break
+                del self._data[oldest_key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0,
+        }
+
+# HTML-шаблоны компилируются один раз при импорте, маршруты рендерят готовые объекты
+TEMPLATES = {}
+TEMPLATE_SOURCES = {}
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 300  # секунд; ключ кеша и так меняется вместе с входными данными страницы
+
+page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+register_stats("page_cache", page_cache.stats)
+
+def compile_template(name, source):
+    """Компилирует шаблон страницы и регистрирует его под именем name"""
+    TEMPLATE_SOURCES[name] = source
+    TEMPLATES[name] = app.jinja_env.from_string(source)
+    return TEMPLATES[name]
+
+def render_page(name, **context):
+    """Рендер зарегистрированного шаблона"""
+    return render_template(TEMPLATES[name], **context)
+
+def stream_page(name, **context):
+    """Потоковый рендер зарегистрированного шаблона (chunked-ответ)"""
+    return Response(stream_template(TEMPLATES[name], **context), mimetype="text/html")
+
+def render_cached_page(name, cache_key, **context):
+    """Рендер с кешем готового HTML: cache_key должен меняться вместе с данными страницы"""
+    key = (name, cache_key)
+    html = page_cache.get(key)
+    if html is None:
+        html = render_page(name, **context)
+        page_cache.put(key, html)
+    return html
 
 def validate_credentials():
     """Проверка учетных данных"""
@@ -55,53 +1334,107 @@ def validate_ngrok_url():
 def verify_signature(params_dict, received_signature):
     """Проверка подписи от FreedomPay с правильным алгоритмом"""
     try:
-        # Убираем подпись из параметров для проверки
-        params_copy = params_dict.copy()
-        if 'pg_sig' in params_copy:
-            del params_copy['pg_sig']
-        
         # Определяем имя скрипта
-        if 'pg_result' in params_copy:
+        if 'pg_result' in params_dict:
             script_name = "result.php"
         else:
             script_name = "check.php"
         
-        # ✅ Используем правильный алгоритм
-        expected_signature, check_string = generate_correct_signature(params_copy, script_name, SECRET_KEY)
+        # ✅ Используем правильный алгоритм (pg_sig в подпись не входит)
+        signer = get_signer(script_name, SECRET_KEY)
+        if signer.verify(params_dict, received_signature):
+            return True
         
-        log_message(f"🔍 Проверка подписи:")
-        log_message(f"   Получена: {received_signature}")
-        log_message(f"   Ожидаем: {expected_signature}")
-        log_message(f"   Строка: {check_string}")
-        
-        return expected_signature == received_signature
+        # Ни строку подписи (она заканчивается SECRET_KEY), ни ожидаемую подпись не пишем: сюда попадает
+        # любой POST на /result, и по логу можно было бы получить верную подпись для своих параметров
+        log_message("🔍 Проверка подписи не прошла", level="WARNING",
+                    received=received_signature,
+                    params=sorted(name for name in params_dict if name != "pg_sig"))
+        return False
     except Exception as e:
-        log_message(f"❌ Ошибка проверки подписи: {e}")
+        log_message(f"❌ Ошибка проверки подписи: {e}", level="ERROR")
         return False
 
-def generate_correct_signature(params_dict, script_name, secret_key):
+class Signer:
     """
-    Правильная генерация подписи по документации FreedomPay
+    Подпись FreedomPay для фиксированной пары (script_name, secret_key).
+    Состояние MD5 после имени скрипта считается один раз и копируется на каждый вызов,
+    сравнение подписей идет по байтам дайджеста.
     """
-    # 1. Сортируем параметры по алфавиту (как ksort в PHP)
-    sorted_keys = sorted(params_dict.keys())
     
-    # 2. Создаем массив значений в алфавитном порядке
-    values = [str(params_dict[key]) for key in sorted_keys]
+    def __init__(self, script_name, secret_key):
+        self.script_name = script_name
+        self._secret_key = secret_key
+        self._suffix = ";" + secret_key
+        self._prefix_state = hashlib.md5(script_name.encode('utf-8'))
     
-    # 3. Добавляем имя скрипта в начало (array_unshift в PHP)
-    values.insert(0, script_name)
+    def _digest(self, params_dict):
+        # pg_sig никогда не входит в подписываемые параметры
+        values = [str(params_dict[key]) for key in sorted(params_dict) if key != 'pg_sig']
+        state = self._prefix_state.copy()
+        # Отдельный update() на каждое значение в CPython медленнее одного буфера
+        state.update((";" + ";".join(values) + self._suffix if values else self._suffix).encode('utf-8'))
+        return state.digest()
     
-    # 4. Добавляем SECRET_KEY в конец (array_push в PHP)  
-    values.append(secret_key)
+    def sign(self, params_dict):
+        """MD5 подпись (hex) для словаря параметров"""
+        return self._digest(params_dict).hex()
     
-    # 5. Склеиваем через ';' (implode в PHP)
-    sign_string = ';'.join(values)
+    def sign_string(self, params_dict):
+        """Строка подписи целиком — только для диагностики и логов"""
+        values = [str(params_dict[key]) for key in sorted(params_dict) if key != 'pg_sig']
+        return ";".join([self.script_name] + values + [self._secret_key])
     
-    # 6. MD5 хеш
-    signature = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+    def verify(self, params_dict, signature):
+        """Проверка подписи; некорректный hex считается несовпадением"""
+        try:
+            expected = bytes.fromhex(signature)
+        except (TypeError, ValueError):
+            return False
+        return hmac.compare_digest(self._digest(params_dict), expected)
     
-    return signature, sign_string
+    def sign_many(self, params_list):
+        """Подписи для списка словарей параметров"""
+        digest = self._digest
+        return [digest(params_dict).hex() for params_dict in params_list]
+    
+    def verify_many(self, params_list, signatures=None):
+        """Проверка списка словарей; без signatures берется pg_sig из каждого словаря"""
+        if signatures is None:
+            signatures = [params_dict.get('pg_sig') for params_dict in params_list]
+        verify = self.verify
+        return [verify(params_dict, signature) for params_dict, signature in zip(params_list, signatures)]
+
+@lru_cache(maxsize=64)
+def get_signer(script_name, secret_key):
+    """Один Signer на пару (script_name, secret_key)"""
+    return Signer(script_name, secret_key)
+
+def generate_correct_signature(params_dict, script_name, secret_key):
+    """
+    Правильная генерация подписи по документации FreedomPay:
+    сортировка параметров (ksort), имя скрипта в начало, SECRET_KEY в конец,
+    склейка через ';' (implode) и MD5.
+    Возвращает (подпись, строка подписи).
+    """
+    signer = get_signer(script_name, secret_key)
+    return signer.sign(params_dict), signer.sign_string(params_dict)
+
+compile_template("test_correct_algorithm", '''
+    <h2>🎯 Тест правильного алгоритма по документации</h2>
+    <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 11px;">{{ results }}</pre>
+    
+    <h3>📋 Алгоритм (как в PHP примере):</h3>
+    <ol>
+        <li>Сортировка параметров по алфавиту (ksort)</li>
+        <li>Добавление имени скрипта в начало (array_unshift)</li>
+        <li>Добавление SECRET_KEY в конец (array_push)</li>
+        <li>Склеивание через ';' (implode)</li>
+        <li>MD5 хеш</li>
+    </ol>
+    
+    <p><a href="/">← Главная</a></p>
+''')
 
 @app.route('/test_correct_algorithm')
 def test_correct_algorithm():
@@ -171,21 +1504,32 @@ def test_correct_algorithm():
             if match == "🎉 НАЙДЕНО!":
                 results.append(f"🎉 БЕЗ payment_origin! Скрипт='{script_name}', ключ='{key_name}': {signature}")
     
-    return render_template_string('''
-        <h2>🎯 Тест правильного алгоритма по документации</h2>
-        <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 11px;">{{ results }}</pre>
-        
-        <h3>📋 Алгоритм (как в PHP примере):</h3>
-        <ol>
-            <li>Сортировка параметров по алфавиту (ksort)</li>
-            <li>Добавление имени скрипта в начало (array_unshift)</li>
-            <li>Добавление SECRET_KEY в конец (array_push)</li>
-            <li>Склеивание через ';' (implode)</li>
-            <li>MD5 хеш</li>
-        </ol>
-        
-        <p><a href="/">← Главная</a></p>
-    ''', results='\\n'.join(results))
+    return render_page("test_correct_algorithm", results='\\n'.join(results))
+
+compile_template("index", '''
+    <h2>Тестовая оплата FreedomPay</h2>
+    <form method="post" action="/pay">
+        <label>Сумма (UZS):</label><br>
+        <input type="number" name="amount" value="1000" required><br><br>
+        <button type="submit">Оплатить</button>
+    </form>
+    
+    <h3>Информация:</h3>
+    <p>Merchant ID: {{ merchant_id }}</p>
+    <p>Ngrok URL: {{ ngrok_url }}</p>
+    
+    <h3>🛠 Инструменты диагностики:</h3>
+    <p><a href="/test_final_payment">🎉 ФИНАЛЬНЫЙ ТЕСТ (алгоритм найден!)</a></p>
+    <p><a href="/all_payment_statuses">📊 Все статусы платежей</a></p>
+    <p><a href="/test_correct_algorithm">🎯 Тест ПРАВИЛЬНОГО алгоритма (по документации!)</a></p>
+    <p><a href="/test_hash_algorithms">🔬 Тест алгоритмов хеширования</a></p>
+    <p><a href="/analyze_cabinet_url">🕵️ Анализ URL из кабинета</a></p>
+    <p><a href="/test_manual_key">🔑 Ручной тест SECRET_KEY</a></p>
+    <p><a href="/find_secret">🔍 Поиск правильного SECRET_KEY</a></p>
+    <p><a href="/test_signature">🔐 Тест подписи личного кабинета</a></p>
+    <p><a href="/test">🧪 Тест подключения</a></p>
+    <p><a href="/diagnose">🩺 Диагностика ошибки 10000</a></p>
+''')
 
 @app.route('/')
 def index():
@@ -195,30 +1539,7 @@ def index():
     if not validate_ngrok_url():
         return "<h2>❌ Ошибка конфигурации. Проверьте NGROK_URL</h2>"
         
-    return render_template_string('''
-        <h2>Тестовая оплата FreedomPay</h2>
-        <form method="post" action="/pay">
-            <label>Сумма (UZS):</label><br>
-            <input type="number" name="amount" value="1000" required><br><br>
-            <button type="submit">Оплатить</button>
-        </form>
-        
-        <h3>Информация:</h3>
-        <p>Merchant ID: {{ merchant_id }}</p>
-        <p>Ngrok URL: {{ ngrok_url }}</p>
-        
-        <h3>🛠 Инструменты диагностики:</h3>
-        <p><a href="/test_final_payment">🎉 ФИНАЛЬНЫЙ ТЕСТ (алгоритм найден!)</a></p>
-        <p><a href="/all_payment_statuses">📊 Все статусы платежей</a></p>
-        <p><a href="/test_correct_algorithm">🎯 Тест ПРАВИЛЬНОГО алгоритма (по документации!)</a></p>
-        <p><a href="/test_hash_algorithms">🔬 Тест алгоритмов хеширования</a></p>
-        <p><a href="/analyze_cabinet_url">🕵️ Анализ URL из кабинета</a></p>
-        <p><a href="/test_manual_key">🔑 Ручной тест SECRET_KEY</a></p>
-        <p><a href="/find_secret">🔍 Поиск правильного SECRET_KEY</a></p>
-        <p><a href="/test_signature">🔐 Тест подписи личного кабинета</a></p>
-        <p><a href="/test">🧪 Тест подключения</a></p>
-        <p><a href="/diagnose">🩺 Диагностика ошибки 10000</a></p>
-    ''', merchant_id=MERCHANT_ID, ngrok_url=NGROK_URL)
+    return render_cached_page("index", None, merchant_id=MERCHANT_ID, ngrok_url=NGROK_URL)
 
 # Добавляем альтернативные endpoints и методы
 ALTERNATIVE_ENDPOINTS = [
@@ -228,6 +1549,852 @@ ALTERNATIVE_ENDPOINTS = [
     "https://secure.freedompay.uz/payment.php"
 ]
 
+# Параллельная проверка доступности шлюзов: по потоку на хост, общий дедлайн на весь набор
+PROBE_DEADLINE = 8.0       # секунд на все проверки вместе
+PROBE_TIMEOUT = 5.0        # секунд на одну сетевую операцию
+PROBE_MAX_WORKERS = 8
+PROBE_USER_AGENT = "FreedomPayTestServer/1.0 (probe)"
+
+class ProbeDeadlineExceeded(Exception):
+    """Общий дедлайн проверок истек"""
+
+def _remaining(deadline_at, timeout):
+    remaining = deadline_at - time.monotonic()
+    if remaining <= 0:
+        raise ProbeDeadlineExceeded("дедлайн проверки истек")
+    return min(timeout, remaining)
+
+def _open_probe_connection(scheme, host, port, deadline_at, timeout, timings):
+    """Соединение с замером фаз DNS, TCP connect, TLS (пишутся в timings по мере прохождения)"""
+    started = time.perf_counter()
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    timings["dns"] = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    sock = None
+    last_error = None
+    for family, socktype, proto, _, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(_remaining(deadline_at, timeout))
+        try:
+            sock.connect(address)
+            break
+        except OSError as e:
+            sock.close()
+            sock = None
+            last_error = e
+    if sock is None:
+        raise last_error or OSError(f"нет адресов для {host}")
+    timings["connect"] = time.perf_counter() - started
+    
+    timings["tls"] = 0.0
+    if scheme == "https":
+        started = time.perf_counter()
+        sock.settimeout(_remaining(deadline_at, timeout))
+        try:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        except Exception:
+            sock.close()
+            raise
+        timings["tls"] = time.perf_counter() - started
+    
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    conn.sock = sock
+    return conn
+
+def _probe_request(conn, method, path, host, deadline_at, timeout):
+    """Один запрос по уже открытому соединению: (код, время до первого байта, закрыть ли соединение)"""
+    conn.sock.settimeout(_remaining(deadline_at, timeout))
+    started = time.perf_counter()
+    conn.request(method, path, headers={"Host": host, "User-Agent": PROBE_USER_AGENT})
+    response = conn.getresponse()
+    first_byte = time.perf_counter() - started
+    # Тело дочитываем, чтобы соединение можно было переиспользовать
+    response.read()
+    return response.status, first_byte, response.will_close
+
+def _probe_host(scheme, host, port, urls, method, get_on_405, deadline_at, timeout, results):
+    """Проверка всех URL одного хоста по одному keep-alive соединению; результаты пишутся в results сразу"""
+    conn = None
+    for url in urls:
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        result = {"url": url, "ok": False, "status": None, "get_status": None, "error": None,
+                  "reused": False, "timings": {}}
+        # Переиспользованное соединение сервер мог уже закрыть — тогда одна попытка с новым
+        for attempt in range(2):
+            timings = {}
+            result["reused"] = conn is not None
+            try:
+                if conn is None:
+                    conn = _open_probe_connection(scheme, host, port, deadline_at, timeout, timings)
+                else:
+                    timings.update(dns=0.0, connect=0.0, tls=0.0)
+                status, first_byte, will_close = _probe_request(conn, method, path, host, deadline_at, timeout)
+                timings["first_byte"] = first_byte
+                result.update(ok=True, status=status, error=None)
+                # Method not allowed для HEAD — дополнительно пробуем GET
+                if status == 405 and get_on_405 and not will_close:
+                    result["get_status"], _, will_close = _probe_request(conn, "GET", path, host,
+                                                                         deadline_at, timeout)
+                if will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException, ProbeDeadlineExceeded) as e:
+                result["error"] = str(e) or e.__class__.__name__
+                retry = result["reused"] and not isinstance(e, ProbeDeadlineExceeded) and not result["ok"]
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                if retry and attempt == 0:
+                    continue
+            result["timings"] = timings
+            break
+        results[url] = result
+    if conn is not None:
+        conn.close()
+
+def probe_endpoints(urls, method="HEAD", get_on_405=False, deadline=PROBE_DEADLINE, timeout=PROBE_TIMEOUT):
+    """
+    Параллельная проверка URL с общим дедлайном.
+    Возвращает список результатов в порядке urls: код ответа, ошибка и тайминги
+    dns/connect/tls/first_byte (секунды) для каждого URL.
+    """
+    deadline_at = time.monotonic() + deadline
+    hosts = {}
+    for url in urls:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        hosts.setdefault((parts.scheme, parts.hostname, port), []).append(url)
+    
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(len(hosts), PROBE_MAX_WORKERS)),
+                                  thread_name_prefix="gateway-probe")
+    try:
+        futures = [executor.submit(_probe_host, scheme, host, port, host_urls, method, get_on_405,
+                                   deadline_at, timeout, results)
+                   for (scheme, host, port), host_urls in hosts.items()]
+        wait_futures(futures, timeout=max(0, deadline_at - time.monotonic()))
+        results = dict(results)
+    finally:
+        # Зависшие проверки (например, DNS) досчитаются в фоне, ответ их не ждет
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return [results.get(url) or {"url": url, "ok": False, "status": None, "get_status": None,
+                                 "error": "дедлайн проверки истек", "reused": False, "timings": {}}
+            for url in urls]
+
+def format_probe_timings(result):
+    """Тайминги проверки в миллисекундах для диагностических страниц"""
+    timings = result["timings"]
+    if not timings:
+        return ""
+    parts = [f"{name} {timings[name] * 1000:.0f} мс" for name in ("dns", "connect", "tls", "first_byte")
+             if name in timings]
+    if result["reused"]:
+        parts.append("keep-alive")
+    return f" ({', '.join(parts)})"
+
+# Фоновый мониторинг шлюзов: таблица здоровья с TTL и автомат отключения (circuit breaker) по хосту
+HEALTH_CHECK_INTERVAL = 30     # секунд между фоновыми проверками
+HEALTH_TTL = 90                # секунд, после которых запись таблицы считается устаревшей
+BREAKER_FAILURE_THRESHOLD = 3  # ошибок подряд, после которых хост отключается
+BREAKER_RESET_TIMEOUT = 60     # секунд до пробной проверки отключенного хоста
+
+class CircuitBreaker:
+    """
+    Автомат по хосту: closed → open после BREAKER_FAILURE_THRESHOLD ошибок подряд,
+    open → half_open через BREAKER_RESET_TIMEOUT (одна пробная проверка),
+    half_open → closed при успехе или снова open при ошибке.
+    """
+    
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+    
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def allow(self):
+        """Можно ли обращаться к хосту (в half_open — только для пробной проверки)"""
+        return self.state != "open"
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # Ошибка пробной проверки сразу возвращает хост в open
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+def probe_is_healthy(result):
+    """
+    Шлюз годен для /pay, если ответил 2xx/3xx. 405 на HEAD тоже годится: страница есть,
+    но HEAD не принимает — если при этом GET вернул 403/404/410 или 5xx, страницы нет.
+    Остальные 4xx (хост жив, но payment.php не обслуживает) — не годен.
+    """
+    if not result["ok"]:
+        return False
+    status = result["status"]
+    if status == 405:
+        get_status = result.get("get_status")
+        return get_status is None or (get_status not in (403, 404, 410) and get_status < 500)
+    return 200 <= status < 400
+
+class GatewayHealthMonitor:
+    """
+    Периодически проверяет шлюзы через probe_endpoints и хранит последнюю проверку каждого URL.
+    Диагностические страницы и /pay читают таблицу без сетевых запросов.
+    """
+    
+    def __init__(self, urls, interval=HEALTH_CHECK_INTERVAL, ttl=HEALTH_TTL,
+                 deadline=PROBE_DEADLINE, timeout=PROBE_TIMEOUT):
+        self.urls = list(urls)
+        self.interval = interval
+        self.ttl = ttl
+        self.deadline = deadline
+        self.timeout = timeout
+        self._table = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.checks = 0
+        self.skipped = 0
+        self.listeners = []
+        self.last_check_at = None
+    
+    def breaker(self, url):
+        return self._host_breaker(urlsplit(url).netloc)
+    
+    def _host_breaker(self, host):
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker()
+            return breaker
+    
+    def refresh(self):
+        """Одна проверка всех URL; хосты с открытым автоматом пропускаются до пробной проверки"""
+        with self._refresh_lock:
+            due = [url for url in self.urls if self.breaker(url).allow()]
+            results = probe_endpoints(due, method="HEAD", get_on_405=True, deadline=self.deadline,
+                                      timeout=self.timeout) if due else []
+            now = time.time()
+            
+            # Автомат считает ошибки по хосту: хост жив, если ответил хоть один его URL
+            host_healthy = {}
+            for result in results:
+                host = urlsplit(result["url"]).netloc
+                host_healthy[host] = host_healthy.get(host, False) or probe_is_healthy(result)
+                if result["ok"]:
+                    GATEWAY_LATENCY.observe(sum(result["timings"].values()), host, "probe")
+                else:
+                    GATEWAY_ERRORS.inc(host, "probe")
+            for host, healthy in host_healthy.items():
+                breaker = self._host_breaker(host)
+                if healthy:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            
+            with self._lock:
+                for result in results:
+                    self._table[result["url"]] = dict(result, checked_at=now)
+                self.checks += 1
+                self.skipped += len(self.urls) - len(due)
+                self.last_check_at = now
+            for listener in self.listeners:
+                listener(results)
+        return results
+    
+    def ensure_fresh(self):
+        """Проверка на месте, если фоновый поток еще не заполнил таблицу или она устарела"""
+        if self.last_check_at is None or time.time() - self.last_check_at > self.ttl:
+            self.refresh()
+    
+    def snapshot(self):
+        """Таблица в порядке urls: результат проверки, возраст, свежесть и состояние автомата"""
+        now = time.time()
+        rows = []
+        with self._lock:
+            entries = [(url, self._table.get(url)) for url in self.urls]
+        for url, entry in entries:
+            state = self.breaker(url).state
+            if entry is None:
+                entry = {"url": url, "ok": False, "status": None, "get_status": None,
+                         "error": "еще не проверялся", "reused": False, "timings": {}, "checked_at": None}
+            age = None if entry["checked_at"] is None else now - entry["checked_at"]
+            rows.append(dict(entry, age=age, fresh=age is not None and age <= self.ttl, breaker=state))
+        return rows
+    
+    def is_available(self, url):
+        """
+        Шлюз можно использовать: автомат закрыт и свежая проверка не провалилась.
+        В half_open пробный запрос — это следующая фоновая проверка (refresh), а не /pay
+        пользователей: после ее успеха автомат закрывается и шлюз снова выбирается.
+        """
+        if self.breaker(url).state != "closed":
+            return False
+        with self._lock:
+            entry = self._table.get(url)
+        if entry is None or time.time() - entry["checked_at"] > self.ttl:
+            return True
+        return probe_is_healthy(entry)
+    
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="gateway-health", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+    
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                log_message("⚠️ Ошибка фоновой проверки шлюзов", level="WARNING", error=str(e))
+            self._stop.wait(self.interval)
+    
+    def after_fork(self):
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def stats(self):
+        with self._lock:
+            breakers = {host: breaker for host, breaker in self._breakers.items()}
+            healthy = sum(1 for entry in self._table.values() if probe_is_healthy(entry))
+            stats = {"urls": len(self.urls), "healthy": healthy, "checks": self.checks,
+                     "skipped_open": self.skipped, "running": self._thread is not None,
+                     "last_check_age": None if self.last_check_at is None else round(time.time() - self.last_check_at, 1)}
+        stats["breakers"] = {host: breaker.state for host, breaker in breakers.items()}
+        return stats
+
+gateway_monitor = GatewayHealthMonitor(GATEWAY_URLS + ALTERNATIVE_ENDPOINTS)
+register_stats("gateway_health", gateway_monitor.stats)
+atexit.register(gateway_monitor.stop)
+
+# Выбор шлюза для редиректа /pay по EWMA задержки и доли ошибок проверок монитора
+GATEWAY_EWMA_ALPHA = 0.3        # вес нового замера
+GATEWAY_ERROR_PENALTY = 10      # во сколько раз доля ошибок 1.0 ухудшает оценку
+GATEWAY_MAX_ERROR_RATE = 0.5    # шлюз с большей долей ошибок не выбирается
+GATEWAY_SWITCH_RATIO = 1.5      # основной/текущий шлюз держится, пока не хуже лучшего в столько раз
+
+class GatewaySelector:
+    """
+    EWMA задержки (connect + TLS + первый байт) и доли ошибок по каждому URL.
+    Выбор пересчитывается только при новых замерах, /pay читает готовый результат.
+    Основной шлюз (первый в urls) предпочитается, пока он не деградировал.
+    """
+    
+    def __init__(self, urls, monitor, alpha=GATEWAY_EWMA_ALPHA):
+        self.urls = list(urls)
+        self.monitor = monitor
+        self.alpha = alpha
+        self.latency = dict.fromkeys(self.urls)
+        self.error_rate = dict.fromkeys(self.urls)
+        self._lock = threading.Lock()
+        self._pick = self.urls[0]
+        self.switches = 0
+    
+    def observe(self, results):
+        """Новые замеры (результаты probe_endpoints) и пересчет выбора"""
+        with self._lock:
+            for result in results:
+                url = result["url"]
+                if url not in self.error_rate:
+                    continue
+                healthy = probe_is_healthy(result)
+                self.error_rate[url] = self._ewma(self.error_rate[url], 0.0 if healthy else 1.0)
+                if healthy:
+                    sample = sum(result["timings"].get(name, 0.0) for name in ("connect", "tls", "first_byte"))
+                    self.latency[url] = self._ewma(self.latency[url], sample)
+            self._select()
+    
+    def _ewma(self, previous, sample):
+        return sample if previous is None else self.alpha * sample + (1 - self.alpha) * previous
+    
+    def score(self, url):
+        """Оценка шлюза (меньше — лучше), None — замеров задержки еще нет"""
+        latency = self.latency.get(url)
+        if latency is None:
+            return None
+        return latency * (1 + GATEWAY_ERROR_PENALTY * (self.error_rate[url] or 0.0))
+    
+    def _select(self):
+        candidates = {}
+        for url in self.urls:
+            score = self.score(url)
+            if (score is not None and (self.error_rate[url] or 0.0) <= GATEWAY_MAX_ERROR_RATE
+                    and self.monitor.is_available(url)):
+                candidates[url] = score
+        if not candidates:
+            # Замеров нет или все деградировали — основной шлюз
+            pick = self.urls[0]
+        else:
+            best = min(candidates, key=candidates.get)
+            pick = best
+            # Гистерезис: основной, затем текущий шлюз держатся, пока не намного хуже лучшего
+            for preferred in (self.urls[0], self._pick):
+                if preferred in candidates and candidates[preferred] <= candidates[best] * GATEWAY_SWITCH_RATIO:
+                    pick = preferred
+                    break
+        if pick != self._pick:
+            log_message("🔀 Смена шлюза для /pay", level="WARNING", previous=self._pick, current=pick,
+                        score=candidates.get(pick))
+            self.switches += 1
+            self._pick = pick
+    
+    def pick(self):
+        return self._pick
+    
+    def stats(self):
+        with self._lock:
+            return {"pick": self._pick, "switches": self.switches,
+                    "gateways": {url: {"latency_ms": None if self.latency[url] is None
+                                       else round(self.latency[url] * 1000, 1),
+                                       "error_rate": None if self.error_rate[url] is None
+                                       else round(self.error_rate[url], 3)}
+                                 for url in self.urls}}
+
+gateway_selector = GatewaySelector(GATEWAY_URLS, gateway_monitor)
+gateway_monitor.listeners.append(gateway_selector.observe)
+register_stats("gateway_selector", gateway_selector.stats)
+
+def format_health_age(row):
+    """Возраст записи таблицы здоровья для диагностических страниц"""
+    if row["age"] is None:
+        return ""
+    suffix = "" if row["fresh"] else ", устарело"
+    return f" [проверено {row['age']:.0f} с назад{suffix}]"
+
+def format_breaker(row):
+    return "" if row["breaker"] == "closed" else f" [автомат: {row['breaker']}]"
+
+# Общая сессия для исходящих запросов к шлюзу: пул keep-alive соединений на хост и таймауты по умолчанию.
+# Проверки доступности (probe_endpoints) открывают свои соединения, чтобы замерять DNS/connect/TLS.
+HTTP_CONNECT_TIMEOUT = 3.05   # секунд на установку соединения
+HTTP_READ_TIMEOUT = 10        # секунд на ожидание ответа
+HTTP_POOL_CONNECTIONS = 8     # хостов, пулы которых держатся одновременно
+HTTP_POOL_MAXSIZE = 10        # keep-alive соединений на хост по умолчанию
+HTTP_HOST_POOL_SIZES = {
+    "api.freedompay.uz": 20,
+}
+
+class GatewaySession:
+    """
+    Потокобезопасная обертка над requests.Session: отдельный HTTPAdapter с размером пула
+    для хостов из pool_sizes, таймауты (connect, read) по умолчанию и счетчики
+    переиспользования соединений по данным пулов urllib3.
+    """
+    
+    def __init__(self, pool_sizes=None, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self._pool_config = (pool_sizes or {}, pool_connections, pool_maxsize)
+        self.session = self._build_session()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            GATEWAY_ERRORS.inc(host, "session")
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            GATEWAY_LATENCY.observe(elapsed, host, "session")
+            with self._lock:
+                self.requests += 1
+                self.total_time += elapsed
+    
+    def _build_session(self):
+        pool_sizes, pool_connections, pool_maxsize = self._pool_config
+        session = requests.Session()
+        session.headers["User-Agent"] = PROBE_USER_AGENT
+        self._adapters = {}
+        default = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        for scheme in ("http://", "https://"):
+            session.mount(scheme, default)
+        self._adapters["*"] = default
+        for host, size in pool_sizes.items():
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            for scheme in ("http://", "https://"):
+                session.mount(f"{scheme}{host}", adapter)
+            self._adapters[host] = adapter
+        return session
+    
+    def after_fork(self):
+        # Keep-alive соединения родителя делить нельзя: дочерний процесс открывает свои
+        self._lock = threading.Lock()
+        self.session = self._build_session()
+    
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+    
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+    
+    def close(self):
+        self.session.close()
+    
+    def pool_stats(self):
+        """Открытые соединения и запросы по пулам urllib3: reused = запросы без нового соединения"""
+        pools = {}
+        for adapter in set(self._adapters.values()):
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.host}:{pool.port}"
+                pools[host] = {"connections": pool.num_connections, "requests": pool.num_requests,
+                               "reused": pool.num_requests - pool.num_connections,
+                               "idle": pool.pool.qsize() if pool.pool is not None else 0,
+                               "maxsize": pool.pool.maxsize if pool.pool is not None else 0}
+        return pools
+    
+    def stats(self):
+        with self._lock:
+            stats = {"requests": self.requests, "errors": self.errors,
+                     "avg_ms": round(self.total_time / self.requests * 1000, 1) if self.requests else 0.0}
+        stats["pools"] = self.pool_stats()
+        return stats
+
+gateway_session = GatewaySession(HTTP_HOST_POOL_SIZES)
+register_stats("gateway_session", gateway_session.stats)
+atexit.register(gateway_session.close)
+
+# Сверка зависших "pending" заказов со шлюзом (get_status2.php) на случай потерянного /result
+RECONCILE_URL = os.environ.get("FREEDOMPAY_STATUS_URL")  # по умолчанию — get_status2.php выбранного шлюза
+RECONCILE_INTERVAL = 60        # секунд между проходами
+RECONCILE_AFTER = 600          # секунд в "pending", после которых заказ сверяется со шлюзом
+RECONCILE_RECHECK = 300        # секунд до повторной сверки заказа, который шлюз вернул как незавершенный
+RECONCILE_RECHECK_SIZE = 10000 # заказов, помнящих время последней сверки
+RECONCILE_BATCH = 500          # заказов за проход
+RECONCILE_CONCURRENCY = 4      # одновременных запросов к шлюзу
+RECONCILE_RATE = 20            # запросов к шлюзу в секунду
+RECONCILE_BUDGET = 30          # секунд на проход; что не успели — в следующий раз
+RECONCILE_NOT_FOUND_CODE = "340"  # pg_error_code "платеж не найден"
+
+# Запросы статуса к шлюзу из /check_payment_status и сверки идут через single-flight кеш
+STATUS_LOOKUP_AFTER = 30         # секунд в "pending", после которых /check_payment_status спрашивает шлюз
+STATUS_LOOKUP_TIMEOUT = 2.0      # секунд клиент ждет ответ шлюза, потом получает локальный статус
+STATUS_LOOKUP_WORKERS = 4        # одновременных запросов статуса к шлюзу
+STATUS_LOOKUP_CACHE_SIZE = 10000
+STATUS_LOOKUP_FINAL_TTL = 3600   # секунд кешируется финальный ответ ("success" / "failed")
+STATUS_LOOKUP_PENDING_TTL = 5    # секунд кешируются "pending" и "not_found"
+STATUS_LOOKUP_ERROR_TTL = 1      # секунд кешируется ошибка, чтобы при сбое шлюза не слать ему лавину запросов
+
+# pg_transaction_status из get_status2.php -> статус заказа; остальные значения — платеж еще идет
+GATEWAY_TRANSACTION_STATUSES = {
+    "ok": "success",
+    "failed": "failed",
+    "revoked": "failed",
+    "incomplete": "failed",
+}
+
+def parse_gateway_response(text):
+    """XML-ответ FreedomPay (<response><pg_status>...) в плоский dict"""
+    root = ElementTree.fromstring(text)
+    return {child.tag: (child.text or "") for child in root}
+
+class GatewayStatusLookup:
+    """
+    Single-flight кеш перед запросами статуса к шлюзу: одновременные запросы одного
+    order_id ждут один и тот же вызов query(record), результат кешируется на время,
+    зависящее от исхода (финальный — надолго, "pending" — на секунды, ошибка — на секунду).
+    Вызовы идут в пуле из workers потоков, поэтому клиент может перестать ждать по таймауту,
+    не прерывая запрос, результат которого пригодится следующим.
+    """
+
+    def __init__(self, query, workers=STATUS_LOOKUP_WORKERS, cache_size=STATUS_LOOKUP_CACHE_SIZE,
+                 final_ttl=STATUS_LOOKUP_FINAL_TTL, pending_ttl=STATUS_LOOKUP_PENDING_TTL,
+                 error_ttl=STATUS_LOOKUP_ERROR_TTL):
+        self.query = query
+        self.workers = workers
+        # TTLCache вытесняет по порядку добавления, поэтому на каждый TTL свой кеш
+        self._caches = {"final": TTLCache(cache_size, final_ttl), "pending": TTLCache(cache_size, pending_ttl),
+                        "error": TTLCache(cache_size, error_ttl)}
+        self._in_flight = {}  # order_id -> Future
+        self._lock = threading.Lock()
+        self._executor = None
+        self.calls = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.timeouts = 0
+
+    @staticmethod
+    def _kind(outcome):
+        if outcome in ("success", "failed"):
+            return "final"
+        return "error" if outcome == "error" else "pending"
+
+    def cached(self, order_id):
+        """Исход из кеша или None"""
+        for cache in self._caches.values():
+            outcome = cache.get(order_id)
+            if outcome is not None:
+                return outcome
+        return None
+
+    def _call(self, record):
+        order_id = record["order_id"]
+        try:
+            outcome = self.query(record)
+        except Exception as e:
+            log_message("⚠️ Ошибка запроса статуса к шлюзу", level="WARNING", order_id=order_id, error=str(e))
+            outcome = "error"
+        # Сначала кеш, потом снятие in-flight: между ними новый запрос не должен уйти в шлюз
+        self._caches[self._kind(outcome)].put(order_id, outcome)
+        with self._lock:
+            self._in_flight.pop(order_id, None)
+        return outcome
+
+    def lookup_async(self, record):
+        """Future с исходом запроса статуса заказа record (общий для одновременных запросов)"""
+        order_id = record["order_id"]
+        with self._lock:
+            outcome = self.cached(order_id)
+            if outcome is not None:
+                self.cache_hits += 1
+                future = Future()
+                future.set_result(outcome)
+                return future
+            future = self._in_flight.get(order_id)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="status-lookup")
+            self.calls += 1
+            future = self._executor.submit(self._call, record)
+            self._in_flight[order_id] = future
+        return future
+
+    def lookup(self, record, timeout=None):
+        """Исход запроса или None, если шлюз не ответил за timeout секунд"""
+        try:
+            return self.lookup_async(record).result(timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            return None
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._executor = None
+
+    def stats(self):
+        with self._lock:
+            stats = {"calls": self.calls, "coalesced": self.coalesced, "cache_hits": self.cache_hits,
+                     "timeouts": self.timeouts, "in_flight": len(self._in_flight)}
+        stats["cached"] = {kind: len(cache) for kind, cache in self._caches.items()}
+        return stats
+
+class Reconciler:
+    """
+    Фоновая сверка: заказы, зависшие в "pending" дольше after секунд, запрашиваются
+    в get_status2.php не более concurrency запросами одновременно и не чаще rate в секунду
+    через общий пул соединений; проход ограничен budget секундами. Итоги проверки
+    записываются одним пакетом с пробуждением ожидающих клиентов.
+    """
+
+    def __init__(self, store, url=RECONCILE_URL, interval=RECONCILE_INTERVAL, after=RECONCILE_AFTER,
+                 batch=RECONCILE_BATCH, concurrency=RECONCILE_CONCURRENCY, rate=RECONCILE_RATE,
+                 budget=RECONCILE_BUDGET, recheck=RECONCILE_RECHECK, session=None, lookup=None):
+        self.store = store
+        self.url = url
+        self.interval = interval
+        self.after = after
+        self.batch = batch
+        self.concurrency = concurrency
+        self.rate = rate
+        self.budget = budget
+        self.session = session or gateway_session
+        self.lookup = lookup or GatewayStatusLookup(self.query)
+        self._recent = TTLCache(RECONCILE_RECHECK_SIZE, recheck)
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.totals = {"checked": 0, "success": 0, "failed": 0, "pending": 0, "not_found": 0, "errors": 0}
+        self.last_run = None
+
+    def status_url(self):
+        return self.url or urljoin(gateway_selector.pick(), "get_status2.php")
+
+    def _acquire(self, deadline):
+        """Слот для запроса с шагом 1/rate; False, если он позже deadline (бюджет прохода исчерпан)"""
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            if slot >= deadline:
+                return False
+            self._next_slot = slot + 1 / self.rate if self.rate else slot
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
+    def query(self, record):
+        """Один запрос get_status2.php: "success" / "failed" / "pending" / "not_found" / "error" """
+        url = self.status_url()
+        params = {"pg_merchant_id": MERCHANT_ID, "pg_order_id": record["order_id"], "pg_salt": uuid.uuid4().hex[:16]}
+        if record.get("payment_id"):
+            params["pg_payment_id"] = record["payment_id"]
+        signer = get_signer("get_status2.php", SECRET_KEY)
+        params["pg_sig"] = signer.sign(params)
+        try:
+            response = self.session.post(url, data=params)
+            fields = parse_gateway_response(response.text)
+        except (requests.RequestException, ElementTree.ParseError) as e:
+            log_message("⚠️ Сверка: шлюз не ответил", level="WARNING", order_id=record["order_id"], error=str(e))
+            return "error"
+        # Неподписанный ответ тоже отвергаем: по нему статус ушел бы в хранилище и подписчикам
+        if not fields.get("pg_sig") or not signer.verify(fields, fields["pg_sig"]):
+            log_message("⚠️ Сверка: ответ без подписи или с некорректной подписью", level="WARNING",
+                        order_id=record["order_id"])
+            return "error"
+        if fields.get("pg_status") != "ok":
+            if fields.get("pg_error_code") == RECONCILE_NOT_FOUND_CODE:
+                return "not_found"
+            log_message("⚠️ Сверка: ошибка шлюза", level="WARNING", order_id=record["order_id"],
+                        code=fields.get("pg_error_code"), description=fields.get("pg_error_description"))
+            return "error"
+        return GATEWAY_TRANSACTION_STATUSES.get(fields.get("pg_transaction_status"), "pending")
+
+    def _check(self, record, deadline):
+        # Ответ, полученный недавно для клиента, не тратит лимит частоты
+        outcome = self.lookup.cached(record["order_id"])
+        if outcome is not None:
+            return record, outcome
+        if not self._acquire(deadline):
+            return record, None
+        return record, self.lookup.lookup(record)
+
+    def run_once(self, now=None):
+        """Один проход; возвращает статистику прохода"""
+        started = time.monotonic()
+        deadline = started + self.budget
+        before = (now or time.time()) - self.after
+        # Недавно сверенные заказы пропускаем, поэтому берем кандидатов с запасом
+        candidates = self.store.pending_older_than(before, self.batch + len(self._recent))
+        orders = [record for record in candidates if self._recent.get(record["order_id"]) is None][:self.batch]
+        run = {"candidates": len(orders), "checked": 0, "success": 0, "failed": 0, "pending": 0,
+               "not_found": 0, "errors": 0, "over_budget": 0}
+        updates = []
+        if orders:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconcile") as executor:
+                for record, outcome in executor.map(lambda record: self._check(record, deadline), orders):
+                    if outcome is None:
+                        run["over_budget"] += 1
+                        continue
+                    run["checked"] += 1
+                    run["errors" if outcome == "error" else outcome] += 1
+                    if outcome in ("success", "failed"):
+                        updates.append((record["order_id"], outcome, record.get("payment_id")))
+                    elif outcome != "error":
+                        self._recent.put(record["order_id"], True)
+        # Пока шли запросы, мог прийти запоздавший /result — его не перезаписываем
+        updates = [update for update in updates if self.store.get(update[0]) == "pending"]
+        write_statuses(self.store, updates)
+        run["updated"] = len(updates)
+        run["duration"] = round(time.monotonic() - started, 3)
+        run["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        self.runs += 1
+        for name in self.totals:
+            self.totals[name] += run[name]
+        self.last_run = run
+        if orders:
+            log_message("🔄 Сверка с шлюзом", **run)
+        return run
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="reconciler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                log_message("⚠️ Ошибка сверки со шлюзом", level="WARNING", error=str(e))
+
+    def after_fork(self):
+        self._rate_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.lookup.after_fork()
+
+    def stats(self):
+        return {"runs": self.runs, "running": self._thread is not None, "totals": dict(self.totals),
+                "last_run": self.last_run, "recently_checked": len(self._recent)}
+
+reconciler = Reconciler(payment_statuses)
+register_stats("reconciler", reconciler.stats)
+atexit.register(reconciler.stop)
+status_lookup = reconciler.lookup
+register_stats("status_lookup", status_lookup.stats)
+
+def needs_gateway_lookup(record):
+    """Заказ давно в "pending" — возможно, /result потерялся и стоит спросить шлюз"""
+    return (record is not None and record["status"] == "pending"
+            and time.time() - record["updated_at"] > STATUS_LOOKUP_AFTER)
+
+def apply_gateway_outcome(record, outcome):
+    """Финальный исход из шлюза записывается (если заказ все еще "pending"); возвращает статус для клиента"""
+    if outcome not in ("success", "failed"):
+        return record["status"]
+    if payment_statuses.get(record["order_id"]) == "pending":
+        set_payment_status(record["order_id"], outcome, record.get("payment_id"))
+    return outcome
+
 # Добавляем проверку мерчанта
 def test_merchant_credentials():
     """Тестирование учетных данных мерчанта"""
@@ -244,9 +2411,7 @@ def test_merchant_credentials():
     }
     
     # Создаем тестовую подпись
-    sorted_keys = sorted(test_params.keys())
-    sign_string = "payment.php;" + ";".join(f"{k}={test_params[k]}" for k in sorted_keys) + f";{SECRET_KEY}"
-    signature = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+    signature = get_signer("payment.php", SECRET_KEY).sign(test_params)
     
     log_message(f"🧪 Тестовая подпись: {signature}")
     log_message(f"🧪 Merchant ID: {MERCHANT_ID}")
@@ -261,7 +2426,11 @@ def pay():
     if not validate_ngrok_url():
         return "<h2>❌ Ошибка конфигурации NGROK URL</h2>"
 
-    amount = str(int(request.form['amount']))
+    return redirect(build_payment_redirect(request.form['amount']))
+
+def build_payment_redirect(amount, route=None):
+    """Подписанный URL payment.php для суммы amount (общий для Flask и ASGI режимов)"""
+    amount = str(int(amount))
     salt = uuid.uuid4().hex[:16]  # Укорачиваем соль как в примере
 
     # Параметры для платежа
@@ -278,10 +2447,8 @@ def pay():
     # ✅ ПРАВИЛЬНАЯ подпись по найденному алгоритму
     signature, sign_string = generate_correct_signature(params, "payment.php", SECRET_KEY)
 
-    log_message(f"💰 Amount: {amount} UZS")
-    log_message(f"🧂 Salt: {salt}")
-    log_message(f"✅ ПРАВИЛЬНАЯ подпись: {signature}")
-    log_message(f"📝 Sign String: {sign_string}")
+    log_message("💰 Новый платеж", route=route, amount=amount, salt=salt, signature=signature)
+    log_message("📝 Sign String", level="DEBUG", route=route, sign_string=sign_string)
 
     # Формируем URL для перенаправления
     query_parts = []
@@ -291,14 +2458,21 @@ def pay():
     query_parts.append(f"pg_sig={signature}")
     
     query_string = "&".join(query_parts)
-    redirect_url = f"https://api.freedompay.uz/payment.php?{query_string}"
+    # Шлюз с лучшей EWMA задержки и ошибок по проверкам монитора
+    gateway_url = gateway_selector.pick()
+    redirect_url = f"{gateway_url}?{query_string}"
     
-    log_message(f"🔗 Итоговая ссылка: {redirect_url}")
-    log_message(f"🚀 Перенаправляем...")
+    log_message("🚀 Перенаправляем", level="DEBUG", route=route, redirect_url=redirect_url)
     
-    return redirect(redirect_url)
+    return redirect_url
 
 # Добавляем отдельный route для тестирования подписи
+compile_template("test_signature", '''
+    <h2>🧪 Тест подписи личного кабинета</h2>
+    <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px;">{{ results }}</pre>
+    <p><a href="/">← Главная</a></p>
+''')
+
 @app.route('/test_signature')
 def test_signature():
     """Тестирование подписи как в личном кабинете"""
@@ -315,9 +2489,7 @@ def test_signature():
         "payment_origin": "merchant_cabinet"
     }
     
-    sorted_keys = sorted(cabinet_params.keys())
-    sign_string = "payment.php;" + ";".join(f"{k}={cabinet_params[k]}" for k in sorted_keys) + f";{SECRET_KEY}"
-    our_signature = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+    our_signature, sign_string = generate_correct_signature(cabinet_params, "payment.php", SECRET_KEY)
     
     expected_signature = "cf5b280eccf239052039b0692208bce3"
     
@@ -335,80 +2507,839 @@ def test_signature():
         results.append("3. Другой алгоритм хеширования")
         results.append(f"Текущий SECRET_KEY: {SECRET_KEY}")
     
-    return render_template_string('''
-        <h2>🧪 Тест подписи личного кабинета</h2>
-        <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px;">{{ results }}</pre>
-        <p><a href="/">← Главная</a></p>
-    ''', results='\\n'.join(results))
+    return render_page("test_signature", results='\\n'.join(results))
 
-@app.route('/check', methods=['POST'])
-def check():
-    log_message("▶ CHECK запрос получен")
-    log_message(f"📨 Данные: {dict(request.form)}")
+# Очередь входящих callback'ов: обработчики только проверяют подпись и сразу отвечают "OK",
+# изменения статусов применяют фоновые потоки пачками
+CALLBACK_QUEUE_SIZE = 10000      # общая емкость очереди
+CALLBACK_WORKERS = 2             # потоков-обработчиков
+CALLBACK_BATCH_SIZE = 200        # callback'ов за одно применение
+CALLBACK_ENQUEUE_TIMEOUT = 0.5   # секунд ждем место в очереди, потом отвечаем 503
+CALLBACK_RETRY_ATTEMPTS = 3      # попыток применить пачку (сбой outbox, занятая база)
+CALLBACK_RETRY_DELAY = 0.5       # секунд перед повтором, растет с каждой попыткой
+
+class CallbackQueue:
+    """
+    Ограниченная очередь callback'ов с пулом обработчиков.
+    Callback'и одного заказа всегда попадают в один и тот же поток, поэтому
+    /check и /result одного заказа применяются в порядке поступления.
+    """
+
+    def __init__(self, handler, maxsize=CALLBACK_QUEUE_SIZE, workers=CALLBACK_WORKERS,
+                 batch_size=CALLBACK_BATCH_SIZE, enqueue_timeout=CALLBACK_ENQUEUE_TIMEOUT,
+                 retry_attempts=CALLBACK_RETRY_ATTEMPTS, retry_delay=CALLBACK_RETRY_DELAY):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_attempts = retry_attempts
+        self.retry_delay = retry_delay
+        self._queues = [queue.Queue(max(1, maxsize // workers)) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index, shard in enumerate(self._queues):
+                thread = threading.Thread(target=self._worker, args=(shard,),
+                                          name=f"callback-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind, form, key=None, timeout=None):
+        """Ставит callback в очередь; False, если очередь переполнена (backpressure)"""
+        self._ensure_workers()
+        shard = self._queues[zlib.crc32((key or "").encode('utf-8')) % len(self._queues)]
+        try:
+            shard.put((kind, form), timeout=self.enqueue_timeout if timeout is None else timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        depth = self.depth()
+        with self._lock:
+            self.enqueued += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _worker(self, shard):
+        while True:
+            items = [shard.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(shard.get_nowait())
+                except queue.Empty:
+                    break
+            # Метки barrier() (kind None) срабатывают после применения всего, что стояло перед ними
+            batch = [item for item in items if item[0] is not None]
+            ok = True
+            if batch:
+                # Обработчик идемпотентен (статусы перезаписываются, outbox — at-least-once), пачку можно повторить
+                for attempt in range(1, self.retry_attempts + 1):
+                    try:
+                        self.handler(batch)
+                        ok = True
+                        break
+                    except Exception as e:
+                        ok = False
+                        log_message(f"❌ Ошибка обработки пачки callback'ов: {e}", level="ERROR", attempt=attempt,
+                                    callbacks=len(batch))
+                        if attempt < self.retry_attempts:
+                            with self._lock:
+                                self.retries += 1
+                            time.sleep(self.retry_delay * attempt)
+                with self._lock:
+                    if ok:
+                        self.processed += len(batch)
+                    else:
+                        self.failed += len(batch)
+                    self.batches += 1
+            for kind, payload in items:
+                if kind is None:
+                    payload.set()
+                shard.task_done()
+
+    def barrier(self, timeout=None):
+        """
+        Ждет применения всех callback'ов, принятых до вызова (в отличие от join(),
+        не ждет новых); False, если не дождались за timeout секунд.
+        """
+        self._ensure_workers()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        events = []
+        for shard in self._queues:
+            event = threading.Event()
+            try:
+                shard.put((None, event), timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Full:
+                return False
+            events.append(event)
+        for event in events:
+            if not event.wait(None if deadline is None else max(0, deadline - time.monotonic())):
+                return False
+        return True
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._queues)
+
+    def after_fork(self):
+        # Обработчики остались в родителе: пустые очереди, потоки запустятся при первом submit
+        self._queues = [queue.Queue(shard.maxsize) for shard in self._queues]
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def join(self):
+        """Ждет, пока все принятые callback'и будут применены"""
+        for shard in self._queues:
+            shard.join()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "capacity": sum(shard.maxsize for shard in self._queues),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "retries": self.retries,
+            "batches": self.batches,
+            "avg_batch_size": round(self.processed / self.batches, 2) if self.batches else 0,
+            "workers": len(self._threads),
+        }
+
+def apply_callbacks(batch):
+    """Применяет пачку callback'ов (kind, form) к хранилищу статусов"""
+    updates = []
+    for kind, form in batch:
+        pg_order_id = form.get('pg_order_id')
+        route = f"/{kind}"
+        log_message(f"▶ {kind.upper()}", level="DEBUG", route=route, form=form)
+        
+        if kind == "check":
+            # Инициализируем статус как "pending" если его еще нет
+            if pg_order_id and payment_statuses.insert_if_absent(pg_order_id, "pending"):
+                log_message("📝 Создан статус 'pending'", route=route, order_id=pg_order_id)
+            continue
+        
+        pg_result = form.get('pg_result')
+        pg_payment_id = form.get('pg_payment_id')
+        
+        # Повторный callback без pg_order_id находим по индексу pg_payment_id
+        if not pg_order_id and pg_payment_id:
+            record = payment_statuses.find_by_payment_id(pg_payment_id)
+            if record:
+                pg_order_id = record["order_id"]
+        
+        if not pg_order_id:
+            log_message("⚠️ RESULT без Order ID, статус не сохранен", level="WARNING", route=route,
+                        payment_id=pg_payment_id)
+        elif pg_result == "1":
+            log_message("✅ Платеж успешен", route=route, order_id=pg_order_id, payment_id=pg_payment_id)
+            updates.append((pg_order_id, "success", pg_payment_id))
+        else:
+            log_message("❌ Платеж не прошел", route=route, order_id=pg_order_id, payment_id=pg_payment_id,
+                        pg_result=pg_result)
+            updates.append((pg_order_id, "failed", pg_payment_id))
+    
+    set_payment_statuses(updates)
+    # Повторы отвечаем из кеша только для примененных callback'ов: при ошибке выше
+    # FreedomPay повторит /result, и он будет обработан заново
+    for kind, form in batch:
+        dedup_key = callback_dedup_key(kind, form)
+        if dedup_key is not None:
+            callback_dedup.put(dedup_key, ("OK", 200))
+
+def replay_callbacks(batch, store):
+    """
+    Применение callback'ов из журнала при запуске: то же, что apply_callbacks, но без логов
+    на каждый callback. Переходы статусов публикуются: callback, принятый, но не примененный
+    до падения, должен дойти до подписчиков webhook'ов.
+    """
+    updates = []
+    for kind, form in batch:
+        order_id = form.get('pg_order_id')
+        if kind == "check":
+            if order_id:
+                store.insert_if_absent(order_id, "pending")
+            continue
+        payment_id = form.get('pg_payment_id')
+        if not order_id and payment_id:
+            # Поиск по pg_payment_id должен видеть изменения, накопленные выше в этой пачке
+            write_statuses(store, updates)
+            updates = []
+            record = store.find_by_payment_id(payment_id)
+            order_id = record["order_id"] if record else None
+        if order_id:
+            updates.append((order_id, "success" if form.get('pg_result') == "1" else "failed", payment_id))
+    write_statuses(store, updates)
+
+callback_queue = CallbackQueue(apply_callbacks)
+atexit.register(callback_queue.join)
+register_stats("callback_queue", callback_queue.stats)
+
+# Повторы /result от FreedomPay: отвечаем из кеша, не проверяя подпись и не трогая хранилище
+CALLBACK_DEDUP_SIZE = 10000   # последних уникальных callback'ов
+CALLBACK_DEDUP_TTL = 3600     # секунд (FreedomPay повторяет callback в течение часа)
+
+callback_dedup = TTLCache(CALLBACK_DEDUP_SIZE, CALLBACK_DEDUP_TTL)
+register_stats("callback_dedup", callback_dedup.stats)
+
+def callback_dedup_key(kind, form):
+    """Ключ кеша повторов для /result с pg_payment_id, иначе None"""
+    if kind == "result" and form.get('pg_payment_id'):
+        return form['pg_payment_id'], form.get('pg_result'), form.get('pg_sig')
+    return None
+
+# Журнал принятых callback'ов: сегменты с CRC32 на каждую запись и периодические снимки.
+# Принятый (ответ "OK") callback не теряется при падении до применения, а хранилище
+# "memory" восстанавливается из снимка и хвоста журнала.
+JOURNAL_DIR = os.environ.get("FREEDOMPAY_JOURNAL_DIR")  # не задан — журнал выключен
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024  # байт, после которых начинается новый сегмент
+JOURNAL_FSYNC = os.environ.get("FREEDOMPAY_JOURNAL_FSYNC") == "1"  # fsync каждой записи, иначе — при ротации
+JOURNAL_SNAPSHOT_INTERVAL = 300          # секунд между снимками (контрольными точками)
+JOURNAL_SNAPSHOT_CHUNK = 10000           # заказов в одной записи снимка
+JOURNAL_REPLAY_BATCH = 10000             # callback'ов за одно применение при восстановлении
+JOURNAL_BARRIER_TIMEOUT = 30             # секунд ждем применения очереди перед снимком
+JOURNAL_FRAME = struct.Struct("<II")     # длина и CRC32 записи
+
+class CallbackJournal:
+    """
+    Append-only журнал callback'ов: файлы segment-<N>.log из записей [длина, CRC32, JSON].
+    Контрольная точка начинает сегмент N, дожидается применения всего принятого раньше
+    и пишет snapshot-<N>.snap (для хранилища в памяти) — после этого сегменты < N не нужны.
+    При запуске загружается последний снимок и через mmap проигрываются сегменты после него;
+    недописанная или битая запись в конце сегмента отбрасывается.
+    """
+
+    def __init__(self, directory, segment_size=JOURNAL_SEGMENT_SIZE, fsync=JOURNAL_FSYNC,
+                 snapshot_interval=JOURNAL_SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.Lock()
+        # Записано в журнал, но еще не передано в очередь: {сегмент: число callback'ов}
+        self._inflight = {}
+        self._inflight_done = threading.Condition(self._lock)
+        self._checkpoint_lock = threading.Lock()
+        self._file = None
+        self._segment = 0
+        self._segment_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.appended = 0
+        self.appended_since_checkpoint = 0
+        self.checkpoints = 0
+        self.last_checkpoint = None
+        self.last_recovery = None
+
+    def _path(self, prefix, number, suffix):
+        return os.path.join(self.directory, f"{prefix}-{number:08d}.{suffix}")
+
+    def _files(self, prefix, suffix):
+        """Отсортированные номера файлов prefix-<N>.suffix"""
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix + "-") and name.endswith("." + suffix):
+                with contextlib.suppress(ValueError):
+                    numbers.append(int(name[len(prefix) + 1:-len(suffix) - 1]))
+        return sorted(numbers)
+
+    def _open_segment(self, number):
+        """Под self._lock: закрывает текущий сегмент и начинает segment-<number>"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._segment = number
+        self._file = open(self._path("segment", number, "log"), "ab")
+        self._segment_bytes = self._file.tell()
+
+    def append(self, kind, form, inflight=False):
+        """
+        Дописывает принятый callback; возвращает номер сегмента с записью.
+        inflight=True — запись сразу считается непереданной в очередь (см. recording).
+        """
+        payload = json.dumps([kind, form], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        frame = JOURNAL_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                self._open_segment(self._segment + 1)
+            elif self._segment_bytes >= self.segment_size:
+                self._open_segment(self._segment + 1)
+            self._file.write(frame)
+            # flush — запись переживает падение процесса; fsync — и падение машины
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._segment_bytes += len(frame)
+            self.appended += 1
+            self.appended_since_checkpoint += 1
+            if inflight:
+                # В той же критической секции, что и запись: иначе контрольная точка могла бы
+                # вклиниться между ними и не увидеть этот callback
+                self._inflight[self._segment] = self._inflight.get(self._segment, 0) + 1
+            return self._segment
+
+    @contextlib.contextmanager
+    def recording(self, kind, form):
+        """
+        Запись callback'а и его постановка в очередь внутри with: пока блок не завершен,
+        контрольная точка не удалит сегмент — иначе между append и submit барьер очереди
+        пропустил бы callback, о котором FreedomPay уже получил OK.
+        """
+        segment = self.append(kind, form, inflight=True)
+        try:
+            yield segment
+        finally:
+            with self._lock:
+                self._inflight[segment] -= 1
+                if not self._inflight[segment]:
+                    del self._inflight[segment]
+                    self._inflight_done.notify_all()
+
+    @staticmethod
+    def read_frames(path):
+        """Записи файла через mmap; возвращает (список payload, смещение первой битой записи или None)"""
+        payloads = []
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return payloads, None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                header = JOURNAL_FRAME.size
+                while offset < size:
+                    if offset + header > size:
+                        return payloads, offset
+                    length, crc = JOURNAL_FRAME.unpack_from(mm, offset)
+                    end = offset + header + length
+                    if end > size:
+                        return payloads, offset
+                    payload = mm[offset + header:end]
+                    if zlib.crc32(payload) != crc:
+                        return payloads, offset
+                    payloads.append(payload)
+                    offset = end
+        return payloads, None
+
+    def recover(self, store, replay_batch=JOURNAL_REPLAY_BATCH):
+        """Снимок (для хранилища в памяти) + хвост журнала; вызывается до приема запросов"""
+        os.makedirs(self.directory, exist_ok=True)
+        # Миллионы новых записей запускали бы циклический GC снова и снова по всей растущей куче
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._recover(store, replay_batch)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _recover(self, store, replay_batch):
+        started = time.perf_counter()
+        stats = {"snapshot": None, "snapshot_orders": 0, "segments": 0, "callbacks": 0, "truncated": 0}
+        first_segment = 0
+        if not store.persistent:
+            for number in reversed(self._files("snapshot", "snap")):
+                chunks, bad_offset = self.read_frames(self._path("snapshot", number, "snap"))
+                if bad_offset is not None:
+                    log_message("⚠️ Снимок журнала поврежден, берем предыдущий", level="WARNING", snapshot=number)
+                    continue
+                for chunk in chunks:
+                    rows = json.loads(chunk)
+                    store.load_records(rows)
+                    stats["snapshot_orders"] += len(rows)
+                stats["snapshot"] = number
+                first_segment = number
+                break
+        segments = [number for number in self._files("segment", "log") if number >= first_segment]
+        for number in segments:
+            path = self._path("segment", number, "log")
+            payloads, bad_offset = self.read_frames(path)
+            for start in range(0, len(payloads), replay_batch):
+                # Один json.loads на пачку: записи — JSON-массивы, склеиваем их в массив массивов
+                batch = json.loads(b"[" + b",".join(payloads[start:start + replay_batch]) + b"]")
+                replay_callbacks(batch, store)
+            stats["segments"] += 1
+            stats["callbacks"] += len(payloads)
+            if bad_offset is not None:
+                # Хвост, не дописанный при падении: обрезаем, чтобы новые записи не оказались за мусором
+                with open(path, "r+b") as f:
+                    stats["truncated"] += os.fstat(f.fileno()).st_size - bad_offset
+                    f.truncate(bad_offset)
+                log_message("⚠️ Журнал: недописанная запись отброшена", level="WARNING", segment=number,
+                            offset=bad_offset)
+        store.flush()
+        with self._lock:
+            # Новые записи идут в новый сегмент: старые остаются ровно такими, как их проиграли
+            self._segment = max(segments + [first_segment, 0])
+            self._open_segment(self._segment + 1)
+        stats["seconds"] = round(time.perf_counter() - started, 3)
+        self.last_recovery = stats
+        log_message("📼 Журнал callback'ов восстановлен", **stats)
+        return stats
+
+    def checkpoint(self, store, callbacks):
+        """Контрольная точка: новый сегмент, применение очереди, снимок, удаление старых файлов"""
+        with self._checkpoint_lock:
+            started = time.perf_counter()
+            with self._lock:
+                self._open_segment(self._segment + 1)
+                boundary = self._segment
+                self.appended_since_checkpoint = 0
+                # Новые записи идут в boundary; ждем, пока записанное раньше дойдет до очереди
+                handed_over = self._inflight_done.wait_for(
+                    lambda: not any(segment < boundary for segment in self._inflight), JOURNAL_BARRIER_TIMEOUT)
+            if not handed_over or callbacks is not None and not callbacks.barrier(JOURNAL_BARRIER_TIMEOUT):
+                log_message("⚠️ Контрольная точка журнала отложена: очередь callback'ов не применена",
+                            level="WARNING")
+                return None
+            orders = 0
+            if store.persistent:
+                store.flush()
+            else:
+                path = self._path("snapshot", boundary, "snap")
+                with open(path + ".tmp", "wb") as f:
+                    records = store.dump_records()
+                    orders = len(records)
+                    for start in range(0, len(records), JOURNAL_SNAPSHOT_CHUNK):
+                        payload = json.dumps([[record["order_id"], record["status"], record["payment_id"],
+                                               record["created_at"], record["updated_at"]]
+                                              for record in records[start:start + JOURNAL_SNAPSHOT_CHUNK]],
+                                             ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                        f.write(JOURNAL_FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + ".tmp", path)
+            for number in self._files("segment", "log"):
+                if number < boundary:
+                    os.remove(self._path("segment", number, "log"))
+            for number in self._files("snapshot", "snap"):
+                if number < boundary:
+                    os.remove(self._path("snapshot", number, "snap"))
+            self.checkpoints += 1
+            self.last_checkpoint = {"segment": boundary, "orders": orders,
+                                    "seconds": round(time.perf_counter() - started, 3),
+                                    "at": datetime.now().isoformat(timespec="seconds")}
+            return self.last_checkpoint
+
+    def start(self, store, callbacks):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(store, callbacks), name="callback-journal",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self, store, callbacks):
+        while not self._stop.wait(self.snapshot_interval):
+            if not self.appended_since_checkpoint:
+                continue
+            try:
+                self.checkpoint(store, callbacks)
+            except Exception as e:
+                log_message("⚠️ Ошибка контрольной точки журнала", level="WARNING", error=str(e))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def after_fork(self):
+        # Файл сегмента родителя не наш: дочерний процесс откроет свой при recover()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_done = threading.Condition(self._lock)
+        self._checkpoint_lock = threading.Lock()
+        self._file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stats(self):
+        stats = {"directory": self.directory, "segment": self._segment, "segment_bytes": self._segment_bytes,
+                 "appended": self.appended, "since_checkpoint": self.appended_since_checkpoint,
+                 "checkpoints": self.checkpoints, "last_checkpoint": self.last_checkpoint,
+                 "last_recovery": self.last_recovery, "running": self._thread is not None}
+        if os.path.isdir(self.directory):
+            stats["segments"] = len(self._files("segment", "log"))
+        return stats
+
+callback_journal = None
+if JOURNAL_DIR:
+    callback_journal = CallbackJournal(JOURNAL_DIR)
+    register_stats("callback_journal", callback_journal.stats)
+    atexit.register(callback_journal.close)
+
+# Рассылка финальных статусов внутренним системам (выдача заказа, разблокировка AR-контента).
+# События попадают в SQLite-outbox в той же пачке, в которой применяются callback'и, а доставку
+# ведут отдельные потоки каждого подписчика: медленный подписчик не задерживает ни /result, ни других.
+WEBHOOK_URLS = [url.strip() for url in os.environ.get("FREEDOMPAY_WEBHOOK_URLS", "").split(",") if url.strip()]
+WEBHOOK_OUTBOX_PATH = os.environ.get("FREEDOMPAY_WEBHOOK_OUTBOX", "webhook_outbox.db")
+WEBHOOK_SECRET = os.environ.get("FREEDOMPAY_WEBHOOK_SECRET")  # ключ HMAC-SHA256 тела, не задан — без подписи
+WEBHOOK_STATUSES = ("success", "failed")  # о каких статусах узнают подписчики
+WEBHOOK_BATCH_SIZE = 100        # событий в одном POST
+WEBHOOK_SENDERS = 2             # потоков доставки (и keep-alive соединений) на подписчика
+WEBHOOK_POLL_INTERVAL = 1.0     # секунд между проверками outbox без новых событий (повторы, другие воркеры)
+WEBHOOK_LEASE = 30              # секунд пачка закреплена за отправителем; упал — ее заберет другой
+WEBHOOK_TIMEOUT = (2, 10)       # (connect, read) секунд на POST подписчику
+WEBHOOK_RETRY_BASE = 1.0        # секунд до первого повтора, дальше пауза удваивается
+WEBHOOK_RETRY_MAX = 600         # секунд, потолок паузы между повторами
+WEBHOOK_MAX_ATTEMPTS = 20       # попыток, после которых событие остается в outbox как "dead"
+
+class WebhookOutbox:
+    """
+    Outbox событий смены статуса в SQLite: строка на каждую пару (событие, подписчик).
+    publish() пишет пачку одной транзакцией. Отправители забирают до batch_size готовых
+    строк одним UPDATE ... RETURNING, продлевая next_attempt на lease (так пачку не возьмет
+    второй поток или воркер pre-fork), и шлют их одним POST {"events": [...]} через общую
+    сессию с keep-alive. Ответ 2xx удаляет строки, остальное — повтор с экспоненциальной
+    паузой и jitter (не меньше Retry-After). Доставка "хотя бы один раз" и без строгого порядка:
+    подписчик отличает повтор по (order_id, status).
+    """
+
+    def __init__(self, path, subscribers, secret=WEBHOOK_SECRET, batch_size=WEBHOOK_BATCH_SIZE,
+                 senders=WEBHOOK_SENDERS, poll_interval=WEBHOOK_POLL_INTERVAL, lease=WEBHOOK_LEASE,
+                 timeout=WEBHOOK_TIMEOUT, retry_base=WEBHOOK_RETRY_BASE, retry_max=WEBHOOK_RETRY_MAX,
+                 max_attempts=WEBHOOK_MAX_ATTEMPTS):
+        self.path = path
+        self.subscribers = list(subscribers)
+        self.secret = secret
+        self.batch_size = batch_size
+        self.senders = senders
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.timeout = timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self._wakeups = {url: threading.Event() for url in self.subscribers}
+        self._stop = threading.Event()
+        self._threads = []
+        self.session = self._build_session()
+        self.published = 0
+        self.publish_errors = 0
+        self.counters = {url: {"posts": 0, "delivered": 0, "retries": 0, "dead": 0, "last_error": None}
+                         for url in self.subscribers}
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS webhook_outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        subscriber TEXT NOT NULL,
+                        order_id TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        payment_id TEXT,
+                        created_at REAL NOT NULL,
+                        next_attempt REAL NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        dead INTEGER NOT NULL DEFAULT 0,
+                        last_error TEXT
+                    );
+                    CREATE INDEX IF NOT EXISTS webhook_outbox_due ON webhook_outbox(subscriber, dead, next_attempt);
+                """)
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _build_session(self):
+        session = requests.Session()
+        session.headers["User-Agent"] = PROBE_USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(len(self.subscribers), 1),
+                                                pool_maxsize=self.senders)
+        for scheme in ("http://", "https://"):
+            session.mount(scheme, adapter)
+        return session
+
+    def publish(self, updates):
+        """Ставит события по финальным статусам из updates (order_id, status, payment_id) в outbox"""
+        events = [update for update in updates if update[1] in WEBHOOK_STATUSES]
+        if not events or not self.subscribers:
+            return 0
+        now = time.time()
+        rows = [(url, order_id, status, payment_id, now, now)
+                for url in self.subscribers for order_id, status, payment_id in events]
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT INTO webhook_outbox (subscriber, order_id, status, payment_id, "
+                                 "created_at, next_attempt) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # Исключение дальше: статусы еще не записаны, пачка будет повторена (write_statuses)
+            with self._lock:
+                self.publish_errors += len(rows)
+            log_message("❌ Outbox: события не записаны", level="ERROR", events=len(rows), error=str(e))
+            raise
+        with self._lock:
+            self.published += len(rows)
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        return len(rows)
+
+    def claim(self, url, now=None):
+        """Забирает до batch_size готовых к отправке событий подписчика на lease секунд"""
+        now = now or time.time()
+        rows = self._connection().execute("""
+            UPDATE webhook_outbox SET next_attempt = ? WHERE id IN (
+                SELECT id FROM webhook_outbox
+                WHERE subscriber = ? AND dead = 0 AND next_attempt <= ?
+                ORDER BY id LIMIT ?)
+            RETURNING id, order_id, status, payment_id, created_at, attempts
+        """, (now + self.lease, url, now, self.batch_size)).fetchall()
+        return sorted(rows)
+
+    def retry_delay(self, attempts):
+        """Пауза перед попыткой attempts + 1: base * 2^attempts с jitter, не больше retry_max"""
+        return min(self.retry_max, self.retry_base * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+    def post(self, url, rows):
+        """Один POST пачки; возвращает (None, 0) при успехе или (ошибка, Retry-After в секундах)"""
+        body = json.dumps({"events": [{"id": row[0], "order_id": row[1], "status": row[2], "payment_id": row[3],
+                                       "created_at": row[4]} for row in rows]},
+                          ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-FreedomPay-Signature"] = hmac.new(self.secret.encode("utf-8"), body,
+                                                         hashlib.sha256).hexdigest()
+        started = time.perf_counter()
+        try:
+            response = self.session.post(url, data=body, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            return str(e) or type(e).__name__, 0
+        finally:
+            WEBHOOK_LATENCY.observe(time.perf_counter() - started, url)
+        if 200 <= response.status_code < 300:
+            return None, 0
+        retry_after = response.headers.get("Retry-After", "")
+        return f"HTTP {response.status_code}", float(retry_after) if retry_after.isdigit() else 0
+
+    def deliver_once(self, url):
+        """Одна пачка подписчику; возвращает число взятых событий (0 — отправлять нечего)"""
+        rows = self.claim(url)
+        if not rows:
+            return 0
+        error, retry_after = self.post(url, rows)
+        conn = self._connection()
+        counters = self.counters[url]
+        if error is None:
+            conn.execute(f"DELETE FROM webhook_outbox WHERE id IN ({','.join('?' * len(rows))})",
+                         [row[0] for row in rows])
+            WEBHOOK_DELIVERIES.inc(url, "delivered", amount=len(rows))
+            with self._lock:
+                counters["posts"] += 1
+                counters["delivered"] += len(rows)
+            return len(rows)
+        now = time.time()
+        retries = [(now + max(self.retry_delay(row[5]), retry_after), row[5] + 1 >= self.max_attempts, error, row[0])
+                   for row in rows]
+        conn.executemany("UPDATE webhook_outbox SET next_attempt = ?, attempts = attempts + 1, dead = ?, "
+                         "last_error = ? WHERE id = ?", retries)
+        dead = sum(1 for retry in retries if retry[1])
+        WEBHOOK_DELIVERIES.inc(url, "retry", amount=len(rows) - dead)
+        if dead:
+            WEBHOOK_DELIVERIES.inc(url, "dead", amount=dead)
+            log_message("❌ Webhook: события исчерпали попытки", level="ERROR", subscriber=url, events=dead,
+                        error=error)
+        with self._lock:
+            counters["posts"] += 1
+            counters["retries"] += len(rows) - dead
+            counters["dead"] += dead
+            counters["last_error"] = error
+        log_message("⚠️ Webhook: подписчик не принял пачку", level="WARNING", subscriber=url, events=len(rows),
+                    error=error)
+        return len(rows)
+
+    def start(self):
+        if not self._threads:
+            self._stop.clear()
+            for url in self.subscribers:
+                for index in range(self.senders):
+                    thread = threading.Thread(target=self._run, args=(url,), name=f"webhook-{index}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+
+    def _run(self, url):
+        wakeup = self._wakeups[url]
+        while not self._stop.is_set():
+            try:
+                # Полная пачка — в outbox есть еще, берем следующую сразу; иначе ждем новых событий
+                if self.deliver_once(url) >= self.batch_size:
+                    continue
+            except Exception as e:
+                log_message("⚠️ Ошибка доставки webhook", level="WARNING", subscriber=url, error=str(e))
+            wakeup.wait(self.poll_interval)
+            wakeup.clear()
+
+    def backlog(self):
+        """Неотправленные и "dead" события по подписчикам и возраст самого старого неотправленного"""
+        now = time.time()
+        rows = self._connection().execute(
+            "SELECT subscriber, SUM(dead = 0), SUM(dead), MIN(CASE WHEN dead = 0 THEN created_at END) "
+            "FROM webhook_outbox GROUP BY subscriber").fetchall()
+        return {url: {"pending": pending, "dead": dead,
+                      "oldest_seconds": round(now - oldest, 1) if oldest is not None else None}
+                for url, pending, dead, oldest in rows}
+
+    def close(self):
+        self.stop()
+        self.session.close()
+
+    def after_fork(self):
+        # Соединения SQLite и keep-alive родителя дочернему процессу не годятся
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeups = {url: threading.Event() for url in self.subscribers}
+        self._stop = threading.Event()
+        self._threads = []
+        self.session = self._build_session()
+
+    def stats(self):
+        backlog = self.backlog()
+        with self._lock:
+            subscribers = {url: dict(counters, **backlog.get(url, {"pending": 0, "dead": 0, "oldest_seconds": None}))
+                           for url, counters in self.counters.items()}
+            return {"path": self.path, "published": self.published, "publish_errors": self.publish_errors,
+                    "running": bool(self._threads), "subscribers": subscribers}
+
+webhook_outbox = None
+if WEBHOOK_URLS:
+    webhook_outbox = WebhookOutbox(WEBHOOK_OUTBOX_PATH, WEBHOOK_URLS)
+    register_stats("webhooks", webhook_outbox.stats)
+    atexit.register(webhook_outbox.close)
+
+
+def accept_callback(kind):
+    """Проверка подписи и постановка callback'а в очередь; ответ FreedomPay сразу"""
+    return process_callback(kind, request.form.to_dict())
+
+def process_callback(kind, form, enqueue_timeout=None, route=None):
+    """
+    Общая часть /check и /result для Flask и ASGI режимов: (тело, код[, заголовки]).
+    enqueue_timeout=0 — не ждать места в очереди (для event loop).
+    """
+    pg_sig = form.get('pg_sig')
+    dedup_key = callback_dedup_key(kind, form)
+    if dedup_key is not None:
+        cached = callback_dedup.get(dedup_key)
+        if cached is not None:
+            return cached
     
-    # Проверяем подпись
-    pg_sig = request.form.get('pg_sig')
     if pg_sig:
-        if verify_signature(dict(request.form), pg_sig):
-            log_message("✅ Подпись CHECK корректна")
-        else:
-            log_message("❌ Некорректная подпись CHECK")
+        if not verify_signature(form, pg_sig):
+            SIGNATURE_CHECKS.inc(kind, "fail")
+            log_message(f"❌ Некорректная подпись {kind.upper()}", level="WARNING", route=route)
             return "ERROR", 400
+        SIGNATURE_CHECKS.inc(kind, "pass")
     else:
-        log_message("⚠️ Подпись CHECK отсутствует")
-    
-    # Проверяем order_id и amount
-    pg_order_id = request.form.get('pg_order_id')
-    pg_amount = request.form.get('pg_amount')
+        SIGNATURE_CHECKS.inc(kind, "missing")
+        log_message(f"⚠️ Подпись {kind.upper()} отсутствует", level="WARNING", route=route)
     
-    log_message(f"🆔 Order ID: {pg_order_id}")
-    log_message(f"💰 Amount: {pg_amount} UZS")
-    
-    # Инициализируем статус как "pending" если его еще нет
-    if pg_order_id and pg_order_id not in payment_statuses:
-        payment_statuses[pg_order_id] = "pending"
-        log_message(f"📝 Создан статус 'pending' для Order ID: {pg_order_id}")
+    recording = callback_journal.recording(kind, form) if callback_journal is not None else contextlib.nullcontext()
+    with recording:
+        accepted = callback_queue.submit(kind, form, key=form.get('pg_order_id') or form.get('pg_payment_id'),
+                                         timeout=enqueue_timeout)
+    if not accepted:
+        log_message(f"⚠️ Очередь callback'ов переполнена, {kind.upper()} отклонен", level="WARNING", route=route)
+        return "BUSY", 503, {"Retry-After": "1"}
     
     # Здесь должна быть проверка существования заказа в вашей БД
-    # Пока возвращаем OK для всех запросов
+    # Пока возвращаем OK для всех запросов; в кеш повторов ответ попадет после применения (apply_callbacks)
     return "OK", 200
 
+@app.route('/check', methods=['POST'])
+def check():
+    return accept_callback("check")
+
 @app.route('/result', methods=['POST'])
 def result():
-    log_message("▶ RESULT запрос получен")
-    log_message(f"📨 Данные: {dict(request.form)}")
-    
-    # Проверяем подпись
-    pg_sig = request.form.get('pg_sig')
-    if pg_sig:
-        if verify_signature(dict(request.form), pg_sig):
-            log_message("✅ Подпись RESULT корректна")
-        else:
-            log_message("❌ Некорректная подпись RESULT")
-            return "ERROR", 400
-    else:
-        log_message("⚠️ Подпись RESULT отсутствует")
-    
-    # Обрабатываем результат платежа
-    pg_result = request.form.get('pg_result')
-    pg_payment_id = request.form.get('pg_payment_id')
-    pg_order_id = request.form.get('pg_order_id')
-    pg_amount = request.form.get('pg_amount')
-    
-    log_message(f"🆔 Order ID: {pg_order_id}")
-    log_message(f"💳 Payment ID: {pg_payment_id}")
-    log_message(f"💰 Amount: {pg_amount} UZS")
-    
-    if pg_result == "1":
-        log_message(f"✅ Платеж успешен! Payment ID: {pg_payment_id}")
-        # Здесь должно быть обновление статуса заказа в БД
-        payment_statuses[pg_order_id] = "success"
-    else:
-        log_message(f"❌ Платеж не прошел. Результат: {pg_result}")
-        # Здесь должна быть обработка неуспешного платежа
-        payment_statuses[pg_order_id] = "failed"
-    
-    return "OK", 200
+    return accept_callback("result")
+
+compile_template("success", '''
+    <h2>✅ Платеж прошёл успешно!</h2>
+    <p>Спасибо за покупку!</p>
+    <p><a href="/">← Новый платеж</a></p>
+''')
 
 @app.route('/success', methods=['GET', 'POST'])
 def success():
@@ -422,17 +3353,19 @@ def success():
             # Получаем order_id из формы
             pg_order_id = request.form.get('pg_order_id')
             if pg_order_id:
-                payment_statuses[pg_order_id] = "success"
+                set_payment_status(pg_order_id, "success")
                 log_message(f"✅ Установлен статус 'success' для Order ID: {pg_order_id}")
         
         return "OK", 200
     
     # GET запрос - показываем страницу
-    return render_template_string('''
-        <h2>✅ Платеж прошёл успешно!</h2>
-        <p>Спасибо за покупку!</p>
-        <p><a href="/">← Новый платеж</a></p>
-    ''')
+    return render_cached_page("success", None)
+
+compile_template("fail", '''
+    <h2>❌ Платеж не прошёл или был отменён</h2>
+    <p>Попробуйте ещё раз или свяжитесь с поддержкой.</p>
+    <p><a href="/">← Попробовать снова</a></p>
+''')
 
 @app.route('/fail', methods=['GET', 'POST'])
 def fail():
@@ -445,24 +3378,54 @@ def fail():
         if request.form:
             pg_order_id = request.form.get('pg_order_id')
             if pg_order_id:
-                payment_statuses[pg_order_id] = "failed"
+                set_payment_status(pg_order_id, "failed")
                 log_message(f"❌ Установлен статус 'failed' для Order ID: {pg_order_id}")
         
         return "OK", 200
     
     # GET запрос - показываем страницу
-    return render_template_string('''
-        <h2>❌ Платеж не прошёл или был отменён</h2>
-        <p>Попробуйте ещё раз или свяжитесь с поддержкой.</p>
-        <p><a href="/">← Попробовать снова</a></p>
-    ''')
+    return render_cached_page("fail", None)
 
 # Добавляем route для диагностики ошибки 10000
-@app.route('/diagnose')
-def diagnose():
-    """Диагностика проблем с ошибкой 10000"""
-    log_message("🩺 Начинаем диагностику ошибки 10000...")
+compile_template("diagnose", '''
+    <h2>🩺 Диагностика ошибки 10000</h2>
+    <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px;">{{ results }}</pre>
+    
+    <h3>📋 Рекомендации:</h3>
+    <ol>
+        <li>Если все серверы недоступны - проблема в сети</li>
+        <li>Если POST возвращает 10000 - проблема в учетных данных</li>
+        <li>Проверьте в личном кабинете FreedomPay:
+            <ul>
+                <li>Статус аккаунта (активен/заблокирован)</li>
+                <li>Тестовый режим включен</li>
+                <li>Валюта UZS активна</li>
+                <li>Callback URLs настроены</li>
+            </ul>
+        </li>
+    </ol>
+    
+    <p><a href="/">← Главная</a> | <a href="/test">🧪 Тест подключения</a></p>
+''')
+
+def diagnose_test_request():
+    """Тестовый запрос payment.php для /diagnose: (параметры, подпись, строка подписи)"""
+    test_params = {
+        "pg_merchant_id": MERCHANT_ID,
+        "pg_amount": "1000",
+        "pg_currency": "UZS",
+        "pg_order_id": "test_123",
+        "pg_testing_mode": "1"
+    }
     
+    signature, sign_string = generate_correct_signature(test_params, "payment.php", SECRET_KEY)
+    return test_params, signature, sign_string
+
+def diagnose_results(post_outcome, refresh=False):
+    """
+    Строки отчета /diagnose. post_outcome — результат тестового POST на шлюз:
+    (код, тело ответа) или исключение; сам запрос делает вызывающий (sync или async клиент).
+    """
     results = []
     
     # 1. Проверка базовых параметров
@@ -473,50 +3436,41 @@ def diagnose():
     
     # 2. Тест подписи
     results.append("\n=== ТЕСТ ПОДПИСИ ===")
-    test_params = {
-        "pg_merchant_id": MERCHANT_ID,
-        "pg_amount": "1000",
-        "pg_currency": "UZS",
-        "pg_order_id": "test_123",
-        "pg_testing_mode": "1"
-    }
-    
-    sorted_keys = sorted(test_params.keys())
-    sign_string = "payment.php;" + ";".join(f"{k}={test_params[k]}" for k in sorted_keys) + f";{SECRET_KEY}"
-    signature = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+    _, signature, sign_string = diagnose_test_request()
     
     results.append(f"Тестовая строка: {sign_string}")
     results.append(f"Тестовая подпись: {signature}")
     
     # 3. Тест доступности серверов
     results.append("\n=== ТЕСТ СЕРВЕРОВ ===")
-    all_endpoints = GATEWAY_URLS + ALTERNATIVE_ENDPOINTS
+    if refresh:
+        gateway_monitor.refresh()
+    else:
+        gateway_monitor.ensure_fresh()
     
-    for url in all_endpoints:
-        try:
-            response = requests.get(url, timeout=5)
-            results.append(f"✅ {url} - код: {response.status_code}")
-        except Exception as e:
-            results.append(f"❌ {url} - ошибка: {str(e)[:50]}...")
+    for row in gateway_monitor.snapshot():
+        if row["ok"]:
+            # Ответ 4xx — хост жив, но платежная страница там не обслуживается
+            mark = "✅" if probe_is_healthy(row) else "⚠️"
+            results.append(f"{mark} {row['url']} - код: {row['status']}{format_probe_timings(row)}"
+                           f"{format_health_age(row)}{format_breaker(row)}")
+        else:
+            results.append(f"❌ {row['url']} - ошибка: {row['error'][:50]}...{format_breaker(row)}")
     
     # 4. Тест POST запроса
     results.append("\n=== ТЕСТ POST ЗАПРОСА ===")
-    try:
-        post_data = test_params.copy()
-        post_data['pg_sig'] = signature
-        
-        response = requests.post("https://api.freedompay.uz/payment.php", data=post_data, timeout=10)
-        results.append(f"POST статус: {response.status_code}")
+    if isinstance(post_outcome, Exception):
+        results.append(f"❌ POST ошибка: {str(post_outcome)}")
+    else:
+        status_code, text = post_outcome
+        results.append(f"POST статус: {status_code}")
         
-        if "10000" in response.text:
+        if "10000" in text:
             results.append("❌ Получена ошибка 10000")
         else:
             results.append("✅ Ошибка 10000 не обнаружена")
             
-        results.append(f"Ответ: {response.text[:200]}...")
-        
-    except Exception as e:
-        results.append(f"❌ POST ошибка: {str(e)}")
+        results.append(f"Ответ: {text[:200]}...")
     
     # 5. Альтернативные методы
     results.append("\n=== АЛЬТЕРНАТИВНЫЕ МЕТОДЫ ===")
@@ -529,71 +3483,66 @@ def diagnose():
         "pg_order_id": "alt_test_123"
     }
     
-    alt_sorted = sorted(alt_params.keys())
-    alt_sign = "payment.php;" + ";".join(f"{k}={alt_params[k]}" for k in alt_sorted) + f";{SECRET_KEY}"
-    alt_signature = hashlib.md5(alt_sign.encode('utf-8')).hexdigest()
+    alt_signature = get_signer("payment.php", SECRET_KEY).sign(alt_params)
     
     results.append(f"Без testing_mode: {alt_signature}")
+    return results
+
+@app.route('/diagnose')
+def diagnose():
+    """Диагностика проблем с ошибкой 10000"""
+    log_message("🩺 Начинаем диагностику ошибки 10000...")
     
-    return render_template_string('''
-        <h2>🩺 Диагностика ошибки 10000</h2>
-        <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px;">{{ results }}</pre>
-        
-        <h3>📋 Рекомендации:</h3>
-        <ol>
-            <li>Если все серверы недоступны - проблема в сети</li>
-            <li>Если POST возвращает 10000 - проблема в учетных данных</li>
-            <li>Проверьте в личном кабинете FreedomPay:
-                <ul>
-                    <li>Статус аккаунта (активен/заблокирован)</li>
-                    <li>Тестовый режим включен</li>
-                    <li>Валюта UZS активна</li>
-                    <li>Callback URLs настроены</li>
-                </ul>
-            </li>
-        </ol>
-        
-        <p><a href="/">← Главная</a> | <a href="/test">🧪 Тест подключения</a></p>
-    ''', results='\\n'.join(results))
+    test_params, signature, _ = diagnose_test_request()
+    try:
+        response = gateway_session.post(GATEWAY_URLS[0], data=dict(test_params, pg_sig=signature))
+        post_outcome = (response.status_code, response.text)
+    except Exception as e:
+        post_outcome = e
+    
+    results = diagnose_results(post_outcome, refresh=bool(request.args.get("refresh")))
+    return render_page("diagnose", results='\\n'.join(results))
 
 # Улучшаем тестовый endpoint
+compile_template("test", '''
+    <h2>🧪 Тест подключения к FreedomPay</h2>
+    <h3>Результаты:</h3>
+    {% for result in results %}
+        <p style="font-family: monospace;">{{ result }}</p>
+    {% endfor %}
+    
+    <h3>📊 Дополнительные инструменты:</h3>
+    <p><a href="/diagnose">🩺 Диагностика ошибки 10000</a></p>
+    <p><a href="/">← Вернуться</a></p>
+''')
+
 @app.route('/test')
 def test():
     log_message("🧪 Тестирование подключения к FreedomPay...")
     
     results = []
-    all_endpoints = GATEWAY_URLS + ALTERNATIVE_ENDPOINTS
+    if request.args.get("refresh"):
+        gateway_monitor.refresh()
+    else:
+        gateway_monitor.ensure_fresh()
     
-    for url in all_endpoints:
-        try:
-            response = requests.head(url, timeout=5)
-            status = f"✅ Доступен (код: {response.status_code})"
-            
-            # Дополнительная проверка с GET
-            if response.status_code == 405:  # Method not allowed для HEAD
-                try:
-                    get_response = requests.get(url, timeout=5)
-                    status += f" | GET: {get_response.status_code}"
-                except:
-                    pass
-                    
-        except Exception as e:
-            status = f"❌ Недоступен: {str(e)[:50]}..."
-        
-        results.append(f"{url} - {status}")
-        log_message(f"{url} - {status}")
-    
-    return render_template_string('''
-        <h2>🧪 Тест подключения к FreedomPay</h2>
-        <h3>Результаты:</h3>
-        {% for result in results %}
-            <p style="font-family: monospace;">{{ result }}</p>
-        {% endfor %}
+    for row in gateway_monitor.snapshot():
+        if row["ok"]:
+            if probe_is_healthy(row):
+                status = f"✅ Доступен (код: {row['status']})"
+            else:
+                status = f"⚠️ Отвечает, но не годен для /pay (код: {row['status']})"
+            if row["get_status"] is not None:
+                status += f" | GET: {row['get_status']}"
+            status += format_probe_timings(row) + format_health_age(row)
+        else:
+            status = f"❌ Недоступен: {row['error'][:50]}..."
+        status += format_breaker(row)
         
-        <h3>📊 Дополнительные инструменты:</h3>
-        <p><a href="/diagnose">🩺 Диагностика ошибки 10000</a></p>
-        <p><a href="/">← Вернуться</a></p>
-    ''', results=results)
+        results.append(f"{row['url']} - {status}")
+        log_message(f"{row['url']} - {status}")
+    
+    return render_page("test", results=results)
 
 # Добавляем функцию поиска правильного SECRET_KEY
 def find_correct_secret_key():
@@ -643,6 +3592,49 @@ def find_correct_secret_key():
     log_message("❌ Правильный SECRET_KEY не найден среди вариантов")
     return None
 
+compile_template("find_secret_found", '''
+    <h2>✅ SECRET_KEY найден!</h2>
+    <p><strong>Правильный SECRET_KEY:</strong> <code>{{ secret_key }}</code></p>
+    
+    <h3>📝 Что делать дальше:</h3>
+    <ol>
+        <li>Скопируйте найденный ключ</li>
+        <li>Замените в коде строку: <br>
+            <code>SECRET_KEY = "{{ old_key }}"</code><br>
+            на<br>
+            <code>SECRET_KEY = "{{ secret_key }}"</code>
+        </li>
+        <li>Перезапустите сервер</li>
+        <li>Попробуйте платеж снова</li>
+    </ol>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
+compile_template("find_secret_missing", '''
+    <h2>❌ SECRET_KEY не найден</h2>
+    
+    <h3>🔑 Где найти правильный SECRET_KEY:</h3>
+    <ol>
+        <li><strong>Личный кабинет FreedomPay:</strong>
+            <ul>
+                <li>Войдите в <a href="https://merchant.freedompay.com/" target="_blank">merchant.freedompay.com</a></li>
+                <li>Найдите раздел "API" или "Интеграция"</li>
+                <li>Скопируйте SECRET_KEY (может называться "Секретный ключ" или "API Key")</li>
+            </ul>
+        </li>
+        <li><strong>Свяжитесь с поддержкой:</strong>
+            <ul>
+                <li>Email: support@freedompay.uz</li>
+                <li>Укажите MERCHANT_ID: {{ merchant_id }}</li>
+                <li>Попросите предоставить актуальный SECRET_KEY</li>
+            </ul>
+        </li>
+    </ol>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
 @app.route('/find_secret')
 def find_secret():
     """Route для поиска правильного SECRET_KEY"""
@@ -651,82 +3643,98 @@ def find_secret():
     correct_key = find_correct_secret_key()
     
     if correct_key:
-        return render_template_string('''
-            <h2>✅ SECRET_KEY найден!</h2>
-            <p><strong>Правильный SECRET_KEY:</strong> <code>{{ secret_key }}</code></p>
-            
-            <h3>📝 Что делать дальше:</h3>
-            <ol>
-                <li>Скопируйте найденный ключ</li>
-                <li>Замените в коде строку: <br>
-                    <code>SECRET_KEY = "{{ old_key }}"</code><br>
-                    на<br>
-                    <code>SECRET_KEY = "{{ secret_key }}"</code>
-                </li>
-                <li>Перезапустите сервер</li>
-                <li>Попробуйте платеж снова</li>
-            </ol>
-            
-            <p><a href="/">← Главная</a></p>
-        ''', secret_key=correct_key, old_key=SECRET_KEY)
+        return render_page("find_secret_found", secret_key=correct_key, old_key=SECRET_KEY)
     else:
-        return render_template_string('''
-            <h2>❌ SECRET_KEY не найден</h2>
-            
-            <h3>🔑 Где найти правильный SECRET_KEY:</h3>
-            <ol>
-                <li><strong>Личный кабинет FreedomPay:</strong>
-                    <ul>
-                        <li>Войдите в <a href="https://merchant.freedompay.com/" target="_blank">merchant.freedompay.com</a></li>
-                        <li>Найдите раздел "API" или "Интеграция"</li>
-                        <li>Скопируйте SECRET_KEY (может называться "Секретный ключ" или "API Key")</li>
-                    </ul>
-                </li>
-                <li><strong>Свяжитесь с поддержкой:</strong>
-                    <ul>
-                        <li>Email: support@freedompay.uz</li>
-                        <li>Укажите MERCHANT_ID: {{ merchant_id }}</li>
-                        <li>Попросите предоставить актуальный SECRET_KEY</li>
-                    </ul>
-                </li>
-            </ol>
-            
-            <p><a href="/">← Главная</a></p>
-        ''', merchant_id=MERCHANT_ID)
+        return render_page("find_secret_missing", merchant_id=MERCHANT_ID)
+
+compile_template("test_manual_key_form", '''
+    <h2>🔑 Тестирование SECRET_KEY вручную</h2>
+    
+    <h3>📋 Инструкция:</h3>
+    <ol>
+        <li>Войдите в <a href="https://merchant.freedompay.com/" target="_blank">личный кабинет FreedomPay</a></li>
+        <li>Найдите раздел "API", "Интеграция" или "Настройки"</li>
+        <li>Скопируйте SECRET_KEY (может называться "Секретный ключ", "API Key", "Ключ для подписи")</li>
+        <li>Вставьте его в форму ниже для тестирования</li>
+    </ol>
+    
+    <form method="post">
+        <h3>🧪 Тест SECRET_KEY:</h3>
+        <label>Введите SECRET_KEY из личного кабинета:</label><br>
+        <input type="text" name="test_key" placeholder="Вставьте SECRET_KEY сюда" style="width: 400px; padding: 5px;" required><br><br>
+        <button type="submit">Проверить ключ</button>
+    </form>
+    
+    <h3>📞 Если не можете найти SECRET_KEY:</h3>
+    <p>Свяжитесь с поддержкой FreedomPay:</p>
+    <ul>
+        <li><strong>Email:</strong> support@freedompay.uz</li>
+        <li><strong>Укажите MERCHANT_ID:</strong> {{ merchant_id }}</li>
+        <li><strong>Попросите:</strong> предоставить актуальный SECRET_KEY для Gateway API</li>
+    </ul>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
+compile_template("test_manual_key_valid", '''
+    <h2>🎉 Отлично! SECRET_KEY найден!</h2>
+    
+    <div style="background: #d4edda; padding: 15px; border-radius: 5px; margin: 10px 0;">
+        <h3>✅ Правильный SECRET_KEY:</h3>
+        <code style="background: white; padding: 5px; display: block; margin: 5px 0;">{{ test_key }}</code>
+    </div>
+    
+    <h3>📝 Что делать дальше:</h3>
+    <ol>
+        <li><strong>Скопируйте код ниже</strong> и замените в вашем файле:</li>
+    </ol>
+    
+    <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 10px 0;">
+        <h4>Замените строку:</h4>
+        <code>SECRET_KEY = "{{ old_key }}"</code>
+        <h4>На:</h4>
+        <code style="background: #d4edda; padding: 2px;">SECRET_KEY = "{{ test_key }}"</code>
+    </div>
+    
+    <h3>🚀 Перезапуск:</h3>
+    <ol start="2">
+        <li>Остановите сервер (Ctrl+C)</li>
+        <li>Перезапустите: <code>python freedom_pay_final_attempt.py</code></li>
+        <li>Попробуйте платеж снова!</li>
+    </ol>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
+compile_template("test_manual_key_invalid", '''
+    <h2>❌ Этот SECRET_KEY не подходит</h2>
+    
+    <div style="background: #f8d7da; padding: 15px; border-radius: 5px; margin: 10px 0;">
+        <h3>🔍 Результат проверки:</h3>
+        <p><strong>Ваш ключ:</strong> <code>{{ test_key }}</code></p>
+        <p><strong>Ожидаемая подпись:</strong> <code>cf5b280eccf239052039b0692208bce3</code></p>
+        <p><strong>Полученная подпись:</strong> <code>{{ test_signature }}</code></p>
+        <p><strong>Результат:</strong> ❌ Не совпадает</p>
+    </div>
+    
+    <h3>💡 Попробуйте:</h3>
+    <ul>
+        <li>Проверить, что скопировали полный ключ</li>
+        <li>Убрать лишние пробелы в начале/конце</li>
+        <li>Поискать ключ в других разделах кабинета</li>
+        <li>Связаться с поддержкой FreedomPay</li>
+    </ul>
+    
+    <p><a href="/test_manual_key">🔄 Попробовать другой ключ</a></p>
+    <p><a href="/">← Главная</a></p>
+''')
 
 @app.route('/test_manual_key', methods=['GET', 'POST'])
 def test_manual_key():
     """Ручное тестирование SECRET_KEY"""
     
     if request.method == 'GET':
-        return render_template_string('''
-            <h2>🔑 Тестирование SECRET_KEY вручную</h2>
-            
-            <h3>📋 Инструкция:</h3>
-            <ol>
-                <li>Войдите в <a href="https://merchant.freedompay.com/" target="_blank">личный кабинет FreedomPay</a></li>
-                <li>Найдите раздел "API", "Интеграция" или "Настройки"</li>
-                <li>Скопируйте SECRET_KEY (может называться "Секретный ключ", "API Key", "Ключ для подписи")</li>
-                <li>Вставьте его в форму ниже для тестирования</li>
-            </ol>
-            
-            <form method="post">
-                <h3>🧪 Тест SECRET_KEY:</h3>
-                <label>Введите SECRET_KEY из личного кабинета:</label><br>
-                <input type="text" name="test_key" placeholder="Вставьте SECRET_KEY сюда" style="width: 400px; padding: 5px;" required><br><br>
-                <button type="submit">Проверить ключ</button>
-            </form>
-            
-            <h3>📞 Если не можете найти SECRET_KEY:</h3>
-            <p>Свяжитесь с поддержкой FreedomPay:</p>
-            <ul>
-                <li><strong>Email:</strong> support@freedompay.uz</li>
-                <li><strong>Укажите MERCHANT_ID:</strong> {{ merchant_id }}</li>
-                <li><strong>Попросите:</strong> предоставить актуальный SECRET_KEY для Gateway API</li>
-            </ul>
-            
-            <p><a href="/">← Главная</a></p>
-        ''', merchant_id=MERCHANT_ID)
+        return render_page("test_manual_key_form", merchant_id=MERCHANT_ID)
     
     # POST - тестируем введенный ключ
     test_key = request.form.get('test_key', '').strip()
@@ -761,59 +3769,23 @@ def test_manual_key():
     
     if test_signature == expected_signature:
         # Ключ правильный!
-        return render_template_string('''
-            <h2>🎉 Отлично! SECRET_KEY найден!</h2>
-            
-            <div style="background: #d4edda; padding: 15px; border-radius: 5px; margin: 10px 0;">
-                <h3>✅ Правильный SECRET_KEY:</h3>
-                <code style="background: white; padding: 5px; display: block; margin: 5px 0;">{{ test_key }}</code>
-            </div>
-            
-            <h3>📝 Что делать дальше:</h3>
-            <ol>
-                <li><strong>Скопируйте код ниже</strong> и замените в вашем файле:</li>
-            </ol>
-            
-            <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 10px 0;">
-                <h4>Замените строку:</h4>
-                <code>SECRET_KEY = "{{ old_key }}"</code>
-                <h4>На:</h4>
-                <code style="background: #d4edda; padding: 2px;">SECRET_KEY = "{{ test_key }}"</code>
-            </div>
-            
-            <h3>🚀 Перезапуск:</h3>
-            <ol start="2">
-                <li>Остановите сервер (Ctrl+C)</li>
-                <li>Перезапустите: <code>python freedom_pay_final_attempt.py</code></li>
-                <li>Попробуйте платеж снова!</li>
-            </ol>
-            
-            <p><a href="/">← Главная</a></p>
-        ''', test_key=test_key, old_key=SECRET_KEY)
+        return render_page("test_manual_key_valid", test_key=test_key, old_key=SECRET_KEY)
     else:
         # Ключ неправильный
-        return render_template_string('''
-            <h2>❌ Этот SECRET_KEY не подходит</h2>
-            
-            <div style="background: #f8d7da; padding: 15px; border-radius: 5px; margin: 10px 0;">
-                <h3>🔍 Результат проверки:</h3>
-                <p><strong>Ваш ключ:</strong> <code>{{ test_key }}</code></p>
-                <p><strong>Ожидаемая подпись:</strong> <code>cf5b280eccf239052039b0692208bce3</code></p>
-                <p><strong>Полученная подпись:</strong> <code>{{ test_signature }}</code></p>
-                <p><strong>Результат:</strong> ❌ Не совпадает</p>
-            </div>
-            
-            <h3>💡 Попробуйте:</h3>
-            <ul>
-                <li>Проверить, что скопировали полный ключ</li>
-                <li>Убрать лишние пробелы в начале/конце</li>
-                <li>Поискать ключ в других разделах кабинета</li>
-                <li>Связаться с поддержкой FreedomPay</li>
-            </ul>
-            
-            <p><a href="/test_manual_key">🔄 Попробовать другой ключ</a></p>
-            <p><a href="/">← Главная</a></p>
-        ''', test_key=test_key, test_signature=test_signature)
+        return render_page("test_manual_key_invalid", test_key=test_key, test_signature=test_signature)
+
+compile_template("analyze_cabinet_url", '''
+    <h2>🔍 Анализ URL из личного кабинета</h2>
+    <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 12px;">{{ results }}</pre>
+    
+    <h3>💡 Если найдено совпадение:</h3>
+    <p>Используйте найденный вариант для обновления кода!</p>
+    
+    <h3>❌ Если совпадений нет:</h3>
+    <p>Возможно, FreedomPay использует другой алгоритм или есть скрытые параметры.</p>
+    
+    <p><a href="/">← Главная</a></p>
+''')
 
 @app.route('/analyze_cabinet_url')
 def analyze_cabinet_url():
@@ -919,18 +3891,20 @@ def analyze_cabinet_url():
         
         results.append(f"С ключом {key[:10]}...: {test_signature} {match}")
     
-    return render_template_string('''
-        <h2>🔍 Анализ URL из личного кабинета</h2>
-        <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 12px;">{{ results }}</pre>
-        
-        <h3>💡 Если найдено совпадение:</h3>
-        <p>Используйте найденный вариант для обновления кода!</p>
-        
-        <h3>❌ Если совпадений нет:</h3>
-        <p>Возможно, FreedomPay использует другой алгоритм или есть скрытые параметры.</p>
-        
-        <p><a href="/">← Главная</a></p>
-    ''', results='\\n'.join(results))
+    return render_page("analyze_cabinet_url", results='\\n'.join(results))
+
+compile_template("test_hash_algorithms", '''
+    <h2>🧪 Тестирование алгоритмов хеширования</h2>
+    <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 12px;">{{ results }}</pre>
+    
+    <h3>🎯 Если найден правильный алгоритм:</h3>
+    <p>Обновим код для использования найденного метода!</p>
+    
+    <h3>❌ Если ничего не найдено:</h3>
+    <p>Возможно, нужно обратиться в поддержку FreedomPay за документацией по алгоритму подписи.</p>
+    
+    <p><a href="/">← Главная</a></p>
+''')
 
 @app.route('/test_hash_algorithms')
 def test_hash_algorithms():
@@ -1042,18 +4016,47 @@ def test_hash_algorithms():
         except Exception as e:
             pass
     
-    return render_template_string('''
-        <h2>🧪 Тестирование алгоритмов хеширования</h2>
-        <pre style="background: #f5f5f5; padding: 15px; border-radius: 5px; font-size: 12px;">{{ results }}</pre>
-        
-        <h3>🎯 Если найден правильный алгоритм:</h3>
-        <p>Обновим код для использования найденного метода!</p>
+    return render_page("test_hash_algorithms", results='\\n'.join(results))
+
+compile_template("test_final_payment", '''
+    <h2>🎯 Финальный тест с ПРАВИЛЬНЫМ алгоритмом</h2>
+    
+    <div style="background: #d4edda; padding: 15px; border-radius: 5px; margin: 15px 0;">
+        <h3>✅ Найденный алгоритм:</h3>
+        <ol>
+            <li>Сортировка параметров по алфавиту</li>
+            <li>Добавление "payment.php" в начало</li>
+            <li>Добавление SECRET_KEY в конец</li>
+            <li>Склеивание через ";"</li>
+            <li>MD5 хеш</li>
+        </ol>
+    </div>
+    
+    <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
+        <h3>📊 Результат:</h3>
+        <p><strong>Строка подписи:</strong><br>
+        <code style="word-break: break-all;">{{ sign_string }}</code></p>
         
-        <h3>❌ Если ничего не найдено:</h3>
-        <p>Возможно, нужно обратиться в поддержку FreedomPay за документацией по алгоритму подписи.</p>
+        <p><strong>MD5 подпись:</strong><br>
+        <code>{{ signature }}</code></p>
         
-        <p><a href="/">← Главная</a></p>
-    ''', results='\\n'.join(results))
+        <p><strong>Итоговый URL:</strong><br>
+        <code style="word-break: break-all;">{{ payment_url }}</code></p>
+    </div>
+    
+    <div style="background: #fff3cd; padding: 15px; border-radius: 5px; margin: 15px 0;">
+        <h3>🚨 ВНИМАНИЕ!</h3>
+        <p>Теперь код использует <strong>ПРАВИЛЬНЫЙ</strong> алгоритм подписи!</p>
+        <p>Больше не должно быть ошибок 9998 "Некорректная подпись запроса"</p>
+    </div>
+    
+    <h3>🧪 Попробовать платеж:</h3>
+    <p><a href="/" style="background: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">← Вернуться на главную и попробовать платеж</a></p>
+    
+    <h3>🔗 Или протестировать напрямую:</h3>
+    <p><a href="{{ payment_url }}" target="_blank" style="background: #28a745; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Открыть платежную страницу FreedomPay</a></p>
+    
+''')
 
 @app.route('/test_final_payment')
 def test_final_payment():
@@ -1082,45 +4085,7 @@ def test_final_payment():
     
     payment_url = f"https://api.freedompay.uz/payment.php?{'&'.join(query_parts)}"
     
-    return render_template_string('''
-        <h2>🎯 Финальный тест с ПРАВИЛЬНЫМ алгоритмом</h2>
-        
-        <div style="background: #d4edda; padding: 15px; border-radius: 5px; margin: 15px 0;">
-            <h3>✅ Найденный алгоритм:</h3>
-            <ol>
-                <li>Сортировка параметров по алфавиту</li>
-                <li>Добавление "payment.php" в начало</li>
-                <li>Добавление SECRET_KEY в конец</li>
-                <li>Склеивание через ";"</li>
-                <li>MD5 хеш</li>
-            </ol>
-        </div>
-        
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
-            <h3>📊 Результат:</h3>
-            <p><strong>Строка подписи:</strong><br>
-            <code style="word-break: break-all;">{{ sign_string }}</code></p>
-            
-            <p><strong>MD5 подпись:</strong><br>
-            <code>{{ signature }}</code></p>
-            
-            <p><strong>Итоговый URL:</strong><br>
-            <code style="word-break: break-all;">{{ payment_url }}</code></p>
-        </div>
-        
-        <div style="background: #fff3cd; padding: 15px; border-radius: 5px; margin: 15px 0;">
-            <h3>🚨 ВНИМАНИЕ!</h3>
-            <p>Теперь код использует <strong>ПРАВИЛЬНЫЙ</strong> алгоритм подписи!</p>
-            <p>Больше не должно быть ошибок 9998 "Некорректная подпись запроса"</p>
-        </div>
-        
-        <h3>🧪 Попробовать платеж:</h3>
-        <p><a href="/" style="background: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">← Вернуться на главную и попробовать платеж</a></p>
-        
-        <h3>🔗 Или протестировать напрямую:</h3>
-        <p><a href="{{ payment_url }}" target="_blank" style="background: #28a745; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">Открыть платежную страницу FreedomPay</a></p>
-        
-    ''', sign_string=sign_string, signature=signature, payment_url=payment_url)
+    return render_page("test_final_payment", sign_string=sign_string, signature=signature, payment_url=payment_url)
 
 @app.route('/check_payment_status')
 def check_payment_status():
@@ -1130,92 +4095,753 @@ def check_payment_status():
     if not order_id:
         return {"status": "error", "message": "order_id не указан"}, 400
     
-    # Проверяем статус платежа
-    status = payment_statuses.get(order_id, "pending")
+    # Проверяем статус платежа; давно зависший "pending" уточняем у шлюза
+    record = payment_statuses.get_record(order_id)
+    status = record["status"] if record else "pending"
+    if needs_gateway_lookup(record):
+        outcome = status_lookup.lookup(record, timeout=STATUS_LOOKUP_TIMEOUT)
+        status = apply_gateway_outcome(record, outcome)
+    
+    log_message("🔍 Unity запрашивает статус", order_id=order_id, status=status)
+    
+    return {
+        "order_id": order_id,
+        "status": status,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.route('/wait_payment_status')
+def wait_payment_status():
+    """Long-poll для Unity: отвечает, как только статус заказа изменится"""
+    order_id = request.args.get('order_id')
+    
+    if not order_id:
+        return {"status": "error", "message": "order_id не указан"}, 400
+    
+    known_status = request.args.get('known', 'pending')
+    try:
+        timeout = min(float(request.args.get('timeout', LONG_POLL_MAX_TIMEOUT)), LONG_POLL_MAX_TIMEOUT)
+    except ValueError:
+        return {"status": "error", "message": "timeout должен быть числом"}, 400
     
-    log_message(f"🔍 Unity запрашивает статус для Order ID: {order_id}")
-    log_message(f"📊 Статус: {status}")
+    status = status_waiters.wait_for_change(order_id, known_status, max(timeout, 0))
     
     return {
         "order_id": order_id,
         "status": status,
+        "changed": status != known_status,
         "timestamp": datetime.now().isoformat()
     }
 
+def format_sse_event(event, data):
+    """Форматирование одного события Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/payment_status_stream')
+def payment_status_stream():
+    """SSE-поток статуса заказа: событие при каждом изменении, закрывается на финальном статусе"""
+    order_id = request.args.get('order_id')
+    
+    if not order_id:
+        return {"status": "error", "message": "order_id не указан"}, 400
+    
+    def generate():
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        status = payment_statuses.get(order_id, "pending")
+        yield "retry: 3000\n"
+        yield format_sse_event("status", {"order_id": order_id, "status": status})
+        
+        while status not in FINAL_STATUSES and time.monotonic() < deadline:
+            new_status = status_waiters.wait_for_change(order_id, status, SSE_HEARTBEAT_INTERVAL)
+            if new_status == status:
+                yield ": keep-alive\n\n"
+                continue
+            status = new_status
+            yield format_sse_event("status", {"order_id": order_id, "status": status})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+compile_template("payment_status", '''
+    <h2>📊 Статус платежа</h2>
+    
+    <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
+        <h3>Order ID: {{ order_id }}</h3>
+        <h3>Статус: 
+            {% if status == 'success' %}
+                <span style="color: green;">✅ Успешно оплачен</span>
+            {% elif status == 'failed' %}
+                <span style="color: red;">❌ Не оплачен</span>
+            {% elif status == 'expired' %}
+                <span style="color: gray;">⌛ Истек срок оплаты</span>
+            {% else %}
+                <span style="color: orange;">⏳ В ожидании</span>
+            {% endif %}
+        </h3>
+    </div>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
 @app.route('/payment_status/<order_id>')
 def get_payment_status(order_id):
     """Получение статуса конкретного платежа"""
     status = payment_statuses.get(order_id, "pending")
     
-    return render_template_string('''
-        <h2>📊 Статус платежа</h2>
-        
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
-            <h3>Order ID: {{ order_id }}</h3>
-            <h3>Статус: 
-                {% if status == 'success' %}
-                    <span style="color: green;">✅ Успешно оплачен</span>
-                {% elif status == 'failed' %}
-                    <span style="color: red;">❌ Не оплачен</span>
+    return render_page("payment_status", order_id=order_id, status=status)
+
+# Страница статусов: по умолчанию одна страница по курсору, ?stream=1 — все заказы chunked-ответом
+STATUS_PAGE_SIZE = 100
+STATUS_PAGE_MAX_SIZE = 1000
+STATUS_STREAM_BATCH = 500
+
+compile_template("all_payment_statuses", '''
+    <h2>📊 Все статусы платежей</h2>
+    
+    <p>
+        Фильтр:
+        <a href="/all_payment_statuses">все</a>
+        {% for name in ['pending', 'success', 'failed', 'expired'] %}
+            | <a href="/all_payment_statuses?status={{ name }}">{{ name }}</a>
+        {% endfor %}
+        | <a href="/all_payment_statuses?stream=1{% if status_filter %}&status={{ status_filter }}{% endif %}">показать все</a>
+        | <a href="/all_payment_statuses.ndjson{% if status_filter %}?status={{ status_filter }}{% endif %}">NDJSON</a>
+    </p>
+    
+    <table style="border-collapse: collapse; width: 100%; margin: 20px 0;">
+        <tr style="background: #f8f9fa;">
+            <th style="border: 1px solid #ddd; padding: 10px;">Order ID</th>
+            <th style="border: 1px solid #ddd; padding: 10px;">Статус</th>
+            <th style="border: 1px solid #ddd; padding: 10px;">Действия</th>
+        </tr>
+        {% for record in records %}
+        <tr>
+            <td style="border: 1px solid #ddd; padding: 10px;">{{ record.order_id }}</td>
+            <td style="border: 1px solid #ddd; padding: 10px;">
+                {% if record.status == 'success' %}
+                    <span style="color: green;">✅ Успешно</span>
+                {% elif record.status == 'failed' %}
+                    <span style="color: red;">❌ Неуспешно</span>
+                {% elif record.status == 'expired' %}
+                    <span style="color: gray;">⌛ Просрочен</span>
                 {% else %}
                     <span style="color: orange;">⏳ В ожидании</span>
                 {% endif %}
-            </h3>
-        </div>
-        
-        <p><a href="/">← Главная</a></p>
-    ''', order_id=order_id, status=status)
+            </td>
+            <td style="border: 1px solid #ddd; padding: 10px;">
+                <a href="/payment_status/{{ record.order_id }}">Подробнее</a>
+            </td>
+        </tr>
+        {% else %}
+        <tr>
+            <td colspan="3" style="background: #fff3cd; padding: 15px;">
+                <p>🤷‍♂️ Платежей пока нет</p>
+                <p>Создайте тестовый платеж, чтобы увидеть статусы здесь</p>
+            </td>
+        </tr>
+        {% endfor %}
+    </table>
+    
+    {% if next_cursor %}
+        <p><a href="/all_payment_statuses?cursor={{ next_cursor }}&limit={{ limit }}{% if status_filter %}&status={{ status_filter }}{% endif %}">Следующая страница →</a></p>
+    {% endif %}
+    
+    <h3>🧪 Для тестирования Unity:</h3>
+    <ol>
+        <li>Запустите платеж в Unity</li>
+        <li>Обновите эту страницу - увидите статус "⏳ В ожидании"</li>
+        <li>Совершите оплату в браузере</li>
+        <li>Через несколько секунд статус изменится на "✅ Успешно"</li>
+        <li>Unity автоматически получит обновление статуса</li>
+    </ol>
+    
+    <p><a href="/">← Главная</a></p>
+''')
+
+def parse_status_page_args():
+    """Общие параметры постраничного вывода: (status, cursor, limit)"""
+    status_filter = request.args.get('status') or None
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = request.args.get('limit', STATUS_PAGE_SIZE, type=int)
+    return status_filter, max(cursor, 0), min(max(limit, 1), STATUS_PAGE_MAX_SIZE)
 
 @app.route('/all_payment_statuses')
 def all_payment_statuses():
-    """Показать все статусы платежей"""
+    """Показать статусы платежей: страница по курсору или весь список потоком"""
+    status_filter, cursor, limit = parse_status_page_args()
     
-    return render_template_string('''
-        <h2>📊 Все статусы платежей</h2>
-        
-        {% if payment_statuses %}
-            <table style="border-collapse: collapse; width: 100%; margin: 20px 0;">
-                <tr style="background: #f8f9fa;">
-                    <th style="border: 1px solid #ddd; padding: 10px;">Order ID</th>
-                    <th style="border: 1px solid #ddd; padding: 10px;">Статус</th>
-                    <th style="border: 1px solid #ddd; padding: 10px;">Действия</th>
-                </tr>
-                {% for order_id, status in payment_statuses.items() %}
-                <tr>
-                    <td style="border: 1px solid #ddd; padding: 10px;">{{ order_id }}</td>
-                    <td style="border: 1px solid #ddd; padding: 10px;">
-                        {% if status == 'success' %}
-                            <span style="color: green;">✅ Успешно</span>
-                        {% elif status == 'failed' %}
-                            <span style="color: red;">❌ Неуспешно</span>
-                        {% else %}
-                            <span style="color: orange;">⏳ В ожидании</span>
-                        {% endif %}
-                    </td>
-                    <td style="border: 1px solid #ddd; padding: 10px;">
-                        <a href="/payment_status/{{ order_id }}">Подробнее</a>
-                    </td>
-                </tr>
-                {% endfor %}
-            </table>
-        {% else %}
-            <div style="background: #fff3cd; padding: 15px; border-radius: 5px; margin: 15px 0;">
-                <p>🤷‍♂️ Платежей пока нет</p>
-                <p>Создайте тестовый платеж, чтобы увидеть статусы здесь</p>
-            </div>
-        {% endif %}
-        
-        <h3>🧪 Для тестирования Unity:</h3>
-        <ol>
-            <li>Запустите платеж в Unity</li>
-            <li>Обновите эту страницу - увидите статус "⏳ В ожидании"</li>
-            <li>Совершите оплату в браузере</li>
-            <li>Через несколько секунд статус изменится на "✅ Успешно"</li>
-            <li>Unity автоматически получит обновление статуса</li>
-        </ol>
-        
-        <p><a href="/">← Главная</a></p>
-    ''', payment_statuses=payment_statuses)
+    if request.args.get('stream'):
+        records = payment_statuses.iter_records(status=status_filter, after=cursor, batch_size=STATUS_STREAM_BATCH)
+        return stream_page("all_payment_statuses", records=records, status_filter=status_filter,
+                           next_cursor=None, limit=limit)
+    
+    records = payment_statuses.page(after=cursor, limit=limit, status=status_filter)
+    next_cursor = records[-1]["cursor"] if len(records) == limit else None
+    return render_cached_page("all_payment_statuses",
+                              (payment_statuses.version, status_filter, cursor, limit),
+                              records=records, status_filter=status_filter,
+                              next_cursor=next_cursor, limit=limit)
+
+@app.route('/all_payment_statuses.ndjson')
+def all_payment_statuses_ndjson():
+    """Все статусы платежей в NDJSON (по строке на заказ) для скриптов и выгрузок"""
+    status_filter, cursor, _ = parse_status_page_args()
+    
+    def generate():
+        for record in payment_statuses.iter_records(status=status_filter, after=cursor,
+                                                    batch_size=STATUS_STREAM_BATCH):
+            yield json.dumps({
+                "cursor": record["cursor"],
+                "order_id": record["order_id"],
+                "status": record["status"],
+                "payment_id": record["payment_id"],
+                "created_at": record["created_at"],
+                "updated_at": record["updated_at"],
+            }, ensure_ascii=False) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route('/stats')
+def stats():
+    """Счетчики компонентов сервера (очереди, ожидающие клиенты и т.д.)"""
+    return {name: provider() for name, provider in STATS_PROVIDERS.items()}
+
+# Латентность считается только для маршрутов платежного потока
+METRICS_ROUTES = ("/pay", "/check", "/result", "/check_payment_status")
+ORDER_COUNTS_TTL = 10  # секунд, подсчет заказов по статусам на больших базах не бесплатный
+order_counts_cache = TTLCache(1, ORDER_COUNTS_TTL)
+
+def order_counts():
+    counts = order_counts_cache.get("counts")
+    if counts is None:
+        counts = payment_statuses.count_by_status()
+        order_counts_cache.put("counts", counts)
+    return {(status,): count for status, count in counts.items()}
+
+GaugeFunc("freedompay_orders", "Заказы по статусам", ("status",), order_counts)
+
+@app.before_request
+def start_request_timer():
+    request.environ["freedompay.started"] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    if rule in METRICS_ROUTES:
+        REQUEST_LATENCY.observe(time.perf_counter() - request.environ["freedompay.started"], rule)
+        REQUESTS_TOTAL.inc(rule, response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# Ограничение частоты опроса статуса: token bucket на клиента и на заказ, лишние запросы — сразу 429
+RATE_LIMITS = {  # маршрут -> {вид ключа: (запросов в секунду, запас burst)}
+    "/check_payment_status": {"client": (10, 20), "order": (5, 10)},
+    "/wait_payment_status": {"client": (2, 10), "order": (1, 5)},
+    "/payment_status_stream": {"client": (1, 5), "order": (0.5, 3)},
+}
+# Переопределение JSON-ом: {"/check_payment_status": {"client": [20, 40]}, "/wait_payment_status": null}
+for _route, _limits in json.loads(os.environ.get("FREEDOMPAY_RATE_LIMITS") or "{}").items():
+    if _limits is None:
+        RATE_LIMITS.pop(_route, None)
+    else:
+        RATE_LIMITS[_route] = dict(RATE_LIMITS.get(_route, {}), **{kind: tuple(limit) for kind, limit in _limits.items()})
+RATE_LIMIT_SHARDS = 32           # шардов с отдельными блокировками
+RATE_LIMIT_MAX_KEYS = 100_000    # корзин в памяти на все шарды, сверх — вытесняются давно не использованные
+# Адреса прокси перед сервером через запятую; по умолчанию — агент ngrok на этой машине, иначе все
+# клиенты Unity пришли бы с 127.0.0.1 и делили одну корзину. X-Forwarded-For учитывается только
+# у запросов от этих адресов; пустая строка — прокси нет, клиент это REMOTE_ADDR
+RATE_LIMIT_TRUSTED_PROXIES = frozenset(address.strip() for address in
+                                       os.environ.get("FREEDOMPAY_TRUSTED_PROXIES", "127.0.0.1").split(",")
+                                       if address.strip())
+
+class RateLimiter:
+    """
+    Token bucket на (маршрут, вид ключа, значение): rate токенов в секунду, не больше burst.
+    Корзины разложены по шардам со своими блокировками, поэтому запросы разных клиентов
+    почти не ждут друг друга; в шарде OrderedDict хранит их в порядке обращения, и сверх
+    max_keys / shards вытесняется самая давняя. Вытесненная корзина при следующем обращении
+    начинается полной — так же, как после долгого простоя.
+    """
+
+    def __init__(self, limits, shards=RATE_LIMIT_SHARDS, max_keys=RATE_LIMIT_MAX_KEYS):
+        for route, route_limits in limits.items():
+            for kind, (rate, burst) in route_limits.items():
+                # rate 0 дал бы деление на ноль в _take; маршрут без лимита задается null
+                if rate <= 0 or burst < 1:
+                    raise ValueError(f"Некорректный лимит {route} {kind}: rate > 0 и burst >= 1, получено "
+                                     f"{[rate, burst]}")
+        self.limits = limits
+        self.shard_size = max(1, max_keys // shards)
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+        self._evicted = [0] * shards
+
+    def _take(self, key, rate, burst, now):
+        """Берет токен из корзины key; возвращает 0 или секунды до появления токена"""
+        index = hash(key) % len(self._shards)
+        buckets, lock = self._shards[index]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [burst, now]
+                if len(buckets) > self.shard_size:
+                    buckets.popitem(last=False)
+                    self._evicted[index] += 1
+            else:
+                buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+    def _refund(self, key, burst):
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(burst, bucket[0] + 1)
+
+    def acquire(self, route, keys, now=None):
+        """(True, 0) или (False, секунд до следующей попытки); keys — {вид ключа: значение}"""
+        limits = self.limits.get(route)
+        if not limits:
+            return True, 0.0
+        now = now or time.monotonic()
+        taken = []
+        for kind, (rate, burst) in limits.items():
+            value = keys.get(kind)
+            if value is None:
+                continue
+            key = (route, kind, value)
+            wait = self._take(key, rate, burst, now)
+            if wait:
+                # Отказ по одному ключу не должен тратить токены остальных
+                for taken_key, taken_burst in taken:
+                    self._refund(taken_key, taken_burst)
+                RATE_LIMITED.inc(route, kind)
+                return False, wait
+            taken.append((key, burst))
+        return True, 0.0
+
+    def __len__(self):
+        return sum(len(buckets) for buckets, _ in self._shards)
+
+    def after_fork(self):
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in self._shards]
+        self._evicted = [0] * len(self._shards)
+
+    def stats(self):
+        limited = {}
+        for (route, kind), count in RATE_LIMITED.values().items():
+            limited.setdefault(route, {})[kind] = count
+        return {"routes": {route: {kind: list(limit) for kind, limit in limits.items()}
+                           for route, limits in self.limits.items()},
+                "buckets": len(self), "max_buckets": self.shard_size * len(self._shards),
+                "evicted": sum(self._evicted), "limited": limited}
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+register_stats("rate_limiter", rate_limiter.stats)
+
+def client_identity(remote_addr, forwarded_for=None):
+    """Адрес клиента: за доверенными прокси — первый справа в X-Forwarded-For, кто не наш прокси"""
+    if remote_addr not in RATE_LIMIT_TRUSTED_PROXIES or not forwarded_for:
+        # Заголовок от клиента напрямую — его выдумка: меняя его, он получал бы новую корзину
+        return remote_addr
+    # Левые адреса присылает сам клиент и может подделать, правые дописали наши прокси
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if hop not in RATE_LIMIT_TRUSTED_PROXIES:
+            return hop
+    return hops[0] if hops else remote_addr
+
+def rate_limit_response(route, remote_addr, forwarded_for, order_id):
+    """None — запрос пропускаем, иначе ответ 429 (тело, код, заголовки) для Flask и ASGI"""
+    allowed, wait = rate_limiter.acquire(route, {"client": client_identity(remote_addr, forwarded_for),
+                                                 "order": order_id})
+    if allowed:
+        return None
+    retry_after = max(1, int(-(-wait // 1)))  # Retry-After — целые секунды, округляем вверх
+    return ({"status": "error", "message": "слишком много запросов", "retry_after": retry_after}, 429,
+            {"Retry-After": str(retry_after)})
+
+@app.before_request
+def enforce_rate_limit():
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    if rule in rate_limiter.limits:
+        return rate_limit_response(rule, request.remote_addr, request.headers.get("X-Forwarded-For"),
+                                   request.args.get("order_id"))
+
+# Профилирование по запросу: cProfile отдельного запроса (заголовок X-Profile: 1 или ?_profile=1)
+# и сэмплирующий профайлер всех потоков. Результаты — collapsed stacks для flamegraph.pl / speedscope.
+ADMIN_TOKEN = os.environ.get("FREEDOMPAY_ADMIN_TOKEN")  # /admin/* и профиль запроса — только с этим X-Admin-Token
+PROFILE_REQUESTS = False        # включается через /admin/profiling без перезапуска
+PROFILE_KEEP = 20               # последних профилей запросов в памяти
+SAMPLER_INTERVAL = 0.005        # секунд между снимками стеков
+SAMPLER_MAX_DURATION = 300      # секунд, дольше окно сэмплирования не держим
+
+request_profiles = OrderedDict()  # id -> профиль запроса
+request_profiles_lock = threading.Lock()
+
+def check_admin_token():
+    """
+    True, только если токен настроен и передан правильный X-Admin-Token. Без токена
+    админка закрыта: за ngrok все запросы приходят с 127.0.0.1, так что разрешить
+    "только локальные" значило бы разрешить всем.
+    """
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _pstats_name(func):
+    filename, line, name = func
+    if filename == "~":
+        return name  # встроенные функции: "<built-in method ...>"
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def profile_to_collapsed(profiler):
+    """
+    Collapsed stacks из cProfile. cProfile хранит только пары вызывающий → вызываемый,
+    поэтому стеки восстанавливаются обходом графа от корней, а собственное время
+    функции делится между вызывающими пропорционально их вызовам (как в flameprof).
+    """
+    stats = pstats.Stats(profiler).stats  # func -> (cc, nc, tt, ct, callers)
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+    lines = {}
+    
+    def walk(func, stack, share, path):
+        tt = stats[func][2]
+        if tt * share > 0:
+            key = ";".join(stack)
+            lines[key] = lines.get(key, 0) + tt * share
+        for callee, edge in callees.get(func, ()):
+            if callee in path or callee not in stats:
+                continue
+            callee_ct = stats[callee][3]
+            callee_share = share * (edge[3] / callee_ct if callee_ct else 0)
+            # Ветки меньше микросекунды на флеймграфе не видны, а обход графа по ним дорогой
+            if callee_ct * callee_share < 1e-6:
+                continue
+            walk(callee, stack + [_pstats_name(callee)], callee_share, path | {callee})
+    
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, [_pstats_name(func)], 1.0, {func})
+    # Вес в микросекундах: flamegraph.pl ждет целые числа
+    return "\n".join(f"{stack} {round(weight * 1e6)}" for stack, weight in sorted(lines.items())
+                     if round(weight * 1e6) > 0) + "\n"
+
+@app.before_request
+def start_request_profile():
+    if not PROFILE_REQUESTS:
+        return
+    if request.headers.get("X-Profile") != "1" and request.args.get("_profile") != "1":
+        return
+    if not check_admin_token():
+        return
+    profiler = cProfile.Profile()
+    request.environ["freedompay.profiler"] = profiler
+    profiler.enable()
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = request.environ.pop("freedompay.profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    profile_id = uuid.uuid4().hex[:12]
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(40)
+    profile = {"id": profile_id, "path": request.path, "method": request.method,
+               "status": response.status_code, "at": datetime.now().isoformat(timespec="seconds"),
+               "duration_ms": round((time.perf_counter() - request.environ["freedompay.started"]) * 1000, 2),
+               "collapsed": profile_to_collapsed(profiler), "pstats": output.getvalue()}
+    with request_profiles_lock:
+        request_profiles[profile_id] = profile
+        while len(request_profiles) > PROFILE_KEEP:
+            request_profiles.popitem(last=False)
+    response.headers["X-Profile-Id"] = profile_id
+    log_message("🔬 Профиль запроса сохранен", id=profile_id, path=request.path,
+                duration_ms=profile["duration_ms"])
+    return response
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер: фоновый поток раз в interval снимает стеки всех потоков
+    через sys._current_frames() и копит счетчики collapsed stacks. Наблюдаемый код
+    не инструментируется, накладные расходы — один проход по стекам за снимок.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counts = {}
+        self.samples = 0
+        self.started_at = None
+        self.finished_at = None
+        self.interval = SAMPLER_INTERVAL
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, interval=SAMPLER_INTERVAL, duration=30):
+        """Новое окно сэмплирования; предыдущие результаты сбрасываются"""
+        with self._lock:
+            if self.running:
+                return False
+            self.counts = {}
+            self.samples = 0
+            self.interval = interval
+            self.started_at = datetime.now().isoformat(timespec="seconds")
+            self.finished_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval, min(duration, SAMPLER_MAX_DURATION)),
+                                            name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+    
+    def _run(self, interval, duration):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self.counts[key] = self.counts.get(key, 0) + 1
+            with self._lock:
+                self.samples += 1
+            self._stop.wait(interval)
+        self.finished_at = datetime.now().isoformat(timespec="seconds")
+    
+    def collapsed(self):
+        with self._lock:
+            items = sorted(self.counts.items())
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+    
+    def stats(self):
+        return {"running": self.running, "samples": self.samples, "stacks": len(self.counts),
+                "interval": self.interval, "started_at": self.started_at, "finished_at": self.finished_at,
+                "request_profiling": PROFILE_REQUESTS, "request_profiles": len(request_profiles)}
+
+sampling_profiler = SamplingProfiler()
+register_stats("profiler", sampling_profiler.stats)
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """Включение/выключение профилирования запросов: ?requests=on|off"""
+    global PROFILE_REQUESTS
+    if not check_admin_token():
+        return "FORBIDDEN", 403
+    if request.values.get("requests") in ("on", "off"):
+        PROFILE_REQUESTS = request.values["requests"] == "on"
+        log_message("🔬 Профилирование запросов", enabled=PROFILE_REQUESTS)
+    with request_profiles_lock:
+        profiles = [{key: value for key, value in profile.items() if key not in ("collapsed", "pstats")}
+                    for profile in request_profiles.values()]
+    return {"request_profiling": PROFILE_REQUESTS, "profiles": profiles}
+
+@app.route('/admin/profiling/<profile_id>')
+def admin_request_profile(profile_id):
+    """Профиль запроса: ?format=collapsed (по умолчанию) или pstats"""
+    if not check_admin_token():
+        return "FORBIDDEN", 403
+    with request_profiles_lock:
+        profile = request_profiles.get(profile_id)
+    if profile is None:
+        return "NOT FOUND", 404
+    output_format = "pstats" if request.args.get("format") == "pstats" else "collapsed"
+    return Response(profile[output_format], mimetype="text/plain")
+
+@app.route('/admin/sampler', methods=['GET', 'POST'])
+def admin_sampler():
+    """
+    Сэмплирующий профайлер: ?action=start&duration=30&interval=0.005, ?action=stop,
+    без action — collapsed stacks текущего или последнего окна.
+    """
+    if not check_admin_token():
+        return "FORBIDDEN", 403
+    action = request.values.get("action")
+    if action == "start":
+        try:
+            duration = float(request.values.get("duration", 30))
+            interval = max(0.001, float(request.values.get("interval", SAMPLER_INTERVAL)))
+        except ValueError:
+            return "BAD REQUEST", 400
+        if not sampling_profiler.start(interval=interval, duration=duration):
+            return {"error": "уже запущен", **sampling_profiler.stats()}, 409
+        log_message("🔬 Сэмплирование запущено", duration=duration, interval=interval)
+        return sampling_profiler.stats()
+    if action == "stop":
+        sampling_profiler.stop()
+        return sampling_profiler.stats()
+    return Response(sampling_profiler.collapsed(), mimetype="text/plain")
+
+# Память: tracemalloc по запросу, топ мест выделения и разница между снимками
+MEMORY_SNAPSHOTS_KEEP = 5   # снимков tracemalloc в памяти
+MEMORY_TOP_LIMIT = 25       # строк в топе по умолчанию
+MEMORY_TRACE_FRAMES = 1     # глубина стека для каждого выделения (больше — точнее и дороже)
+MEMORY_TRACE_MAX_FRAMES = 25  # больше не даем: каждый кадр умножает память и CPU на каждое выделение
+
+memory_snapshots = OrderedDict()  # id -> (время, снимок)
+memory_snapshots_lock = threading.Lock()
+
+def _memory_filtered(snapshot):
+    # Выделения самого tracemalloc и импорта модулей — шум
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+def _format_traceback(traceback):
+    # Кадры идут от вызывающего к месту выделения
+    return " -> ".join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in traceback)
+
+def take_memory_snapshot():
+    snapshot = _memory_filtered(tracemalloc.take_snapshot())
+    snapshot_id = uuid.uuid4().hex[:8]
+    with memory_snapshots_lock:
+        memory_snapshots[snapshot_id] = (datetime.now().isoformat(timespec="seconds"), snapshot)
+        while len(memory_snapshots) > MEMORY_SNAPSHOTS_KEEP:
+            memory_snapshots.popitem(last=False)
+    return snapshot_id
+
+def memory_sizes():
+    """Размеры хранилища заказов и кешей из STATS_PROVIDERS"""
+    sizes = {"payment_statuses": len(payment_statuses)}
+    for name, provider in STATS_PROVIDERS.items():
+        stats = provider()
+        for key in ("size", "cached", "depth", "waiting_clients", "stacks", "request_profiles"):
+            if key in stats:
+                sizes[f"{name}.{key}"] = stats[key]
+    return sizes
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@app.route('/admin/memory', methods=['GET', 'POST'])
+def admin_memory():
+    """
+    tracemalloc: ?action=start[&frames=N], ?action=snapshot, ?action=stop.
+    Без action — состояние, топ мест выделения последнего снимка (?group=lineno|filename|traceback,
+    ?limit=N) и разница двух снимков (?base=id&compare=id, по умолчанию два последних).
+    """
+    if not check_admin_token():
+        return "FORBIDDEN", 403
+    action = request.values.get("action")
+    if action == "start":
+        frames = request.values.get("frames", MEMORY_TRACE_FRAMES)
+        if not str(frames).isdigit() or not 1 <= int(frames) <= MEMORY_TRACE_MAX_FRAMES:
+            return "BAD REQUEST", 400
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(int(frames))
+            log_message("🧠 tracemalloc запущен", frames=int(frames))
+    elif action == "snapshot":
+        if not tracemalloc.is_tracing():
+            return {"error": "tracemalloc не запущен"}, 409
+        take_memory_snapshot()
+    elif action == "stop":
+        tracemalloc.stop()
+        with memory_snapshots_lock:
+            memory_snapshots.clear()
+        log_message("🧠 tracemalloc остановлен")
+    elif action is not None:
+        return "BAD REQUEST", 400
+    
+    group = request.args.get("group", "lineno")
+    if group not in ("lineno", "filename", "traceback"):
+        return "BAD REQUEST", 400
+    limit = request.args.get("limit", MEMORY_TOP_LIMIT, type=int)
+    
+    report = {"tracing": tracemalloc.is_tracing(), "rss_bytes": process_rss_bytes(),
+              "gc_counts": gc.get_count(), "sizes": memory_sizes()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report.update(traced_bytes=current, traced_peak_bytes=peak)
+    with memory_snapshots_lock:
+        snapshots = dict(memory_snapshots)
+    report["snapshots"] = [{"id": snapshot_id, "at": at} for snapshot_id, (at, _) in snapshots.items()]
+    
+    if snapshots:
+        ids = list(snapshots)
+        _, latest = snapshots[ids[-1]]
+        report["top"] = [{"site": _format_traceback(stat.traceback), "size": stat.size, "count": stat.count}
+                         for stat in latest.statistics(group)[:limit]]
+        base_id = request.args.get("base", ids[-2] if len(ids) > 1 else None)
+        compare_id = request.args.get("compare", ids[-1])
+        if base_id is not None:
+            if base_id not in snapshots or compare_id not in snapshots:
+                return "NOT FOUND", 404
+            diff = snapshots[compare_id][1].compare_to(snapshots[base_id][1], group)
+            report["diff"] = {"base": base_id, "compare": compare_id,
+                              "top": [{"site": _format_traceback(stat.traceback), "size_diff": stat.size_diff,
+                                       "count_diff": stat.count_diff, "size": stat.size}
+                                      for stat in diff[:limit]]}
+    return report
+
+def reinit_after_fork():
+    """
+    Дочерний процесс после fork() (режим pre-fork): потоки родителя в нем не существуют,
+    поэтому службы заново создают блокировки, очереди и соединения.
+    """
+    for component in (logger, payment_statuses, callback_queue, gateway_session, gateway_monitor,
+                      order_expiry, status_event_poller, reconciler, callback_journal, webhook_outbox,
+                      rate_limiter):
+        if component is not None:
+            component.after_fork()
+
+os.register_at_fork(after_in_child=reinit_after_fork)
+
+def start_background_services(reconcile=True):
+    """
+    Запуск фоновых служб сервера (мониторинг шлюзов, просрочка заказов, события других процессов,
+    сверка со шлюзом, доставка webhook'ов). reconcile=False — для всех воркеров pre-fork, кроме одного.
+    Журнал callback'ов проигрывается первым, до приема запросов.
+    """
+    if callback_journal is not None:
+        callback_journal.recover(payment_statuses)
+        callback_journal.start(payment_statuses, callback_queue)
+    gateway_monitor.start()
+    order_expiry.start()
+    if status_event_poller is not None:
+        status_event_poller.start()
+    if reconcile:
+        reconciler.start()
+    if webhook_outbox is not None:
+        webhook_outbox.start()
+    log_message("🩺 Мониторинг шлюзов запущен", interval=HEALTH_CHECK_INTERVAL, ttl=HEALTH_TTL)
 
 if __name__ == '__main__':
     log_message("🚀 Запуск FreedomPay тестового сервера...")
@@ -1225,4 +4851,9 @@ if __name__ == '__main__':
     if not validate_credentials():
         log_message("❌ Проверьте конфигурацию перед запуском!")
     
+    # С debug=True код запускается дважды: наблюдатель перезагрузки и рабочий процесс.
+    # Фоновые службы нужны только в рабочем.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services()
+    
     app.run(debug=True)
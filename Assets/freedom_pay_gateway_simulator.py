@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FreedomPay Gateway Simulator
+Локальная замена api.freedompay.uz для нагрузочных и интеграционных тестов
+
+Принимает payment.php (подпись pg_sig проверяется тем же Signer, что и в сервере),
+затем шлет подписанные /check и /result на сервер мерчанта с заданной частотой,
+задержкой, долей ошибок и повторов. get_status2.php отвечает статусом платежа —
+для сверки заказов, /result которых потерялся (--lost-result-rate).
+
+Запуск:
+    python freedom_pay_gateway_simulator.py --port 8090 --callback-url http://127.0.0.1:5000
+    python freedom_pay_gateway_simulator.py --payments 1000 --rate 200 --duplicate-rate 0.1
+    python freedom_pay_gateway_simulator.py --port 8090 --lost-result-rate 0.2
+"""
+
+import argparse
+import heapq
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+import requests
+from flask import Flask, request
+
+import freedom_pay_final_attempt as server
+
+class CallbackDispatcher:
+    """
+    Планировщик callback'ов: задания лежат в куче по времени отправки, один поток
+    выдает их не чаще rate в секунду, отправка идет в пуле потоков по общей сессии.
+    Не-200 и ошибки соединения повторяются с экспоненциальной задержкой, как у шлюза.
+    """
+
+    def __init__(self, rate, workers=8, timeout=10, max_retries=3, retry_delay=0.5):
+        self.rate = rate
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sim-callback")
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._next_send_at = 0.0
+        self._in_flight = 0
+        self._closed = False
+        self.stats = {"scheduled": 0, "sent": 0, "ok": 0, "rejected": 0, "errors": 0,
+                      "retries": 0, "duplicates": 0, "latency_total": 0.0}
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="sim-dispatcher", daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, url, params, on_done=None, attempt=0):
+        """Отправить POST url с params через delay секунд; on_done(ok) после финального ответа"""
+        with self._condition:
+            self._sequence += 1
+            self._in_flight += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._sequence, url, params, on_done, attempt))
+            self._condition.notify()
+        self._count("scheduled")
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                _, _, url, params, on_done, attempt = heapq.heappop(self._heap)
+            # Ограничение частоты: задания выдаются с шагом 1/rate
+            if self.rate:
+                now = time.monotonic()
+                if self._next_send_at > now:
+                    time.sleep(self._next_send_at - now)
+                self._next_send_at = max(now, self._next_send_at) + 1 / self.rate
+            self.executor.submit(self._send, url, params, on_done, attempt)
+
+    def _send(self, url, params, on_done, attempt):
+        started = time.perf_counter()
+        try:
+            response = self.session.post(url, data=params, timeout=self.timeout)
+            status = response.status_code
+            response.close()
+        except requests.RequestException:
+            status = None
+        with self._stats_lock:
+            self.stats["sent"] += 1
+            self.stats["latency_total"] += time.perf_counter() - started
+        retry = status is None or status >= 500
+        if retry and attempt < self.max_retries:
+            self._count("retries")
+            self.schedule(self.retry_delay * 2 ** attempt, url, params, on_done, attempt + 1)
+        else:
+            if status == 200:
+                self._count("ok")
+            elif status is not None and status < 500:
+                self._count("rejected")
+            else:
+                self._count("errors")
+            if on_done is not None:
+                on_done(status == 200)
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Ждет, пока все запланированные callback'и не будут отправлены"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        sent = stats.pop("latency_total")
+        stats["avg_latency_ms"] = round(sent / stats["sent"] * 1000, 2) if stats["sent"] else 0.0
+        stats["in_flight"] = self._in_flight
+        return stats
+
+# Внутренний статус платежа симулятора -> pg_transaction_status в get_status2.php
+PAYMENT_TRANSACTION_STATUSES = {
+    "created": "pending",
+    "paid": "ok",
+    "declined": "failed",
+    "aborted": "incomplete",
+}
+
+def xml_response(fields, script_name, secret_key):
+    """Подписанный XML-ответ шлюза <response>...</response>"""
+    fields = dict(fields, pg_salt=uuid.uuid4().hex[:16])
+    fields["pg_sig"] = server.get_signer(script_name, secret_key).sign(fields)
+    body = "".join(f"<{name}>{escape(str(value))}</{name}>" for name, value in fields.items())
+    return (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><response>{body}</response>", 200,
+            {"Content-Type": "application/xml; charset=utf-8"})
+
+class GatewaySimulator:
+    """Платежи и сценарий callback'ов: check → result (+ дубликаты, ошибки оплаты, битые подписи)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.merchant_id = args.merchant_id
+        self.secret_key = args.secret_key
+        self.rng = random.Random(args.seed)
+        self._rng_lock = threading.Lock()
+        self.dispatcher = CallbackDispatcher(args.rate, workers=args.workers, max_retries=args.max_retries,
+                                             retry_delay=args.retry_delay)
+        self.payments = {}
+        self.orders = {}  # pg_order_id -> pg_payment_id
+        self._lock = threading.Lock()
+        self.stats = {"payments": 0, "rejected_payments": 0, "paid": 0, "declined": 0, "aborted": 0,
+                      "bad_signatures": 0, "lost_results": 0, "status_requests": 0}
+
+    def _random(self):
+        with self._rng_lock:
+            return self.rng.random()
+
+    def _delay(self):
+        """Задержка шлюза перед callback'ом: latency ± jitter (секунды)"""
+        jitter = (self._random() * 2 - 1) * self.args.jitter
+        return max(0.0, (self.args.latency + jitter) / 1000)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def validate_payment(self, params):
+        """Ошибка запроса payment.php или None, если мерчант и подпись верны"""
+        for name in ("pg_merchant_id", "pg_amount", "pg_salt", "pg_sig"):
+            if not params.get(name):
+                return f"Отсутствует обязательный параметр {name}"
+        if params["pg_merchant_id"] != self.merchant_id:
+            return "Неизвестный мерчант"
+        if not server.get_signer("payment.php", self.secret_key).verify(params, params["pg_sig"]):
+            return "Некорректная подпись запроса"
+        return None
+
+    def create_payment(self, params):
+        """Регистрирует платеж и планирует /check; возвращает pg_payment_id"""
+        payment_id = str(uuid.uuid4().int % 10 ** 9)
+        payment = {
+            "pg_order_id": params.get("pg_order_id") or f"sim_{uuid.uuid4().hex[:12]}",
+            "pg_payment_id": payment_id,
+            "pg_amount": params["pg_amount"],
+            "pg_currency": params.get("pg_currency", "UZS"),
+            "check_url": params.get("pg_check_url") or f"{self.args.callback_url}/check",
+            "result_url": params.get("pg_result_url") or f"{self.args.callback_url}/result",
+            "status": "created",
+        }
+        with self._lock:
+            self.payments[payment_id] = payment
+            self.orders[payment["pg_order_id"]] = payment_id
+            self.stats["payments"] += 1
+        self.dispatcher.schedule(self._delay(), payment["check_url"], self.callback_params(payment, "check"),
+                                 on_done=lambda ok: self._after_check(payment, ok))
+        return payment_id
+
+    def callback_params(self, payment, kind):
+        params = {
+            "pg_order_id": payment["pg_order_id"],
+            "pg_payment_id": payment["pg_payment_id"],
+            "pg_amount": payment["pg_amount"],
+            "pg_currency": payment["pg_currency"],
+            "pg_salt": uuid.uuid4().hex[:16],
+        }
+        if kind == "result":
+            params["pg_result"] = "1" if payment["status"] == "paid" else "0"
+            params["pg_can_reject"] = "0"
+        # Сервер проверяет подписи callback'ов как check.php / result.php
+        params["pg_sig"] = server.get_signer(f"{kind}.php", self.secret_key).sign(params)
+        if self._random() < self.args.bad_signature_rate:
+            params["pg_sig"] = "0" * 32
+            self._count("bad_signatures")
+        return params
+
+    def _after_check(self, payment, ok):
+        if not ok:
+            # Мерчант не подтвердил заказ — шлюз не проводит оплату
+            payment["status"] = "aborted"
+            self._count("aborted")
+            return
+        declined = self._random() < self.args.decline_rate
+        payment["status"] = "declined" if declined else "paid"
+        self._count("declined" if declined else "paid")
+        if self._random() < self.args.lost_result_rate:
+            # Оплата прошла, но /result до мерчанта не дошел — узнать можно только через get_status2.php
+            self._count("lost_results")
+            return
+        params = self.callback_params(payment, "result")
+        self.dispatcher.schedule(self._delay(), payment["result_url"], params)
+        # Повторная доставка того же result (как при таймауте ответа мерчанта)
+        if self._random() < self.args.duplicate_rate:
+            self.dispatcher._count("duplicates")
+            self.dispatcher.schedule(self._delay() * 2, payment["result_url"], params)
+
+    def register_payment(self, order_id, status, amount="1000"):
+        """Платеж в нужном статусе без callback'ов (для сверки); возвращает pg_payment_id"""
+        payment_id = str(uuid.uuid4().int % 10 ** 9)
+        with self._lock:
+            self.payments[payment_id] = {"pg_order_id": order_id, "pg_payment_id": payment_id, "pg_amount": amount,
+                                         "pg_currency": "UZS", "status": status}
+            self.orders[order_id] = payment_id
+        return payment_id
+
+    def payment_status(self, params):
+        """Ответ get_status2.php: dict полей <response> без подписи"""
+        for name in ("pg_merchant_id", "pg_salt", "pg_sig"):
+            if not params.get(name):
+                return {"pg_status": "error", "pg_error_code": "10000",
+                        "pg_error_description": f"Отсутствует обязательный параметр {name}"}
+        if params["pg_merchant_id"] != self.merchant_id or \
+                not server.get_signer("get_status2.php", self.secret_key).verify(params, params["pg_sig"]):
+            return {"pg_status": "error", "pg_error_code": "10000", "pg_error_description": "Некорректная подпись запроса"}
+        with self._lock:
+            self.stats["status_requests"] += 1
+            payment_id = params.get("pg_payment_id") or self.orders.get(params.get("pg_order_id"))
+            payment = self.payments.get(payment_id)
+        if payment is None:
+            return {"pg_status": "error", "pg_error_code": "340", "pg_error_description": "Платеж не найден"}
+        return {"pg_status": "ok", "pg_payment_id": payment["pg_payment_id"],
+                "pg_transaction_status": PAYMENT_TRANSACTION_STATUSES[payment["status"]],
+                "pg_amount": payment["pg_amount"], "pg_currency": payment["pg_currency"]}
+
+    def generate_payments(self, count, amount="1000"):
+        """Синтетические платежи без браузера: подписанный payment.php сразу в create_payment"""
+        for i in range(count):
+            params = {
+                "pg_merchant_id": self.merchant_id,
+                "pg_amount": amount,
+                "pg_currency": "UZS",
+                "pg_description": "Simulated Payment",
+                "pg_salt": uuid.uuid4().hex[:16],
+                "pg_order_id": f"sim_{int(time.time())}_{i}",
+            }
+            params["pg_sig"] = server.get_signer("payment.php", self.secret_key).sign(params)
+            self.create_payment(params)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["callbacks"] = self.dispatcher.snapshot()
+        return stats
+
+def create_app(simulator):
+    app = Flask(__name__)
+
+    @app.route('/payment.php', methods=['GET', 'POST'])
+    def payment():
+        params = request.values.to_dict()
+        if simulator._random() < simulator.args.error_rate:
+            return "<h2>Service Unavailable</h2>", 503
+        error = simulator.validate_payment(params)
+        if error is not None:
+            simulator._count("rejected_payments")
+            return (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><response><pg_status>error</pg_status>"
+                    f"<pg_error_code>10000</pg_error_code><pg_error_description>{error}</pg_error_description>"
+                    f"</response>", 200, {"Content-Type": "application/xml; charset=utf-8"})
+        payment_id = simulator.create_payment(params)
+        return f"""
+            <h2>🧪 Симулятор FreedomPay</h2>
+            <p>Платеж {payment_id} принят, callback'и будут отправлены на {simulator.args.callback_url}</p>
+        """
+
+    @app.route('/get_status2.php', methods=['GET', 'POST'])
+    def get_status():
+        if simulator._random() < simulator.args.error_rate:
+            return "<h2>Service Unavailable</h2>", 503
+        if simulator.args.status_latency:
+            time.sleep(simulator.args.status_latency / 1000)
+        return xml_response(simulator.payment_status(request.values.to_dict()), "get_status2.php",
+                            simulator.secret_key)
+
+    @app.route('/stats')
+    def stats():
+        return simulator.snapshot()
+
+    return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Симулятор шлюза FreedomPay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--callback-url", default="http://127.0.0.1:5000", help="адрес сервера мерчанта")
+    parser.add_argument("--merchant-id", default=server.MERCHANT_ID)
+    parser.add_argument("--secret-key", default=server.SECRET_KEY)
+    parser.add_argument("--rate", type=float, default=100, help="callback'ов в секунду (0 — без ограничения)")
+    parser.add_argument("--latency", type=float, default=50, help="мс до каждого callback'а")
+    parser.add_argument("--jitter", type=float, default=20, help="± мс к задержке")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля payment.php и get_status2.php с ответом 503")
+    parser.add_argument("--decline-rate", type=float, default=0.1, help="доля неуспешных оплат (pg_result=0)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="доля повторно доставленных /result")
+    parser.add_argument("--bad-signature-rate", type=float, default=0.0, help="доля callback'ов с битой подписью")
+    parser.add_argument("--lost-result-rate", type=float, default=0.0, help="доля /result, которые не отправляются")
+    parser.add_argument("--status-latency", type=float, default=20, help="мс на ответ get_status2.php")
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="секунд до первого повтора")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--payments", type=int, default=0, help="сгенерировать столько платежей при запуске")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+def main():
+    """Главная функция"""
+    args = parse_args()
+    simulator = GatewaySimulator(args)
+    app = create_app(simulator)
+
+    print("=" * 60)
+    print(f"🧪 СИМУЛЯТОР FREEDOMPAY: http://{args.host}:{args.port}/payment.php")
+    print(f"   callback'и → {args.callback_url}, {args.rate:g}/с, задержка {args.latency:g}±{args.jitter:g} мс")
+    print("=" * 60)
+
+    if args.payments:
+        started = time.perf_counter()
+        simulator.generate_payments(args.payments)
+        simulator.dispatcher.join()
+        print(f"✅ {args.payments} платежей за {time.perf_counter() - started:.2f} с: {simulator.snapshot()}")
+        simulator.dispatcher.close()
+        return
+
+    from werkzeug.serving import make_server
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FreedomPay Pre-fork Server
+Многопроцессный режим тестового сервера FreedomPay
+
+Родитель открывает порт и запускает workers дочерних процессов (fork), каждый
+обслуживает общий сокет своим потоковым werkzeug-сервером. Статусы заказов лежат
+в общем SQLite (бэкенд "shared"), изменения из других воркеров доходят до
+long-poll/SSE клиентов через таблицу status_events.
+
+Упавший воркер перезапускается, SIGTERM/SIGINT останавливает все процессы.
+
+Запуск:
+    python freedom_pay_prefork.py --workers 4 --port 5000
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import time
+
+# Хранилище выбирается при импорте сервера, поэтому переменная ставится до него
+os.environ.setdefault("FREEDOMPAY_STATUS_STORE", "shared")
+
+import freedom_pay_final_attempt as server
+
+PREFORK_BACKLOG = 1024         # длина очереди соединений общего сокета
+PREFORK_RESTART_DELAY = 1.0    # секунд между перезапусками упавшего воркера
+PREFORK_STOP_TIMEOUT = 10      # секунд ждем завершения воркеров, потом SIGKILL
+MULTIPROCESS_BACKENDS = ("shared",)
+
+class PreforkServer:
+    """Родительский процесс: общий сокет, запуск и перезапуск воркеров"""
+
+    def __init__(self, host, port, workers):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.children = {}  # pid -> номер воркера
+        self.stopping = False
+        self.sock = None
+        self.restarts = 0
+
+    def listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(PREFORK_BACKLOG)
+        self.sock.set_inheritable(True)
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return pid
+        # Дочерний процесс: reinit_after_fork уже сбросил состояние служб
+        code = 0
+        try:
+            run_worker(self.host, self.port, self.sock.fileno(), index)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException as e:
+            server.log_message("❌ Воркер завершился с ошибкой", level="ERROR", worker=index, error=str(e))
+            code = 1
+        finally:
+            server.logger.flush()
+        os._exit(code)
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        self.listen()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        server.log_message("🚀 Запуск FreedomPay сервера в режиме pre-fork", workers=self.workers,
+                           port=self.port, backend=server.STATUS_STORE_BACKEND)
+        replay_orphaned_journals(self.workers)
+        server.logger.flush()
+        for index in range(self.workers):
+            self.spawn(index)
+        while not self.stopping:
+            # Без блокирующего waitpid: после сигнала он бы перезапустился и не увидел stopping
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(0.2)
+                continue
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            server.log_message("⚠️ Воркер завершился, перезапуск", level="WARNING", worker=index,
+                               exit_code=os.waitstatus_to_exitcode(status))
+            time.sleep(PREFORK_RESTART_DELAY)
+            self.restarts += 1
+            self.spawn(index)
+        self.stop()
+
+    def stop(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.pop(pid, None)
+        deadline = time.monotonic() + PREFORK_STOP_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.children:
+            os.kill(pid, signal.SIGKILL)
+        self.sock.close()
+        server.log_message("🛑 Сервер pre-fork остановлен", restarts=self.restarts)
+
+def replay_orphaned_journals(workers):
+    """
+    Журналы worker-N с N >= workers остались от запуска с большим числом воркеров: их никто
+    не проиграет, поэтому родитель применяет их до fork и удаляет каталоги.
+    """
+    if server.callback_journal is None or not os.path.isdir(server.JOURNAL_DIR):
+        return
+    for name in sorted(os.listdir(server.JOURNAL_DIR)):
+        prefix, _, number = name.partition("-")
+        if prefix != "worker" or not number.isdigit() or int(number) < workers:
+            continue
+        path = os.path.join(server.JOURNAL_DIR, name)
+        journal = server.CallbackJournal(path)
+        stats = journal.recover(server.payment_statuses)
+        journal.close()
+        # Хранилище "shared" уже записало статусы (recover делает flush): журнал больше не нужен
+        shutil.rmtree(path)
+        server.log_message("📼 Журнал лишнего воркера проигран и удален", worker=int(number),
+                           callbacks=stats["callbacks"])
+
+def run_worker(host, port, fd, index):
+    """Воркер: werkzeug-сервер с потоками на унаследованном сокете"""
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C получает родитель и останавливает всех
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # прерывает serve_forever
+    httpd = make_server(host, port, server.app, threaded=True, fd=fd)
+    if server.callback_journal is not None:
+        # Свой журнал у каждого воркера: перезапущенный воркер проигрывает только свои callback'и
+        server.callback_journal.directory = os.path.join(server.JOURNAL_DIR, f"worker-{index}")
+    # Сверку со шлюзом ведет один воркер, иначе запросы к get_status2.php умножатся на число процессов
+    server.start_background_services(reconcile=index == 0)
+    server.log_message("👷 Воркер запущен", worker=index, pid=os.getpid())
+    try:
+        httpd.serve_forever()
+    finally:
+        # Воркер выходит через os._exit без atexit: принятые callback'и применяем сами
+        server.callback_queue.join()
+        server.payment_statuses.close()
+
+def main():
+    """Главная функция"""
+    parser = argparse.ArgumentParser(description="Тестовый сервер FreedomPay: несколько процессов-воркеров")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if server.STATUS_STORE_BACKEND not in MULTIPROCESS_BACKENDS:
+        sys.exit(f"❌ Бэкенд '{server.STATUS_STORE_BACKEND}' хранит статусы в памяти процесса, "
+                 f"для нескольких воркеров нужен FREEDOMPAY_STATUS_STORE=shared")
+    PreforkServer(args.host, args.port, args.workers).run()
+
+if __name__ == "__main__":
+    main()